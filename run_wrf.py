@@ -13,7 +13,7 @@ class Application():
 	def __init__(self):
 		curDir = os.path.dirname(os.path.abspath(__file__))
 	
-		#NOTE: If you're looking to automate (CRON) jobs, use this portion of the code to update control.txt
+		#NOTE: If you're looking to automate (CRON) jobs, use this portion of the code to update control.txt, date ranges can be run with campaign_start/campaign_end instead
 		
 		#Run the script
 		os.system("nohup " + curDir + "/scripts/Application.py")
@@ -7,6 +7,8 @@
 import datetime
 import time
 import os
+import re
+import sys
 import Tools
 
 # AppSettings: Class responsible for obtaining information from the control file and parsing it to classes that need the information
@@ -19,6 +21,7 @@ class AppSettings():
 	replacementKeys = {}
 	myUserID = None
 	logger = None
+	derivedRunDir = False
 	
 	def loadSettings(self):
 		curDir = os.path.dirname(os.path.abspath(__file__))
@@ -28,15 +31,15 @@ class AppSettings():
 				#To-Do: This can be simplified to a single if block, but for the time being, I'm going to leave it as is
 				if not line.split():
 					#Comment
-					self.logger.write("Ignored empty line")
+					self.logger.write("Ignored empty line", level = "debug")
 				else:
 					tokenized = line.split()
 					if(tokenized[0][0] == '#'):
 						#Comment line, ignore
-						self.logger.write("Comment line: " + line)
+						self.logger.write("Comment line: " + line.rstrip(), level = "debug")
 					else:
 						self.settings[tokenized[0]] = tokenized[1]
-						self.logger.write("Applying setting (" + tokenized[0] +"): " + tokenized[1])
+						self.logger.write("Applying setting (" + tokenized[0] +"): " + tokenized[1], fields = {"setting": tokenized[0], "value": tokenized[1]})
 		#Test for program critical settings
 		if(not self.settings):
 			self.logger.write("Program critical variables missing, check for existence of control.txt, abort.")
@@ -45,13 +48,19 @@ class AppSettings():
 			self.settings["headdir"] = curDir[:curDir.rfind('/')] + '/'
 			return True
         
+	# fetch: The value of a setting, None if it is not set (Optional settings such as campaign_start or ensemble_file are tested against None)
 	def fetch(self, key):
 		try:
 			return self.settings[key]
 		except KeyError:
-			print("Key (" + str(key) + ") does not exist")
+			self.logger.write("Key (" + str(key) + ") does not exist", level = "debug", fields = {"setting": key})
 			return None    
 			
+	# override: Replace a control.txt setting at run time (IE: From PerfDB recommendations), call assembleKeys() afterwards to refresh the keys
+	def override(self, key, value):
+		self.settings[key] = str(value)
+		self.logger.write("Setting overridden (" + str(key) + "): " + str(value))
+
 	def add_replacementKey(self, key, value):
 		self.replacementKeys[key] = value
 		self.logger.write("Additional replacement key added: " + str(key) + " = " + str(value))
@@ -73,12 +82,12 @@ class AppSettings():
 		self.replacementKeys["[end_hour]"] = str(self.endTime.hour)
 		self.replacementKeys["[geog_path]"] = self.fetch("geogdir")
 		self.replacementKeys["[table_path]"] = self.fetch("tabledir")
-		self.replacementKeys["[run_dir]"] = self.fetch("wrfdir") + '/' + self.fetch("starttime")[0:8]
-		self.replacementKeys["[out_geogrid_path]"] = self.fetch("wrfdir") + '/' + self.fetch("starttime")[0:8] + "/output"
-		self.replacementKeys["[run_output_dir]"] = self.fetch("wrfdir") + '/' + self.fetch("starttime")[0:8] + "/output"
-		self.replacementKeys["[run_postprd_dir]"] = self.fetch("wrfdir") + '/' + self.fetch("starttime")[0:8] + "/postprd"
+		self.replacementKeys["[run_dir]"] = self.fetch("rundir")
+		self.replacementKeys["[out_geogrid_path]"] = self.fetch("rundir") + "/output"
+		self.replacementKeys["[run_output_dir]"] = self.fetch("rundir") + "/output"
+		self.replacementKeys["[run_postprd_dir]"] = self.fetch("rundir") + "/postprd"
 		self.replacementKeys["[data_dir]"] = self.fetch("datadir") + '/' + self.fetch("modeldata") + '/' + self.fetch("starttime")
-		self.replacementKeys["[wrfout_output_dir]"] = self.fetch("wrfdir") + '/' + self.fetch("starttime")[0:8] + "/wrfout"
+		self.replacementKeys["[wrfout_output_dir]"] = self.fetch("rundir") + "/wrfout"
 		self.replacementKeys["[wrf_nio_tasks_per_group]"] = self.fetch("wrf_nio_tasks_per_group")
 		self.replacementKeys["[wrf_nio_groups]"] = self.fetch("wrf_nio_groups")
 		self.replacementKeys["[wrf_numtiles]"] = self.fetch("wrf_numtiles")
@@ -113,30 +122,49 @@ class AppSettings():
 		self.replacementKeys["[sf_urban_physics]"] = self.fetch("sf_urban_physics")
 		self.replacementKeys["[hail_opt]"] = self.fetch("hail_opt")
 		self.replacementKeys["[prec_acc_dt]"] = self.fetch("prec_acc_dt")
+		self.replacementKeys["[history_interval]"] = self.fetch("history_interval")
+		# A single wrf.exe run, restart segments (See Segments) render their own values
+		self.replacementKeys["[restart]"] = ".false."
+		self.replacementKeys["[restart_interval]"] = "7000"
 		self.replacementKeys["[io_vars]"] = "iofields_filename                   = 'IO_VARS.txt',\n" if self.fetch("use_io_vars") == "1" else ""
 	 
 	def replace(self, inStr):
 		if not inStr:
 			return inStr
-		fStr = inStr
-		for key, value in self.replacementKeys.items():
-			kStr = str(key)
-			vStr = str(value)
-			fStr = fStr.replace(kStr, vStr)
-		return fStr
+		# Single pass over the string, keys without a value are left in place
+		def lookup(match):
+			value = self.replacementKeys.get(match.group(0))
+			return match.group(0) if value is None else str(value)
+		return re.sub(r"\[[A-Za-z0-9_]+\]", lookup, inStr)
 		
 	def whoami(self):
 		return self.myUserID
-     
-	def __init__(self):
-		self.logger = Tools.loggedPrint.instance()	
-	
-		if(self.loadSettings() == False):
-			logger.write("Cannot init program, control.txt not found")
-			logger.close()
-			sys.exit("Failed to load settings, please check for control.txt")
-        
-		self.myUserID = os.popen("whoami").read()
+
+	# AppSettings: Loads control.txt, or copies the settings of base (IE: An ensemble member built from the ensemble's settings). overrides
+	#  is an optional dictionary of settings applied on top. rundir defaults to wrfdir/YYYYMMDD of starttime unless it is set explicitly.
+	def __init__(self, base = None, overrides = None):
+		self.logger = Tools.loggedPrint.instance()
+		self.settings = {}
+		self.replacementKeys = {}
+		self.derivedRunDir = False
+
+		if(base != None):
+			self.settings = dict(base.settings)
+			self.myUserID = base.myUserID
+			if base.derivedRunDir:
+				del self.settings["rundir"]
+		else:
+			if(self.loadSettings() == False):
+				self.logger.write("Cannot init program, control.txt not found")
+				self.logger.close()
+				sys.exit("Failed to load settings, please check for control.txt")
+			self.myUserID = os.popen("whoami").read()
+		if(overrides != None):
+			for key, value in overrides.items():
+				self.override(key, value)
+		if not "rundir" in self.settings:
+			self.settings["rundir"] = self.fetch("wrfdir") + '/' + self.fetch("starttime")[0:8]
+			self.derivedRunDir = True
 		
 		self.startTime = datetime.datetime.strptime(self.fetch("starttime"), "%Y%m%d%H")
 		self.runDays = self.fetch("rundays")
@@ -144,4 +172,4 @@ class AppSettings():
 
 		self.endTime = self.startTime + datetime.timedelta(days=int(self.runDays), hours=int(self.runHours))
 
-		self.assembleKeys()
\ No newline at end of file
+		self.assembleKeys()
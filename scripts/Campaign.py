@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# Campaign.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes and methods used to run a date range of cycles (IE: A hindcast campaign) from one program, several cycles at a time
+
+import os
+import sys
+import json
+import time
+import datetime
+import multiprocessing
+import ApplicationSettings
+import ModelData
+import ModelRun
+import Ensemble
+import Tools
+import JobTracker
+import Metrics
+import FileOps
+
+# cycle_settings: The settings of one cycle, control.txt with the cycle's starttime and run directory
+def cycle_settings(starttime, rundir):
+	return ApplicationSettings.AppSettings(overrides = {"starttime": starttime, "rundir": rundir})
+
+# run_cycle: Process entry point running one cycle through the pipeline (Or its ensemble, if ensemble_file is set). Each cycle runs in
+#  its own process so it has its own working directory, log file, job tracker and metrics. The exit code is 0 if the cycle completed
+def run_cycle(starttime, rundir):
+	logger = Tools.loggedPrint.instance()
+	logger.write("Campaign: Running cycle " + starttime + " in " + rundir)
+	settings = cycle_settings(starttime, rundir)
+	modelParms = ModelData.ModelDataParameters(settings.fetch("modeldata"))
+	JobTracker.JobTracker.instance().configure(settings)
+	Metrics.Metrics.instance().configure(settings)
+	if(settings.fetch("ensemble_file") != None):
+		success = Ensemble.Ensemble(settings, modelParms).run()
+	else:
+		success = ModelRun.ModelRun(settings, modelParms).run_all()
+	logger.write("Campaign: Cycle " + starttime + (" complete" if success else " failed"))
+	Metrics.Metrics.instance().finish(success)
+	logger.close()
+	sys.exit(0 if success else 1)
+
+# prefetch_cycle: Process entry point downloading the model data of a cycle before it starts, the download is recorded in the cycle's
+#  run state so the cycle skips it (See RunState)
+def prefetch_cycle(starttime, rundir):
+	logger = Tools.loggedPrint.instance()
+	logger.write("Campaign: Prefetching the model data of cycle " + starttime)
+	settings = cycle_settings(starttime, rundir)
+	FileOps.FileOps(settings).mkdir([rundir, rundir + "/output", rundir + "/wrfout", rundir + "/postprd"])
+	ModelRun.ModelRun(settings, ModelData.ModelDataParameters(settings.fetch("modeldata"))).download()
+	logger.close()
+	sys.exit(0)
+
+# Campaign: Runs every cycle from campaign_start to campaign_end (YYYYMMDDHH) each campaign_interval hours (Default: 24). Up to
+#  campaign_cycles_in_flight cycles (Default: 1) run at the same time, each in its own process, and the model data of the next
+#  campaign_prefetch cycles (Default: 1) is downloaded while they run. Progress is kept in a ledger (campaign_ledger, Default:
+#  wrfdir/campaign_<start>_<end>.json), completed cycles are skipped when the campaign is started again and unfinished ones resume.
+class Campaign:
+	aSet = None
+	logger = None
+	cycles = []
+	inFlight = 1
+	prefetch = 1
+	ledgerPath = ""
+	ledger = {}
+	pollInterval = 30
+	context = None
+	dayDirs = True
+
+	def __init__(self, settings):
+		self.aSet = settings
+		self.logger = Tools.loggedPrint.instance()
+		start = datetime.datetime.strptime(settings.fetch("campaign_start"), "%Y%m%d%H")
+		end = datetime.datetime.strptime(settings.fetch("campaign_end"), "%Y%m%d%H")
+		interval = int(settings.fetch("campaign_interval")) if settings.fetch("campaign_interval") != None else 24
+		self.cycles = []
+		current = start
+		while current <= end:
+			self.cycles.append(current.strftime("%Y%m%d%H"))
+			current += datetime.timedelta(hours = interval)
+		# Daily cycles keep the usual wrfdir/YYYYMMDD run directories, cycles within a day need the hour as well
+		self.dayDirs = (interval % 24 == 0)
+		self.inFlight = int(settings.fetch("campaign_cycles_in_flight")) if settings.fetch("campaign_cycles_in_flight") != None else 1
+		self.prefetch = int(settings.fetch("campaign_prefetch")) if settings.fetch("campaign_prefetch") != None else 1
+		self.ledgerPath = settings.fetch("campaign_ledger")
+		if(self.ledgerPath == None):
+			self.ledgerPath = settings.fetch("wrfdir") + "/campaign_" + self.cycles[0] + "_" + self.cycles[-1] + ".json"
+		self.ledger = {}
+		try:
+			with open(self.ledgerPath) as f:
+				self.ledger = json.load(f)
+		except (IOError, OSError, ValueError):
+			pass
+		# The controller's metrics go next to the ledger, rundir in control.txt is not one of the campaign's run directories
+		Metrics.Metrics.instance().export_to(os.path.splitext(self.ledgerPath)[0] + "_metrics.json")
+		# Each cycle process starts from a fresh interpreter, the program's singletons (Logger, JobTracker, Metrics) are not shared
+		self.context = multiprocessing.get_context("spawn")
+
+	def rundir(self, cycle):
+		return self.aSet.fetch("wrfdir") + '/' + (cycle[0:8] if self.dayDirs else cycle)
+
+	def status(self, cycle):
+		return self.ledger.get(cycle, {}).get("status", "pending")
+
+	# record: Update a cycle's ledger entry and save the ledger
+	def record(self, cycle, **values):
+		entry = self.ledger.setdefault(cycle, {"status": "pending", "rundir": self.rundir(cycle)})
+		entry.update(values)
+		if(self.aSet.fetch("debugmode") == '1'):
+			return
+		with open(self.ledgerPath + ".tmp", 'w') as f:
+			json.dump(self.ledger, f, indent = 1, sort_keys = True)
+		os.rename(self.ledgerPath + ".tmp", self.ledgerPath)
+
+	def now(self):
+		return datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+	def start(self, target, cycle):
+		process = self.context.Process(target = target, args = (cycle, self.rundir(cycle)), name = target.__name__ + " " + cycle)
+		process.start()
+		return process
+
+	def run(self):
+		pending = [c for c in self.cycles if self.status(c) != "complete"]
+		self.logger.write(" - Campaign of " + str(len(self.cycles)) + " cycles (" + self.cycles[0] + " to " + self.cycles[-1] + "), " + str(len(self.cycles) - len(pending)) +
+						  " already complete, " + str(self.inFlight) + " in flight, ledger: " + self.ledgerPath)
+		running = {}
+		prefetching = None
+		while pending or running:
+			for cycle, process in list(running.items()):
+				if process.is_alive():
+					continue
+				process.join()
+				del running[cycle]
+				self.record(cycle, status = "complete" if process.exitcode == 0 else "failed", finished = self.now(), exitcode = process.exitcode)
+				self.logger.write(" - Campaign: Cycle " + cycle + (" complete" if process.exitcode == 0 else " failed with exit code " + str(process.exitcode)) +
+								  ", " + str(len([c for c in self.cycles if self.status(c) == "complete"])) + " of " + str(len(self.cycles)) + " cycles complete")
+			if prefetching != None and not prefetching[1].is_alive():
+				prefetching[1].join()
+				self.record(prefetching[0], prefetched = prefetching[1].exitcode == 0)
+				prefetching = None
+			# The next cycle waits for its own prefetch to finish so its model data is not downloaded twice at once
+			while pending and len(running) < self.inFlight and (prefetching == None or prefetching[0] != pending[0]):
+				cycle = pending.pop(0)
+				running[cycle] = self.start(run_cycle, cycle)
+				self.record(cycle, status = "running", started = self.now(), finished = None, exitcode = None, pid = running[cycle].pid)
+				self.logger.write(" - Campaign: Started cycle " + cycle + " in " + self.rundir(cycle))
+			if prefetching == None:
+				# A failed prefetch is not retried, the cycle downloads its own data when it starts
+				upcoming = [c for c in pending[0:self.prefetch] if not "prefetched" in self.ledger.get(c, {})]
+				if upcoming:
+					prefetching = (upcoming[0], self.start(prefetch_cycle, upcoming[0]))
+			if pending or running:
+				time.sleep(self.pollInterval)
+		failed = [c for c in self.cycles if self.status(c) != "complete"]
+		if failed:
+			self.logger.write(" - Campaign: " + str(len(failed)) + " cycles failed (" + ", ".join(failed) + "), starting the campaign again retries them")
+		self.logger.write("Campaign complete, " + str(len(self.cycles) - len(failed)) + " of " + str(len(self.cycles)) + " cycles succeeded.")
+		return len(failed) == 0
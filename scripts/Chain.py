@@ -0,0 +1,312 @@
+#!/usr/bin/python
+# Chain.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes used to submit every job of a run at once as a chain of PBS job dependencies, and the monitor command used to
+#  follow, finish, cancel or clean up a submitted chain:
+#   python Chain.py status|finish|cancel|cleanup <rundir>
+
+import sys
+import os
+import json
+import datetime
+import ApplicationSettings
+import ModelData
+import ModelRun
+import Jobs
+import PreparePyJob
+import Tools
+import JobTracker
+import FileOps
+import RunState
+import Segments
+import Validate
+
+# The chain record and the progress file written by the jobs (See Jobs.check_lines()), both in the run directory
+CHAIN_FILE = "chain.json"
+PROGRESS_FILE = "chain_progress.txt"
+
+# The commands of the monitor
+COMMANDS = ["status", "finish", "cancel", "cleanup"]
+
+# The wrfout domain, the namelist templates run a single domain (max_dom = 1)
+WRF_DOMAIN = "d01"
+
+# stage_outputs: The RunState step recorded for a stage of the chain and the patterns of the files it produced (See ModelRun)
+def stage_outputs(stage, runDir):
+	return {"geogrid": ("geogrid", [runDir + "/output/geo_em.d0*"]),
+			"preprocessing": ("preprocessing", [runDir + "/output/wrfinput_d0*", runDir + "/output/wrfbdy_d01"]),
+			"wrf": ("wrf", [runDir + "/wrf_log.txt", runDir + "/output/wrfout*"]),
+			"post": ("post", [runDir + "/postprd/*"])}.get(stage)
+
+# Chain: Writes every job file of a run up front and submits them at once, each job depending on the one before it
+#  (qsub -W depend=afterok:<id>), so the scheduler can plan the next stage while the current one runs and the program exits as soon
+#  as the chain is submitted. The checks the program makes on the logs between jobs are appended to each job file instead, a failed
+#  check exits the job with an error and the scheduler removes the rest of the chain. A final job (python Chain.py finish) writes the
+#  GrADS control files, records the run in PerfDB and cleans up. The job IDs are saved to chain.json in the run directory for the
+#  monitor commands (See Monitor). Stages completed by an earlier run (See RunState) are not submitted again.
+class Chain:
+	aSet = None
+	run = None
+	logger = None
+	fileOps = None
+	runDir = ""
+	postDir = ""
+	progressFile = ""
+	stages = []
+
+	def __init__(self, run):
+		self.aSet = run.aSet
+		self.run = run
+		self.logger = Tools.loggedPrint.instance()
+		self.fileOps = FileOps.FileOps(run.aSet)
+		self.runDir = run.aSet.fetch("rundir")
+		self.postDir = self.runDir + "/postprd/"
+		self.progressFile = self.runDir + '/' + PROGRESS_FILE
+		self.stages = []
+
+	# prepare: Place the namelists and run files where the jobs expect them and append the checks to the job files written by ModelRun,
+	#  the work the program does between jobs when it follows them is done here before anything is submitted
+	def prepare(self):
+		settings = self.aSet
+		state = self.run.state
+		self.logger.write(" 4. Preparing the job chain")
+		if(settings.fetch("run_geogrid") == '1'):
+			self.fileOps.move(["namelist.wps.geogrid"], self.runDir + "/namelist.wps")
+		self.fileOps.copy([settings.fetch("headdir") + "vtables/Vtable." + settings.fetch("modeldata") + "*"], self.runDir)
+		self.fileOps.move(["namelist.wps*"], self.runDir)
+		self.run.jobs = Jobs.JobSteps(settings, self.run.modelParms, state)
+		if(settings.fetch("use_io_vars") == '1'):
+			self.fileOps.copy([settings.fetch("headdir") + "io_vars/IO_VARS.txt"], self.runDir + "/output/IO_VARS.txt")
+		# real.exe reads namelist.input, the wrf.exe version is put in its place by the pre-processing job once real.exe is done
+		self.run.write_wrf_namelist("namelist.input.wrf")
+		self.fileOps.remove([self.progressFile])
+		if(settings.fetch("run_geogrid") == '1' and not state.valid("geogrid")):
+			self.append_check("geogrid.job", Jobs.check_lines("geogrid", "grep -q \"Successful completion of program geogrid.exe\" geogrid.log*", self.progressFile))
+			self.stages.append({"stage": "geogrid", "dir": self.runDir, "jobFile": "geogrid.job"})
+		if(settings.fetch("run_preprocessing_jobs") == '1' and not state.valid("preprocessing")):
+			self.append_check("prerun.job", "mv rsl.out.0000 ../real_log.txt\nmv rsl.error.0000 ../real_error_log.txt\nrm -f rsl.out.* rsl.error.*\n" +
+							  Jobs.check_lines("preprocessing", "grep -q \"SUCCESS COMPLETE REAL_EM\" ../real_log.txt && [ -s wrfinput_d01 ] && [ -s wrfbdy_d01 ]", self.progressFile,
+										  onSuccess = "\tcp namelist.input.wrf namelist.input\n"))
+			self.stages.append({"stage": "preprocessing", "dir": self.runDir, "jobFile": "prerun.job"})
+		else:
+			self.fileOps.copy([self.runDir + "/output/namelist.input.wrf"], self.runDir + "/output/namelist.input")
+			# The inputs of wrf.exe are already written, check them before the wrf.exe job is queued
+			validate = Validate.Validate(settings, self.run.modelParms)
+			if(settings.fetch("run_wrf") == '1' and not state.valid("wrf") and not validate.check(validate.input_jobs(), "wrf.exe inputs")):
+				sys.exit(" 4. ERROR: wrfinput_d01 or wrfbdy_d01 is missing or invalid, check the log file.")
+		if(settings.fetch("run_wrf") == '1' and not state.valid("wrf") and Segments.segmented(settings)):
+			segments = Segments.Segments(settings, self.run.modelParms)
+			segments.write(self.run.tWrite)
+			# A wrfinput_d01 written by this chain starts the segments over
+			first = segments.pending() if state.valid("preprocessing") else 0
+			if(first == 0):
+				self.fileOps.remove([segments.progressFile])
+			self.stages.extend(segments.stages(first))
+		elif(settings.fetch("run_wrf") == '1' and not state.valid("wrf")):
+			self.append_check("wrf.job", "mv rsl.out.0000 ../wrf_log.txt\nmv rsl.error.0000 ../wrf_error_log.txt\nrm -f rsl.out.* rsl.error.*\n" +
+							  Jobs.check_lines("wrf", "grep -q \"SUCCESS COMPLETE WRF\" ../wrf_log.txt", self.progressFile))
+			self.stages.append({"stage": "wrf", "dir": self.runDir, "jobFile": "wrf.job"})
+		if(settings.fetch("run_postprocessing") == '1' and not state.valid("post")):
+			post = Jobs.Postprocessing_Steps(settings, self.run.modelParms)
+			if(post.prepare_postprocessing() == False):
+				sys.exit(" 4. ERROR: post-processing process failed to initialize, check error file.")
+			self.stages.append({"stage": "post", "dir": self.postDir, "jobFile": self.write_post_job(post)})
+		with Tools.cd(self.runDir):
+			with open("finish.job", 'w') as target_file:
+				target_file.write(self.finish_job())
+		self.stages.append({"stage": "finish", "dir": self.runDir, "jobFile": "finish.job"})
+
+	def append_check(self, jobFile, contents):
+		with open(self.runDir + '/' + jobFile, 'a') as target_file:
+			target_file.write(contents)
+
+	# expected_wrfout: The wrfout files wrf.exe will write, one per history_interval (The [history_interval] key rendered into
+	#  namelist.input) from the start to the end of the run
+	def expected_wrfout(self):
+		fList = []
+		interval = datetime.timedelta(minutes = int(self.aSet.replacementKeys["[history_interval]"]))
+		current = self.aSet.startTime
+		while current <= self.aSet.endTime:
+			fList.append(self.runDir + "/output/wrfout_" + WRF_DOMAIN + "_" + Jobs.wrf_date(current))
+			current += interval
+		return fList
+
+	# write_post_job: Write the UPP or Python post-processing job file to the postprd folder, returns its name
+	def write_post_job(self, post):
+		settings = self.aSet
+		if(settings.fetch("post_run_unipost") == '1'):
+			fList = self.expected_wrfout()
+			contents = post.upp_job(fList)
+			contents += Jobs.check_lines("post", "! grep -q \" failed\" upp_progress.txt && [ $(grep -c \" done$\" upp_progress.txt) -eq " + str(len(fList)) + " ]", self.progressFile)
+			jobFile = "upp.job"
+		else:
+			pyJob = PreparePyJob.PreparePyJob(settings, self.runDir + "/output", self.postDir)
+			contents = "#!/bin/bash\n"
+			contents += "#PBS -l nodes=" + settings.fetch("num_python_nodes") + "\n"
+			contents += "#PBS -N WRF_PYTHON_POST" + "\n"
+			contents += "#PBS -l walltime=" + settings.fetch("python_walltime") + "\n"
+			contents += "#PBS -A climlab" + "\n\n"
+			contents += pyJob.job_contents(self.postDir).replace("#!/bin/bash\n", "", 1)
+			contents += Jobs.check_lines("post", "grep -q \"\\*\\*\\*SUCCESS\\*\\*\\*\" " + self.postDir + "pypost.log", self.progressFile)
+			jobFile = "python_post.job"
+		with Tools.cd(self.postDir):
+			with open(jobFile, 'w') as target_file:
+				target_file.write(contents)
+		return jobFile
+
+	# finish_job: The last job of the chain, runs the finish command of the monitor on a single core
+	def finish_job(self):
+		settings = self.aSet
+		contents = "#!/bin/bash\n"
+		contents += "#PBS -l nodes=1:ppn=1\n"
+		contents += "#PBS -N WRF_FINISH" + "\n"
+		contents += "#PBS -l walltime=" + (settings.fetch("upp_walltime") if settings.fetch("post_run_unipost") == '1' else settings.fetch("geogrid_walltime")) + "\n"
+		contents += "#PBS -A climlab" + "\n\n"
+		contents += "source " + settings.fetch("sourcefile") + "\n"
+		contents += "cd " + settings.fetch("headdir") + "scripts\n\n"
+		contents += sys.executable + " Chain.py finish " + self.runDir + "\n"
+		return contents
+
+	# submit: Submit the stages in order, each one depending on the job before it, and save the chain record
+	def submit(self):
+		settings = self.aSet
+		previous = None
+		for stage in self.stages:
+			command = "qsub "
+			if previous != None:
+				command += "-W depend=afterok:" + (previous["jobID"] if previous["jobID"] != None else "<" + previous["stage"] + ">") + " "
+			with Tools.cd(stage["dir"]):
+				self.fileOps.chmod_x([stage["jobFile"]])
+				jobSub = Tools.popen(settings, command + stage["jobFile"])
+			stage["jobID"] = jobSub.jobID
+			if(settings.fetch("debugmode") != '1' and jobSub.jobID == None):
+				self.logger.write(" 4. Failed to submit " + stage["jobFile"] + ", cancelling the chain: " + jobSub.fetch()[1].strip(), level = "error")
+				JobTracker.JobTracker.instance().cancel([s["jobID"] for s in self.stages if s.get("jobID") != None])
+				return False
+			step = stage_outputs(stage["stage"], self.runDir)
+			if(step != None and jobSub.jobID != None):
+				self.run.state.submitted(step[0], jobSub.jobID, stage["jobFile"])
+			self.logger.write("  4. " + stage["stage"] + ": " + stage["jobFile"] + " submitted" + (" (" + jobSub.jobID + ")" if jobSub.jobID != None else ""))
+			previous = stage
+		self.save()
+		self.logger.write(" 4. Job chain submitted, follow it with: python " + settings.fetch("headdir") + "scripts/Chain.py status " + self.runDir)
+		return True
+
+	def save(self):
+		if(self.aSet.fetch("debugmode") == '1'):
+			return
+		record = {"submitted": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), "stages": self.stages, "settings": self.aSet.settings,
+				  "nproc_x": self.run.save_nproc_x, "nproc_y": self.run.save_nproc_y, "wrfout": len(self.expected_wrfout())}
+		with open(self.runDir + '/' + CHAIN_FILE + ".tmp", 'w') as f:
+			json.dump(record, f, indent = 1)
+		os.rename(self.runDir + '/' + CHAIN_FILE + ".tmp", self.runDir + '/' + CHAIN_FILE)
+
+	# run_all: Run the steps of the program up to the job files (See ModelRun), then prepare and submit the chain
+	def run_all(self):
+		self.run.setup()
+		self.run.download()
+		self.run.write_files()
+		self.prepare()
+		return self.submit()
+
+# Monitor: Attaches to the chain submitted in a run directory (See Chain), the settings of the run are read back from chain.json
+class Monitor:
+	runDir = ""
+	record = {}
+	aSet = None
+	modelParms = None
+	logger = None
+	tracker = None
+
+	def __init__(self, runDir):
+		self.runDir = os.path.abspath(runDir)
+		self.logger = Tools.loggedPrint.instance()
+		try:
+			with open(self.runDir + '/' + CHAIN_FILE) as f:
+				self.record = json.load(f)
+		except (IOError, OSError, ValueError):
+			self.logger.write("Chain: No job chain was submitted in " + self.runDir + " (" + CHAIN_FILE + " not found)")
+			self.logger.close()
+			sys.exit(2)
+		saved = dict(self.record["settings"])
+		saved.pop("headdir", None)
+		self.aSet = ApplicationSettings.AppSettings(overrides = saved)
+		self.modelParms = ModelData.ModelDataParameters(self.aSet.fetch("modeldata"))
+		self.tracker = JobTracker.JobTracker.instance()
+		self.tracker.configure(self.aSet)
+		for stage in self.record["stages"]:
+			if(stage.get("jobID") != None):
+				self.tracker.track(stage["jobID"], stage["jobFile"])
+		self.tracker.refresh(force = True)
+
+	# record_progress: Mark the stages reported complete by their jobs as complete in the run state, so a later run skips them. The
+	#  wrf.exe restart segments report to their own progress file (See Segments)
+	def record_progress(self):
+		progress = Jobs.read_progress(self.runDir + "/" + Segments.PROGRESS_FILE)
+		progress.update(Jobs.read_progress(self.runDir + "/" + PROGRESS_FILE))
+		state = RunState.RunState(self.aSet)
+		for stage in self.record["stages"]:
+			step = stage_outputs(stage["stage"], self.runDir)
+			if(step != None and progress.get(stage["stage"]) == "complete" and not state.valid(step[0])):
+				state.complete(step[0], step[1])
+		return progress
+
+	# status: Print the state of every job in the chain, returns False if a stage failed or its job ended without reporting
+	def status(self):
+		progress = self.record_progress()
+		failed = False
+		self.logger.write("Chain: Submitted " + self.record["submitted"] + " (UTC) in " + self.runDir)
+		for stage in self.record["stages"]:
+			jobID = stage.get("jobID")
+			state = self.tracker.state(jobID) if jobID != None else JobTracker.UNKNOWN
+			exitCode = self.tracker.exitCode(jobID) if jobID != None else None
+			reported = progress.get(stage["stage"], "complete" if stage["stage"] == "finish" and progress.get("chain") == "complete" else None)
+			if reported == None and state == JobTracker.EXITED:
+				reported = "removed" if any(progress.get(s["stage"]) == "failed" for s in self.record["stages"]) else "ended without reporting"
+			if(reported != None and reported != "complete"):
+				failed = True
+			self.logger.write("  " + stage["stage"] + ": job " + str(jobID) + " (" + stage["jobFile"] + ") is " + state + ("" if exitCode == None else ", exit code " + str(exitCode)) +
+							  ("" if reported == None else ", " + reported))
+		return not failed
+
+	# finish: Run by the last job of the chain, the post-processing and cleanup the program does after wrf.exe
+	def finish(self):
+		progress = self.record_progress()
+		run = ModelRun.ModelRun(self.aSet, self.modelParms)
+		run.save_nproc_x = self.record["nproc_x"]
+		run.save_nproc_y = self.record["nproc_y"]
+		if(progress.get("wrf") == "complete"):
+			run.record_wrf(self.tracker.latest("wrf.job"))
+		if(progress.get("post") == "complete" and self.aSet.fetch("post_run_unipost") == '1'):
+			Jobs.Postprocessing_Steps(self.aSet, self.modelParms).grib_to_ctl(self.record["wrfout"])
+		run.cleanup()
+		with open(self.runDir + '/' + PROGRESS_FILE, 'a') as f:
+			f.write("chain complete\n")
+		self.logger.write("Chain: Run complete in " + self.runDir)
+		return True
+
+	# cancel: Remove the jobs of the chain that have not finished
+	def cancel(self):
+		pending = self.tracker.outstanding()
+		if not pending:
+			self.logger.write("Chain: No jobs left to cancel")
+			return True
+		self.tracker.cancel(pending)
+		return True
+
+	# cleanup: Cancel what is left of the chain and remove the temporary files of the run (Step 6)
+	def cleanup(self):
+		self.cancel()
+		self.record_progress()
+		ModelRun.ModelRun(self.aSet, self.modelParms).cleanup()
+		return True
+
+if __name__ == "__main__":
+	if(len(sys.argv) != 3 or not sys.argv[1] in COMMANDS):
+		print("Usage: python Chain.py " + "|".join(COMMANDS) + " <rundir>")
+		sys.exit(2)
+	monitor = Monitor(sys.argv[2])
+	success = getattr(monitor, sys.argv[1])()
+	Tools.loggedPrint.instance().close()
+	sys.exit(0 if success else 1)
@@ -8,6 +8,10 @@ import sys
 import os
 import ApplicationSettings
 import Tools
+import DataCache
+import FileOps
+import Staging
+import ModelData
 
 class PostRunCleanup():
 	sObj = None
@@ -17,8 +21,8 @@ class PostRunCleanup():
 		
 	def performClean(self, cleanAll = True, cleanOutFiles = True, cleanErrorFiles = True, cleanBdyFiles = True, cleanInFiles = True, cleanWRFOut = True, cleanModelData = True):
 		sTime = self.sObj.fetch("starttime")
-		dataDir = self.sObj.fetch("datadir") + '/' + self.sObj.fetch("modeldata") + sTime
-		wrfDir = self.sObj.fetch("wrfdir") + '/' + sTime[0:8]
+		dataDir = self.sObj.fetch("datadir") + '/' + self.sObj.fetch("modeldata") + '/' + sTime
+		wrfDir = self.sObj.fetch("rundir")
 		outDir = wrfDir + "/output"
 		if(cleanAll == True):
 			cleanOutFiles = True
@@ -26,66 +30,61 @@ class PostRunCleanup():
 			cleanInFiles = True
 			cleanWRFOut = True
 			cleanModelData = True
+		# Every pattern is collected first and removed in one batch, so each directory is only listed once
+		patterns = []
 		if(cleanOutFiles == True):
-			Tools.popen(self.sObj, "rm " + wrfDir + "/geogrid.log.*")
-			Tools.popen(self.sObj, "rm " + wrfDir + "/metgrid.log.*")
-			Tools.popen(self.sObj, "rm " + wrfDir + "/ungrib.log*")
-			Tools.popen(self.sObj, "rm " + outDir + "/rsl.out.*")
-			Tools.popen(self.sObj, "rm " + wrfDir + "/GEOGRID.o*")
-			Tools.popen(self.sObj, "rm " + wrfDir + "/METGRID.o*")
-			Tools.popen(self.sObj, "rm " + wrfDir + "/UNGRIB.o*") #This shouldn't be needed, but in the event we use a job for ungrib.
-			Tools.popen(self.sObj, "rm " + outDir + "/REAL.o*")
-			Tools.popen(self.sObj, "rm " + outDir + "/WRF.o*")
+			patterns.append(wrfDir + "/geogrid.log.*")
+			patterns.append(wrfDir + "/metgrid.log.*")
+			patterns.append(wrfDir + "/ungrib.log*")
+			patterns.append(outDir + "/rsl.out.*")
+			patterns.append(wrfDir + "/GEOGRID.o*")
+			patterns.append(wrfDir + "/METGRID.o*")
+			patterns.append(wrfDir + "/UNGRIB.o*") #This shouldn't be needed, but in the event we use a job for ungrib.
+			patterns.append(outDir + "/REAL.o*")
+			patterns.append(outDir + "/WRF.o*")
 		if(cleanErrorFiles == True):
-			Tools.popen(self.sObj, "rm " + outDir + "/rsl.error.*")
-			Tools.popen(self.sObj, "rm " + wrfDir + "/GEOGRID.e*")
-			Tools.popen(self.sObj, "rm " + wrfDir + "/METGRID.e*")
-			Tools.popen(self.sObj, "rm " + wrfDir + "/UNGRIB.e*") #This shouldn't be needed, but in the event we use a job for ungrib.
-			Tools.popen(self.sObj, "rm " + outDir + "/REAL.e*")
-			Tools.popen(self.sObj, "rm " + outDir + "/WRF.e*")	
+			patterns.append(outDir + "/rsl.error.*")
+			patterns.append(wrfDir + "/GEOGRID.e*")
+			patterns.append(wrfDir + "/METGRID.e*")
+			patterns.append(wrfDir + "/UNGRIB.e*") #This shouldn't be needed, but in the event we use a job for ungrib.
+			patterns.append(outDir + "/REAL.e*")
+			patterns.append(outDir + "/WRF.e*")
 		if(cleanBdyFiles == True):
-			Tools.popen(self.sObj, "rm " + outDir + "/met_em*")
-			Tools.popen(self.sObj, "rm " + outDir + "/wrfinput*")
-			Tools.popen(self.sObj, "rm " + outDir + "/wrfbdy*")		
-			Tools.popen(self.sObj, "rm " + outDir + "/geo_em.d01.nc*")
+			patterns.append(outDir + "/met_em*")
+			patterns.append(outDir + "/wrfinput*")
+			patterns.append(outDir + "/wrfbdy*")
+			patterns.append(outDir + "/geo_em.d01.nc*")
+			# The restart files a segmented wrf.exe run resumes from (See Segments)
+			patterns.append(outDir + "/wrfrst*")
+			patterns.append(outDir + "/namelist.input.seg*")
 		if(cleanInFiles == True):
-			Tools.popen(self.sObj, "rm " + wrfDir + "/GRIBFILE.*")
-			Tools.popen(self.sObj, "rm " + wrfDir + "/3D:*")
-			Tools.popen(self.sObj, "rm " + wrfDir + "/FLX:*")
-			Tools.popen(self.sObj, "rm " + outDir + "/FILE:*")
-			Tools.popen(self.sObj, "rm " + outDir + "/aero*")
-			Tools.popen(self.sObj, "rm " + outDir + "/bulk*")
-			Tools.popen(self.sObj, "rm " + outDir + "/CAM*")
-			Tools.popen(self.sObj, "rm " + outDir + "/capacity.asc")
-			Tools.popen(self.sObj, "rm " + outDir + "/CCN*")
-			Tools.popen(self.sObj, "rm " + outDir + "/CLM*")
-			Tools.popen(self.sObj, "rm " + outDir + "/co2_trans")
-			Tools.popen(self.sObj, "rm " + outDir + "/coeff*")
-			Tools.popen(self.sObj, "rm " + outDir + "/constants.asc")
-			Tools.popen(self.sObj, "rm " + outDir + "/create_p3_lookupTable_1.f90")
-			Tools.popen(self.sObj, "rm " + outDir + "/ETA*")
-			Tools.popen(self.sObj, "rm " + outDir + "/GEN*")
-			Tools.popen(self.sObj, "rm " + outDir + "/grib*")
-			Tools.popen(self.sObj, "rm " + outDir + "/kernels*")
-			Tools.popen(self.sObj, "rm " + outDir + "/LANDUSE.TBL")
-			Tools.popen(self.sObj, "rm " + outDir + "/masses.asc")
-			Tools.popen(self.sObj, "rm " + outDir + "/MPTABLE.TBL")
-			Tools.popen(self.sObj, "rm " + outDir + "/ozone*")
-			Tools.popen(self.sObj, "rm " + outDir + "/p3_lookup_table_1.dat")
-			Tools.popen(self.sObj, "rm " + outDir + "/RRTM*")
-			Tools.popen(self.sObj, "rm " + outDir + "/RRTMG*")
-			Tools.popen(self.sObj, "rm " + outDir + "/SOILPARM.TBL")
-			Tools.popen(self.sObj, "rm " + outDir + "/termvels.asc")
-			Tools.popen(self.sObj, "rm " + outDir + "/tr*")
-			Tools.popen(self.sObj, "rm " + outDir + "/URB*")
-			Tools.popen(self.sObj, "rm " + outDir + "/VEG*")
-			Tools.popen(self.sObj, "rm " + outDir + "/wind-turbine-1.tbl")
-			Tools.popen(self.sObj, "rm " + outDir + "/real.exe")
-			Tools.popen(self.sObj, "rm " + outDir + "/tc.exe")
-			Tools.popen(self.sObj, "rm " + outDir + "/wrf.exe")
+			patterns.append(wrfDir + "/GRIBFILE.*")
+			patterns.append(wrfDir + "/3D:*")
+			patterns.append(wrfDir + "/FLX:*")
+			patterns.append(outDir + "/FILE:*")
+			# The WRF run files, as recorded when they were staged
+			patterns.extend(Staging.Staging(self.sObj).staged_patterns(outDir))
 		if(cleanWRFOut == True):
-			Tools.popen(self.sObj, "rm " + outDir + "/wrfout*")
-			Tools.popen(self.sObj, "rm " + outDir + "/wrfrst*")
+			patterns.append(outDir + "/wrfout*")
+			patterns.append(outDir + "/wrfrst*")
+		FileOps.FileOps(self.sObj).remove(patterns)
+		if(cleanInFiles == True):
+			# Working directories of the concurrent ungrib.exe slices (ungrib_parallel)
+			FileOps.FileOps(self.sObj).remove([wrfDir + "/ungrib_*"], recursive = True)
+		if(cleanBdyFiles == True and self.sObj.fetch("use_stage_cache") == '1' and self.sObj.fetch("debugmode") != '1'):
+			# The run's geo_em/met_em/wrfinput/wrfbdy links are gone, its stage cache entries may now be evicted
+			released = DataCache.StageCache(self.sObj).release(wrfDir)
+			Tools.loggedPrint.instance().write("  - Released " + str(released) + " stage cache references")
 		if(cleanModelData == True):
-			Tools.popen(self.sObj, "rm -r " + dataDir)
+			# With the shared cache the directory only holds links, release the run's references so the cached files can be reused or evicted
+			if(self.sObj.fetch("use_data_cache") == '1' and self.sObj.fetch("debugmode") != '1'):
+				released = DataCache.ModelDataCache(self.sObj).release(dataDir)
+				Tools.loggedPrint.instance().write("  - Released " + str(released) + " model data cache references")
+			# Model data that cannot be downloaded again (IE: NARR) was staged by hand and is kept. Only downloaded data goes through the
+			#  shared cache, so a directory holding cache links is always one that may be removed
+			modelParms = ModelData.ModelDataParameters(self.sObj.fetch("modeldata"))
+			if(modelParms.validModel() and modelParms.fetch()["CanDownloadDirectly"] == True):
+				FileOps.FileOps(self.sObj).remove([dataDir], recursive = True)
+			else:
+				Tools.loggedPrint.instance().write("  - Keeping " + dataDir + ", " + self.sObj.fetch("modeldata") + " data cannot be downloaded again")
 		return None
\ No newline at end of file
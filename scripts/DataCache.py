@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# DataCache.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes used to share downloaded and generated files between runs through a content-addressed cache
+
+import os
+import json
+import time
+import fcntl
+import errno
+import shutil
+import glob
+import hashlib
+import Tools
+
+# file_hash: Returns the sha256 digest of a file
+def file_hash(path):
+	h = hashlib.sha256()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1048576), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+# link_file: Places source at dest as a hardlink, falling back to a symbolic link when the two paths are on different filesystems
+def link_file(source, dest):
+	if os.path.lexists(dest):
+		os.remove(dest)
+	try:
+		os.link(source, dest)
+	except OSError as e:
+		if not e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+			raise
+		os.symlink(source, dest)
+
+# ContentCache: A directory of content-addressed objects (objects/<hash>) and an index mapping cache keys to a set of named objects.
+#  Each key records the runs referencing it and its last access time, unreferenced keys are evicted least-recently-used first once
+#  the objects exceed the quota. The index is guarded by an flock so concurrent runs can share the cache.
+class ContentCache:
+	root = ""
+	quota = 0
+	logger = None
+
+	def __init__(self, root, quota):
+		self.root = root
+		self.quota = quota
+		self.logger = Tools.loggedPrint.instance()
+		if not os.path.isdir(self.root + "/objects"):
+			os.makedirs(self.root + "/objects")
+
+	def objectPath(self, digest):
+		return self.root + "/objects/" + digest[0:2] + '/' + digest
+
+	def load(self):
+		try:
+			with open(self.root + "/index.json") as f:
+				return json.load(f)
+		except (IOError, OSError, ValueError):
+			return {"entries": {}}
+
+	def save(self, index):
+		with open(self.root + "/index.json.tmp", 'w') as f:
+			json.dump(index, f)
+		os.rename(self.root + "/index.json.tmp", self.root + "/index.json")
+
+	# update: Apply func(index) while holding the cache lock, the index is saved afterwards and func's return value is passed back
+	def update(self, func):
+		with open(self.root + "/.lock", 'a') as lockFile:
+			fcntl.flock(lockFile, fcntl.LOCK_EX)
+			try:
+				index = self.load()
+				result = func(index)
+				self.save(index)
+				return result
+			finally:
+				fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+	# link: Link every file of a cached key into destDir and reference it from ref, returns False on a cache miss
+	def link(self, key, destDir, ref):
+		def apply(index):
+			entry = index["entries"].get(key)
+			if entry is None:
+				return False
+			for name, digest in entry["files"].items():
+				if not os.path.isfile(self.objectPath(digest)):
+					del index["entries"][key]
+					return False
+			for name, digest in entry["files"].items():
+				link_file(self.objectPath(digest), destDir + '/' + name)
+			entry["atime"] = time.time()
+			if not ref in entry["refs"]:
+				entry["refs"].append(ref)
+			return True
+		return self.update(apply)
+
+	# store: Add files ({name: path}) to the cache under key, each path is replaced by a link to its cached object
+	def store(self, key, files, ref):
+		digests = {}
+		for name, path in files.items():
+			digests[name] = file_hash(path)
+		def apply(index):
+			size = 0
+			for name, path in files.items():
+				obj = self.objectPath(digests[name])
+				if not os.path.isfile(obj):
+					if not os.path.isdir(os.path.dirname(obj)):
+						os.makedirs(os.path.dirname(obj))
+					try:
+						os.link(path, obj)
+					except OSError:
+						shutil.copyfile(path, obj + ".tmp")
+						os.rename(obj + ".tmp", obj)
+					os.chmod(obj, 0o444)
+				link_file(obj, path)
+				size += os.path.getsize(obj)
+			entry = index["entries"].get(key, {"refs": []})
+			entry["files"] = digests
+			entry["size"] = size
+			entry["atime"] = time.time()
+			if not ref in entry["refs"]:
+				entry["refs"].append(ref)
+			index["entries"][key] = entry
+		self.update(apply)
+		self.evict()
+
+	# release: Drop every reference held by ref, the cached objects stay available to later runs
+	def release(self, ref):
+		def apply(index):
+			count = 0
+			for entry in index["entries"].values():
+				if ref in entry["refs"]:
+					entry["refs"].remove(ref)
+					count += 1
+			return count
+		return self.update(apply)
+
+	# evict: Remove unreferenced keys, least recently used first, until the cached objects fit in the quota
+	def evict(self):
+		def apply(index):
+			entries = index["entries"]
+			objects = {}
+			for entry in entries.values():
+				for digest in entry["files"].values():
+					objects[digest] = self.objectPath(digest)
+			total = sum(os.path.getsize(p) for p in objects.values() if os.path.isfile(p))
+			removed = 0
+			for key in sorted(entries.keys(), key = lambda k: entries[k]["atime"]):
+				if(total <= self.quota):
+					break
+				if entries[key]["refs"]:
+					continue
+				digests = entries.pop(key)["files"].values()
+				inUse = set(d for e in entries.values() for d in e["files"].values())
+				for digest in digests:
+					if not digest in inUse and os.path.isfile(objects[digest]):
+						total -= os.path.getsize(objects[digest])
+						os.remove(objects[digest])
+				removed += 1
+			if removed > 0:
+				self.logger.write("  - Cache (" + self.root + "): Evicted " + str(removed) + " entries, " + str(total) + " bytes remain")
+			return removed
+		return self.update(apply)
+
+# ModelDataCache: The shared cache of model input files, keyed by model, initialization time and valid time.
+#  Settings: use_data_cache (1/0), cachedir (Default: datadir/cache), cache_quota_gb (Default: 100)
+class ModelDataCache(ContentCache):
+	def __init__(self, settings):
+		root = settings.fetch("cachedir")
+		if(root == None):
+			root = settings.fetch("datadir") + "/cache"
+		quota = settings.fetch("cache_quota_gb")
+		quota = float(quota) if quota != None else 100.0
+		ContentCache.__init__(self, root + "/modeldata", int(quota * 1024 ** 3))
+
+	def key(self, model, initTime, validTime, fileName):
+		return model + '/' + initTime.strftime('%Y%m%d%H') + '/' + validTime.strftime('%Y%m%d%H') + '/' + fileName
+
+# namelist_lines: The lines of the given sections of a rendered namelist file, without the entries named in drop (IE: Output paths that
+#  change with every run but not the result), used to build the stage keys
+def namelist_lines(path, sections, drop = None):
+	lines = []
+	current = None
+	with open(path) as f:
+		for line in f:
+			line = line.strip()
+			if line.startswith('&'):
+				current = line[1:].lower()
+				continue
+			if line == '/':
+				current = None
+				continue
+			if not current in sections or not line:
+				continue
+			name = line.split('=')[0].strip().lower()
+			if drop != None and name in drop:
+				continue
+			lines.append(current + ":" + line)
+	return lines
+
+# fingerprints: Name, size and modification time of each file, a missing file is listed as such
+def fingerprints(paths):
+	out = []
+	for path in paths:
+		try:
+			st = os.stat(path)
+			out.append(os.path.basename(path) + ":" + str(st.st_size) + ":" + str(st.st_mtime_ns))
+		except OSError:
+			out.append(os.path.basename(path) + ":missing")
+	return out
+
+# StageCache: The shared cache of the geogrid, ungrib, metgrid and real.exe outputs. Each stage is keyed by a hash of its actual inputs
+#  (The rendered namelist sections it reads, its tables or Vtable, the input file fingerprints and the keys of the stages it reads from),
+#  so a run with the same inputs links the cached files into its run directory and skips the job.
+#  Settings: use_stage_cache (1/0), cachedir (Default: datadir/cache), stage_cache_quota_gb (Default: 200)
+class StageCache(ContentCache):
+	def __init__(self, settings):
+		root = settings.fetch("cachedir")
+		if(root == None):
+			root = settings.fetch("datadir") + "/cache"
+		quota = settings.fetch("stage_cache_quota_gb")
+		quota = float(quota) if quota != None else 200.0
+		ContentCache.__init__(self, root + "/stages", int(quota * 1024 ** 3))
+
+	def key(self, stage, parts):
+		return stage + '/' + hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+	# geogrid_key: geo_em depends on the domain (&geogrid), the core and output format (&share) and GEOGRID.TBL
+	def geogrid_key(self, namelist, tableDir):
+		parts = namelist_lines(namelist, ["share", "geogrid"], drop = ["start_date", "end_date", "interval_seconds", "opt_output_from_geogrid_path"])
+		parts.append(file_hash(tableDir + "/GEOGRID.TBL") if os.path.isfile(tableDir + "/GEOGRID.TBL") else "GEOGRID.TBL:missing")
+		return self.key("geogrid", parts)
+
+	# ungrib_key: The intermediate files of one input stream depend on its dates (&share), prefix (&ungrib), Vtable and GRIB files
+	def ungrib_key(self, namelist, vtable, inputFiles):
+		parts = namelist_lines(namelist, ["share", "ungrib"], drop = ["opt_output_from_geogrid_path", "io_form_geogrid"])
+		parts.append(file_hash(vtable))
+		return self.key("ungrib", parts + fingerprints(inputFiles))
+
+	# metgrid_key: met_em depends on &metgrid, METGRID.TBL, the constants file and the geogrid and ungrib outputs it reads
+	def metgrid_key(self, namelist, tableDir, geogridKey, ungribKeys):
+		parts = namelist_lines(namelist, ["share", "metgrid"], drop = ["opt_output_from_geogrid_path", "opt_output_from_metgrid_path", "io_form_geogrid"])
+		parts.append(file_hash(tableDir + "/METGRID.TBL") if os.path.isfile(tableDir + "/METGRID.TBL") else "METGRID.TBL:missing")
+		return self.key("metgrid", parts + [geogridKey] + ungribKeys)
+
+	# real_key: wrfinput/wrfbdy depend on the real.exe namelist.input (Less the decomposition, tiling, debug and wrf.exe output entries) and met_em
+	def real_key(self, namelist, metgridKey):
+		parts = namelist_lines(namelist, ["time_control", "domains", "physics", "dynamics", "bdy_control"],
+							   drop = ["nproc_x", "nproc_y", "numtiles", "debug_level", "iofields_filename", "ignore_iofields_warning", "history_interval",
+									   "frames_per_outfile", "restart", "restart_interval", "io_form_history", "io_form_restart", "history_outname"])
+		return self.key("real", parts + [metgridKey])
+
+	# fetch: Link a cached stage's files into destDir, False on a miss
+	def fetch(self, key, destDir, ref):
+		return self.link(key, destDir, ref)
+
+	# keep: Store every file matching patterns under key unless the key is already cached, returns the number of files stored
+	def keep(self, key, patterns, ref):
+		if key in self.load()["entries"]:
+			return 0
+		files = {}
+		for pattern in patterns:
+			for path in sorted(glob.glob(pattern)):
+				if os.path.isfile(path):
+					files[os.path.basename(path)] = path
+		if files:
+			self.store(key, files, ref)
+		return len(files)
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+# Downloader.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes used to download model data over persistent HTTP connections with resume, retry and verification
+
+import os
+import time
+import threading
+import http.client
+import urllib.parse
+from multiprocessing.pool import ThreadPool
+import Tools
+
+#DownloadError: Custom exception that is thrown when a transfer fails, fatal errors (IE: 404) are not retried
+class DownloadError(Exception):
+	fatal = False
+
+	def __init__(self, message, fatal = False):
+		Exception.__init__(self, message)
+		self.fatal = fatal
+
+# grib_complete: Verifier for GRIB files, a complete file starts with the GRIB indicator and ends with the 7777 end section
+def grib_complete(path):
+	try:
+		with open(path, "rb") as f:
+			if(f.read(4) != b"GRIB"):
+				return False
+			f.seek(-4, os.SEEK_END)
+			return f.read(4) == b"7777"
+	except (IOError, OSError):
+		return False
+
+# DownloadTask: Mini class instance describing one file to fetch
+#  size: Expected size in bytes, if known (Otherwise taken from the server response). verify: Callable that takes the file path and returns True if the file is usable.
+class DownloadTask:
+	url = ""
+	dest = ""
+	size = None
+	verify = None
+
+	def __init__(self, url, dest, size = None, verify = None):
+		self.url = url
+		self.dest = dest
+		self.size = size
+		self.verify = verify
+
+	def partPath(self):
+		return self.dest + ".part"
+
+# DownloadResult: Mini class instance storing the outcome of a DownloadTask
+class DownloadResult:
+	task = None
+	ok = False
+	skipped = False
+	error = None
+	attempts = 0
+	received = 0
+
+	def __init__(self, task):
+		self.task = task
+		self.ok = False
+		self.skipped = False
+		self.error = None
+		self.attempts = 0
+		self.received = 0
+
+# Downloader: Class responsible for running a set of DownloadTasks on a thread pool.
+#  Each worker thread keeps one keep-alive connection per host (Closed once the pool finishes), partial transfers are kept in <dest>.part and resumed with range requests,
+#  and the finished file is only renamed into place once its size and verifier have passed.
+class Downloader:
+	threads = 6
+	retries = 5
+	backoff = 2
+	timeout = 60
+	chunkSize = 1048576
+	maxRedirects = 5
+	local = None
+	connections = None
+	lock = None
+
+	def __init__(self, settings):
+		if(settings.fetch("download_threads") != None):
+			self.threads = int(settings.fetch("download_threads"))
+		if(settings.fetch("download_retries") != None):
+			self.retries = int(settings.fetch("download_retries"))
+		self.local = threading.local()
+		self.connections = []
+		self.lock = threading.Lock()
+
+	def fetch(self, tasks):
+		if not tasks:
+			return []
+		t = ThreadPool(processes=min(self.threads, len(tasks)))
+		try:
+			results = t.map(self.download, tasks)
+		finally:
+			t.close()
+			t.join()
+			self.close_connections()
+		return results
+
+	def download(self, task):
+		logger = Tools.loggedPrint.instance()
+		result = DownloadResult(task)
+		if os.path.isfile(task.dest):
+			if self.verified(task, task.dest):
+				result.ok = True
+				result.skipped = True
+				return result
+			# An incomplete file from an earlier run becomes the partial file and is resumed
+			logger.write("  -> Existing file " + task.dest + " failed verification, resuming it")
+			os.rename(task.dest, task.partPath())
+		while result.attempts < self.retries:
+			result.attempts += 1
+			try:
+				result.received += self.transfer(task, task.url)
+				if not self.verified(task, task.partPath()):
+					# Start over, the partial data cannot be trusted
+					os.remove(task.partPath())
+					raise DownloadError("verification failed")
+				os.rename(task.partPath(), task.dest)
+				result.ok = True
+				result.error = None
+				logger.write("  -> Downloaded " + task.dest + " (" + str(result.received) + " bytes, " + str(result.attempts) + " attempt(s))")
+				return result
+			except (DownloadError, http.client.HTTPException, OSError) as e:
+				result.error = str(e)
+				self.drop_connection(task.url)
+				if isinstance(e, DownloadError) and e.fatal:
+					break
+				logger.write("  -> Download of " + task.url + " failed (" + str(e) + "), attempt " + str(result.attempts) + " of " + str(self.retries))
+				if(result.attempts < self.retries):
+					time.sleep(self.backoff * (2 ** (result.attempts - 1)))
+		logger.write("  -> Error: Could not download " + task.url + ": " + str(result.error))
+		return result
+
+	def verified(self, task, path):
+		if(task.size != None and os.path.getsize(path) != task.size):
+			return False
+		if(task.verify != None and not task.verify(path)):
+			return False
+		return True
+
+	def connection(self, url):
+		parts = urllib.parse.urlsplit(url)
+		key = (parts.scheme, parts.netloc)
+		if not hasattr(self.local, "connections"):
+			self.local.connections = {}
+		if not key in self.local.connections:
+			if(parts.scheme == "https"):
+				self.local.connections[key] = http.client.HTTPSConnection(parts.netloc, timeout=self.timeout)
+			else:
+				self.local.connections[key] = http.client.HTTPConnection(parts.netloc, timeout=self.timeout)
+			with self.lock:
+				self.connections.append(self.local.connections[key])
+		return self.local.connections[key]
+
+	def drop_connection(self, url):
+		parts = urllib.parse.urlsplit(url)
+		key = (parts.scheme, parts.netloc)
+		if hasattr(self.local, "connections") and key in self.local.connections:
+			conn = self.local.connections.pop(key)
+			with self.lock:
+				self.connections.remove(conn)
+			conn.close()
+
+	# close_connections: Close the keep-alive connections of every worker thread, called once the pool threads have exited
+	def close_connections(self):
+		with self.lock:
+			connections = self.connections
+			self.connections = []
+		for conn in connections:
+			conn.close()
+
+	# transfer: Fetch the remainder of the file into the .part file, returns the number of bytes received
+	def transfer(self, task, url, redirects = 0):
+		part = task.partPath()
+		offset = os.path.getsize(part) if os.path.isfile(part) else 0
+		parts = urllib.parse.urlsplit(url)
+		path = parts.path + ("?" + parts.query if parts.query else "")
+		headers = {"Connection": "keep-alive", "User-Agent": "wrf-gaea-run"}
+		if(offset > 0):
+			headers["Range"] = "bytes=" + str(offset) + "-"
+		conn = self.connection(url)
+		conn.request("GET", path, headers=headers)
+		response = conn.getresponse()
+		if response.status in (301, 302, 303, 307, 308):
+			response.read()
+			if(redirects >= self.maxRedirects):
+				raise DownloadError("too many redirects", fatal = True)
+			return self.transfer(task, urllib.parse.urljoin(url, response.getheader("Location")), redirects + 1)
+		if(response.status == 416 and offset > 0):
+			# The partial file already holds every byte the server has, let the verifier decide
+			response.read()
+			return 0
+		if(response.status == 404 or response.status == 403):
+			response.read()
+			raise DownloadError("HTTP " + str(response.status), fatal = True)
+		if not response.status in (200, 206):
+			response.read()
+			raise DownloadError("HTTP " + str(response.status))
+		total = None
+		if(response.status == 206):
+			contentRange = response.getheader("Content-Range", "")
+			if not contentRange.startswith("bytes " + str(offset) + "-"):
+				response.read()
+				raise DownloadError("unexpected Content-Range " + contentRange)
+			if not contentRange.endswith("/*"):
+				total = int(contentRange.rsplit('/', 1)[1])
+			mode = "ab"
+		else:
+			# The server ignored the range request, restart from the beginning
+			offset = 0
+			mode = "wb"
+			if(response.getheader("Content-Length") != None):
+				total = int(response.getheader("Content-Length"))
+		received = 0
+		with open(part, mode) as f:
+			while True:
+				chunk = response.read(self.chunkSize)
+				if not chunk:
+					break
+				f.write(chunk)
+				received += len(chunk)
+		if(total != None and offset + received != total):
+			raise DownloadError("transfer ended at " + str(offset + received) + " of " + str(total) + " bytes")
+		if(task.size == None and total != None):
+			task.size = total
+		return received
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# Ensemble.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes used to run every member of an ensemble from one program, members share the pre-processing and run wrf.exe concurrently
+
+import time
+import ApplicationSettings
+import Cleanup
+import Tools
+import Wait
+import Jobs
+import JobTracker
+import Metrics
+import ModelRun
+
+# read_members: Parse the ensemble file, each line is a member name followed by the settings it overrides (IE: "pbl_ysu bl_pbl_physics 1"),
+#  a member may span several lines. Empty lines and lines starting with # are ignored. Returns [(name, {setting: value})] in file order
+def read_members(path):
+	members = []
+	overrides = {}
+	with open(path) as f:
+		for line in f:
+			tokenized = line.split()
+			if not tokenized or tokenized[0][0] == '#':
+				continue
+			name = tokenized[0]
+			if not name in overrides:
+				overrides[name] = {}
+				members.append(name)
+			pairs = tokenized[1:]
+			if len(pairs) % 2 != 0:
+				raise ValueError("Ensemble member " + name + ": Expected setting/value pairs, got: " + line.rstrip())
+			for i in range(0, len(pairs), 2):
+				overrides[name][pairs[i]] = pairs[i + 1]
+	return [(name, overrides[name]) for name in members]
+
+# Member: One ensemble member, its settings (A copy of the ensemble's settings with the member's overrides) and its ModelRun
+class Member:
+	name = ""
+	aSet = None
+	run = None
+	error = None
+	jobSub = None
+	wait = None
+
+	def __init__(self, name, settings, modelParms):
+		self.name = name
+		self.aSet = settings
+		self.run = ModelRun.ModelRun(settings, modelParms)
+		self.error = None
+		self.jobSub = None
+		self.wait = None
+
+# Ensemble: Runs the members listed in ensemble_file (See read_members()). Each member has its own settings object and run directory
+#  (rundir/<member>). Members are prepared one after the other with the stage cache on, so geogrid, ungrib and metgrid run once for the
+#  first member and the members after it link the cached outputs (real.exe only runs again for members whose namelist.input differs).
+#  The wrf.exe jobs of every member are then submitted together and followed in one loop, a failing member does not stop the others.
+class Ensemble:
+	aSet = None
+	modelParms = None
+	logger = None
+	members = []
+	pollInterval = 30
+
+	def __init__(self, settings, modelParms):
+		self.aSet = settings
+		self.modelParms = modelParms
+		self.logger = Tools.loggedPrint.instance()
+		self.members = []
+		for name, overrides in read_members(settings.fetch("ensemble_file")):
+			memberOverrides = {"rundir": settings.fetch("rundir") + '/' + name}
+			if(settings.fetch("debugmode") != '1'):
+				memberOverrides["use_stage_cache"] = '1'
+			memberOverrides.update(overrides)
+			self.logger.write(" - Ensemble member " + name + ": " + (", ".join(k + " = " + v for k, v in sorted(overrides.items())) if overrides else "Base settings"))
+			self.members.append(Member(name, ApplicationSettings.AppSettings(base = settings, overrides = memberOverrides), modelParms))
+
+	def active(self):
+		return [m for m in self.members if m.error is None]
+
+	# guarded: Run one step of a member, a step that exits the program (sys.exit) marks the member as failed instead
+	def guarded(self, member, step, function):
+		try:
+			function()
+			return True
+		except SystemExit as e:
+			member.error = step + ": " + str(e)
+			self.logger.write(" - Ensemble member " + member.name + " failed at " + step + " (" + str(e) + "), the other members continue", level = "error")
+			return False
+
+	def run(self):
+		self.logger.write(" - Running an ensemble of " + str(len(self.members)) + " members from " + self.aSet.fetch("ensemble_file"))
+		for i, member in enumerate(self.members):
+			self.logger.write(" - Preparing ensemble member " + member.name + " (" + str(i + 1) + " of " + str(len(self.members)) + ") in " + member.aSet.fetch("rundir"))
+			with Metrics.span("member " + member.name + " prepare"):
+				for step, function in [("setup", member.run.setup), ("download", member.run.download), ("job files", member.run.write_files),
+									   ("pre-processing", member.run.preprocess), ("wrf namelist", member.run.prepare_wrf)]:
+					if not self.guarded(member, step, function):
+						break
+		if(self.aSet.fetch("run_wrf") == '1'):
+			self.run_wrf()
+		else:
+			self.logger.write("  4.c. run_wrf is turned off, skiping wrf.exe process")
+		self.logger.write(" 4. Done")
+		for member in self.active():
+			self.logger.write(" - Post-processing ensemble member " + member.name)
+			if self.guarded(member, "post-processing", member.run.post):
+				member.run.cleanup(cleanModelData = False)
+		failed = [m for m in self.members if m.error != None]
+		if not failed:
+			# The members share the model data, it is removed once every member is done
+			Cleanup.PostRunCleanup(self.aSet).performClean(cleanAll = False, cleanOutFiles = False, cleanErrorFiles = False, cleanInFiles = False,
+														   cleanBdyFiles = False, cleanWRFOut = False, cleanModelData = True)
+		for member in self.members:
+			self.logger.write(" - Ensemble member " + member.name + ": " + ("Complete" if member.error is None else "Failed at " + member.error))
+		self.logger.write("Ensemble complete, " + str(len(self.members) - len(failed)) + " of " + str(len(self.members)) + " members succeeded.")
+		return len(failed) == 0
+
+	# run_wrf: Submit the wrf.job of every member, then hold until each one has completed or failed
+	def run_wrf(self):
+		pending = []
+		for member in self.active():
+			if member.run.state.valid("wrf"):
+				self.logger.write("  4.c. " + member.name + ": wrf.exe was completed by an earlier run, skiping wrf.exe process")
+				continue
+			member.jobSub = member.run.jobs.submit_wrf()
+			if(member.jobSub == None):
+				member.run.state.failed("wrf")
+				member.error = "wrf.exe: Missing or invalid wrfinput_d01 or wrfbdy_d01"
+				self.logger.write("  4.c. " + member.name + ": Cannot run wrf.exe without valid wrfinput_d01 and wrfbdy_d01", level = "error")
+				continue
+			self.logger.write("  4.c. " + member.name + ": wrf.job submitted" + (" (" + member.jobSub.jobID + ")" if member.jobSub.jobID != None else ""))
+			if(self.aSet.fetch("debugmode") == '1'):
+				continue
+			incremental = member.run.incremental
+			member.wait = Wait.Wait(member.run.jobs.wrf_holds(member.jobSub), onPoll = incremental.poll if incremental != None else None)
+			pending.append(member)
+		if not pending:
+			return
+		self.logger.write("  4.c. Following " + str(len(pending)) + " wrf.exe jobs")
+		jobIDs = [m.jobSub.jobID for m in pending if m.jobSub.jobID != None]
+		with Metrics.span("wait wrf ensemble", jobIDs):
+			self.hold(pending)
+
+	# hold: Poll the wrf.exe holds of every pending member until each one returns (See Wait.check()), the JobTracker refreshes the state
+	#  of every job in one scheduler query
+	def hold(self, pending):
+		watchers = dict((member.name, member.wait.watcher()) for member in pending)
+		try:
+			while pending:
+				for member in list(pending):
+					rc = member.wait.check(watchers[member.name])
+					if rc is None:
+						continue
+					pending.remove(member)
+					if rc == 1:
+						member.run.jobs.collect_wrf_logs()
+						member.run.wrf_complete()
+						member.run.record_wrf(JobTracker.JobTracker.instance().fetch(member.jobSub.jobID) if member.jobSub.jobID != None else None)
+						self.logger.write("  4.c. " + member.name + ": wrf.exe complete, " + str(len(pending)) + " members still running")
+					else:
+						member.run.state.failed("wrf")
+						member.error = "wrf.exe: " + ("Error in the rsl logs" if rc == 2 else Jobs.job_exit_text(member.jobSub))
+						self.logger.write("  4.c. " + member.name + ": wrf.exe failed (" + member.error + ")", level = "error")
+				if pending:
+					time.sleep(self.pollInterval)
+		finally:
+			for watcher in watchers.values():
+				if watcher:
+					watcher.close()
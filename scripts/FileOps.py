@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# FileOps.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes used to perform file system operations in-process instead of forking cp/mv/rm/mkdir/ln/chmod shells
+
+import os
+import shutil
+import fnmatch
+import glob
+from multiprocessing.pool import ThreadPool
+import Tools
+
+# OpResult: Mini class instance storing the outcome of a single file operation
+class OpResult:
+	op = ""
+	path = ""
+	target = None
+	ok = True
+	error = None
+
+	def __init__(self, op, path, target = None, ok = True, error = None):
+		self.op = op
+		self.path = path
+		self.target = target
+		self.ok = ok
+		self.error = error
+
+# FileOpsResult: The collection of OpResults returned by a FileOps call
+class FileOpsResult:
+	results = []
+
+	def __init__(self, results = None):
+		self.results = results if results != None else []
+
+	def ok(self):
+		return len(self.errors()) == 0
+
+	def errors(self):
+		return [r for r in self.results if not r.ok]
+
+	def paths(self):
+		return [r.path for r in self.results if r.ok]
+
+# FileOps: Class responsible for batched file system operations.
+#  Glob patterns are grouped by directory so each directory is listed once per call, no matter how many patterns point into it.
+#  Deletes, copies and links are run on a thread pool (fileops_threads in control.txt). With debugmode on, nothing is touched and the
+#  equivalent shell command is printed, as Tools.popen does.
+class FileOps:
+	aSet = None
+	threads = 8
+	debug = False
+	logger = None
+
+	def __init__(self, settings):
+		self.aSet = settings
+		self.logger = Tools.loggedPrint.instance()
+		self.debug = (settings.fetch("debugmode") == '1')
+		if(settings.fetch("fileops_threads") != None):
+			self.threads = int(settings.fetch("fileops_threads"))
+
+	# expand: Resolve a list of patterns to absolute paths, listing each parent directory only once
+	def expand(self, patterns):
+		byDir = {}
+		for pattern in patterns:
+			full = os.path.abspath(os.path.expanduser(pattern))
+			directory, name = os.path.split(full)
+			if glob.has_magic(directory):
+				# Rare, patterns with wildcards in the directory part fall back to glob
+				byDir.setdefault(None, []).append(full)
+			else:
+				byDir.setdefault(directory, []).append(name)
+		paths = []
+		for directory, names in byDir.items():
+			if directory == None:
+				for full in names:
+					paths.extend(sorted(glob.glob(full)))
+				continue
+			try:
+				entries = os.listdir(directory)
+			except OSError:
+				continue
+			for name in names:
+				if glob.has_magic(name):
+					# Match the shell, hidden files are only matched by patterns that start with a dot
+					matched = [e for e in fnmatch.filter(entries, name) if not e.startswith('.') or name.startswith('.')]
+					paths.extend(directory + '/' + e for e in sorted(matched))
+				elif name in entries:
+					paths.append(directory + '/' + name)
+		seen = set()
+		return [p for p in paths if not (p in seen or seen.add(p))]
+
+	def run(self, func, items):
+		if not items:
+			return []
+		if(len(items) == 1 or self.threads <= 1):
+			return [func(item) for item in items]
+		t = ThreadPool(processes=min(self.threads, len(items)))
+		try:
+			return t.map(func, items)
+		finally:
+			t.close()
+			t.join()
+
+	def report(self, op, result):
+		for r in result.errors():
+			self.logger.write("FileOps(" + op + "): " + r.path + (" -> " + r.target if r.target else "") + ": " + str(r.error))
+		return result
+
+	# remove: rm / rm -r
+	def remove(self, patterns, recursive = False):
+		if self.debug:
+			for pattern in patterns:
+				print("D: rm " + ("-r " if recursive else "") + pattern)
+			return FileOpsResult()
+		def apply(path):
+			try:
+				if(os.path.isdir(path) and not os.path.islink(path)):
+					if not recursive:
+						return OpResult("rm", path, ok = False, error = "is a directory")
+					shutil.rmtree(path)
+				else:
+					os.remove(path)
+				return OpResult("rm", path)
+			except OSError as e:
+				return OpResult("rm", path, ok = False, error = e)
+		return self.report("rm", FileOpsResult(self.run(apply, self.expand(patterns))))
+
+	# copy: cp <patterns> <destDir>, directories are skipped as cp does without -r
+	def copy(self, patterns, dest):
+		if self.debug:
+			for pattern in patterns:
+				print("D: cp " + pattern + " " + dest)
+			return FileOpsResult()
+		toDir = os.path.isdir(dest)
+		def apply(path):
+			target = dest + '/' + os.path.basename(path) if toDir else dest
+			try:
+				if os.path.isdir(path):
+					return OpResult("cp", path, target, ok = False, error = "omitting directory")
+				shutil.copy(path, target)
+				return OpResult("cp", path, target)
+			except (IOError, OSError) as e:
+				return OpResult("cp", path, target, ok = False, error = e)
+		return self.report("cp", FileOpsResult(self.run(apply, self.expand(patterns))))
+
+	# move: mv <patterns> <dest>
+	def move(self, patterns, dest):
+		if self.debug:
+			for pattern in patterns:
+				print("D: mv " + pattern + " " + dest)
+			return FileOpsResult()
+		toDir = os.path.isdir(dest)
+		results = []
+		for path in self.expand(patterns):
+			target = dest + '/' + os.path.basename(path) if toDir else dest
+			try:
+				shutil.move(path, target)
+				results.append(OpResult("mv", path, target))
+			except (IOError, OSError) as e:
+				results.append(OpResult("mv", path, target, ok = False, error = e))
+		return self.report("mv", FileOpsResult(results))
+
+	# link: ln -fs <patterns> <destDir>, or ln -f when symbolic is False
+	def link(self, patterns, dest, symbolic = True):
+		if self.debug:
+			for pattern in patterns:
+				print("D: ln -f" + ("s " if symbolic else " ") + pattern + " " + dest)
+			return FileOpsResult()
+		toDir = os.path.isdir(dest)
+		def apply(path):
+			target = dest + '/' + os.path.basename(path) if toDir else dest
+			try:
+				if os.path.lexists(target):
+					os.remove(target)
+				if symbolic:
+					os.symlink(path, target)
+				else:
+					os.link(path, target)
+				return OpResult("ln", path, target)
+			except OSError as e:
+				return OpResult("ln", path, target, ok = False, error = e)
+		return self.report("ln", FileOpsResult(self.run(apply, self.expand(patterns))))
+
+	# mkdir: Creates each directory, an existing directory is not an error
+	def mkdir(self, paths):
+		if self.debug:
+			for path in paths:
+				print("D: mkdir " + path)
+			return FileOpsResult()
+		results = []
+		for path in paths:
+			try:
+				if not os.path.isdir(path):
+					os.makedirs(path)
+				results.append(OpResult("mkdir", path))
+			except OSError as e:
+				results.append(OpResult("mkdir", path, ok = False, error = e))
+		return self.report("mkdir", FileOpsResult(results))
+
+	# chmod_x: chmod +x, adds the execute bit wherever the read bit is set
+	def chmod_x(self, patterns):
+		if self.debug:
+			for pattern in patterns:
+				print("D: chmod +x " + pattern)
+			return FileOpsResult()
+		results = []
+		for path in self.expand(patterns):
+			try:
+				mode = os.stat(path).st_mode
+				os.chmod(path, mode | ((mode & 0o444) >> 2))
+				results.append(OpResult("chmod", path))
+			except OSError as e:
+				results.append(OpResult("chmod", path, ok = False, error = e))
+		return self.report("chmod", FileOpsResult(results))
@@ -0,0 +1,344 @@
+#!/usr/bin/python
+# GribIndex.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes and methods used to index GRIB2 files from their section headers and write GrADS control files for them
+
+import os
+import json
+import math
+import datetime
+from multiprocessing import Pool
+import Tools
+
+# Short names of the fields written by UPP, keyed by (discipline, category, number). Unknown fields are named VAR<d>_<c>_<n>
+PARAMETERS = {
+	(0, 0, 0): "TMP", (0, 0, 2): "POT", (0, 0, 4): "TMAX", (0, 0, 5): "TMIN", (0, 0, 6): "DPT",
+	(0, 1, 0): "SPFH", (0, 1, 1): "RH", (0, 1, 3): "PWAT", (0, 1, 7): "PRATE", (0, 1, 8): "APCP", (0, 1, 9): "NCPCP", (0, 1, 10): "ACPCP",
+	(0, 1, 11): "SNOD", (0, 1, 13): "WEASD", (0, 1, 22): "CLWMR", (0, 1, 23): "ICMR", (0, 1, 24): "RWMR", (0, 1, 25): "SNMR", (0, 1, 32): "GRLE",
+	(0, 2, 2): "UGRD", (0, 2, 3): "VGRD", (0, 2, 8): "VVEL", (0, 2, 9): "DZDT", (0, 2, 10): "ABSV", (0, 2, 22): "GUST",
+	(0, 3, 0): "PRES", (0, 3, 1): "PRMSL", (0, 3, 5): "HGT", (0, 3, 18): "HPBL", (0, 3, 192): "MSLET",
+	(0, 4, 192): "DSWRF", (0, 5, 192): "DLWRF", (0, 6, 1): "TCDC", (0, 6, 3): "LCDC", (0, 6, 4): "MCDC", (0, 6, 5): "HCDC",
+	(0, 7, 6): "CAPE", (0, 7, 7): "CIN", (0, 7, 8): "HLCY", (0, 16, 195): "REFD", (0, 16, 196): "REFC", (0, 19, 0): "VIS",
+	(2, 0, 0): "LAND", (2, 0, 192): "SOILW", (2, 3, 18): "TSOIL", (10, 2, 0): "ICEC",
+}
+
+# GrADS name suffixes for the fixed surface types, surfaces with a value (IE: 2 m above ground) add the value to the suffix
+SURFACES = {1: "sfc", 2: "cld", 3: "clt", 4: "0deg", 7: "trp", 8: "toa", 100: "prs", 101: "msl", 102: "asl", 103: "m", 104: "sig",
+			106: "bgl", 108: "spc", 200: "clm", 204: "htfl", 215: "cei", 220: "pbl"}
+
+# GrADS time strings, IE: 00Z26may2019
+MONTHS = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+
+EARTH_RADIUS = 6371229.0
+
+def grads_time(t):
+	return t.strftime("%HZ%d") + MONTHS[t.month - 1] + t.strftime("%Y")
+
+# signed: GRIB2 stores negative integers as sign and magnitude, not two's complement
+def signed(data):
+	value = int.from_bytes(data, "big")
+	top = 1 << (8 * len(data) - 1)
+	return -(value & (top - 1)) if value & top else value
+
+def unsigned(data):
+	return int.from_bytes(data, "big")
+
+def surface_value(scale, value):
+	if(scale == -127 or value == -(2 ** 31 - 1)):
+		return None
+	return value / (10.0 ** scale)
+
+# parse_grid: The grid of a section 3, only regular lat/lon (3.0) and Lambert conformal (3.30) grids are described, others return the template number only
+def parse_grid(sec):
+	template = unsigned(sec[12:14])
+	grid = {"template": template}
+	if(template == 0):
+		grid.update({"nx": unsigned(sec[30:34]), "ny": unsigned(sec[34:38]),
+					 "la1": signed(sec[46:50]) / 1e6, "lo1": unsigned(sec[50:54]) / 1e6,
+					 "la2": signed(sec[55:59]) / 1e6, "lo2": unsigned(sec[59:63]) / 1e6,
+					 "dx": unsigned(sec[63:67]) / 1e6, "dy": unsigned(sec[67:71]) / 1e6, "scan": sec[71]})
+	elif(template == 30):
+		grid.update({"nx": unsigned(sec[30:34]), "ny": unsigned(sec[34:38]),
+					 "la1": signed(sec[38:42]) / 1e6, "lo1": unsigned(sec[42:46]) / 1e6,
+					 "lad": signed(sec[47:51]) / 1e6, "lov": unsigned(sec[51:55]) / 1e6,
+					 "dx": unsigned(sec[55:59]) / 1e3, "dy": unsigned(sec[59:63]) / 1e3, "scan": sec[64],
+					 "latin1": signed(sec[65:69]) / 1e6, "latin2": signed(sec[69:73]) / 1e6})
+	return grid
+
+# parse_product: The field described by a section 4, templates 4.0 to 4.15 share the layout of the first 34 octets
+def parse_product(sec, discipline):
+	template = unsigned(sec[7:9])
+	field = {"discipline": discipline, "category": sec[9], "number": sec[10], "template": template}
+	unit = sec[17]
+	hours = {0: 1.0 / 60, 1: 1.0, 2: 24.0, 10: 3.0, 11: 6.0, 12: 12.0, 13: 1.0 / 3600}.get(unit, 1.0)
+	field["forecast"] = signed(sec[18:22]) * hours
+	field["level_type"] = sec[22]
+	field["level"] = surface_value(signed(sec[23:24]), signed(sec[24:28]))
+	field["level_type2"] = sec[28]
+	field["level2"] = surface_value(signed(sec[29:30]), signed(sec[30:34])) if sec[28] != 255 else None
+	if(template == 8 and len(sec) > 46):
+		field["stat"] = sec[46]
+	return field
+
+# scan_file: Walk the messages of a GRIB2 file reading only the section headers (The packed data is skipped), returns the index dictionary
+def scan_file(path):
+	messages = []
+	grid = None
+	with open(path, "rb") as f:
+		offset = 0
+		while True:
+			f.seek(offset)
+			head = f.read(16)
+			if(len(head) < 16):
+				break
+			if(head[0:4] != b"GRIB"):
+				# Skip padding between messages
+				pos = head.find(b"G", 1)
+				offset += pos if pos > 0 else 16
+				continue
+			if(head[7] != 2):
+				raise ValueError(path + " is not a GRIB2 file (edition " + str(head[7]) + ")")
+			discipline = head[6]
+			length = unsigned(head[8:16])
+			refTime = None
+			position = offset + 16
+			while position < offset + length:
+				f.seek(position)
+				marker = f.read(5)
+				if(marker[0:4] == b"7777" or len(marker) < 5):
+					break
+				secLength = unsigned(marker[0:4])
+				number = marker[4]
+				if number in (1, 3, 4):
+					f.seek(position)
+					sec = f.read(secLength)
+					if(number == 1):
+						refTime = datetime.datetime(unsigned(sec[12:14]), sec[14], sec[15], sec[16], sec[17], sec[18])
+					elif(number == 3 and grid is None):
+						grid = parse_grid(sec)
+					elif(number == 4):
+						field = parse_product(sec, discipline)
+						field["offset"] = offset
+						field["length"] = length
+						field["reftime"] = refTime.strftime("%Y%m%d%H%M%S")
+						messages.append(field)
+				position += secLength
+			offset += length
+	return {"grid": grid, "messages": messages}
+
+# build_index: Returns the message index of a GRIB2 file, cached in <file>.inv.json and reused while the file's size and mtime are unchanged
+def build_index(path):
+	st = os.stat(path)
+	cacheFile = path + ".inv.json"
+	try:
+		with open(cacheFile) as f:
+			cached = json.load(f)
+		if(cached["size"] == st.st_size and cached["mtime"] == st.st_mtime):
+			return cached
+	except (IOError, OSError, ValueError, KeyError):
+		pass
+	index = scan_file(path)
+	index["size"] = st.st_size
+	index["mtime"] = st.st_mtime
+	with open(cacheFile + ".tmp", 'w') as f:
+		json.dump(index, f)
+	os.rename(cacheFile + ".tmp", cacheFile)
+	return index
+
+def field_name(field):
+	base = PARAMETERS.get((field["discipline"], field["category"], field["number"]), "VAR" + str(field["discipline"]) + "_" + str(field["category"]) + "_" + str(field["number"]))
+	suffix = SURFACES.get(field["level_type"], "l" + str(field["level_type"]))
+	if(field["level_type"] != 100 and field["level"] != None and field["level_type"] in (103, 104, 106, 108)):
+		level = ('%g' % field["level"]).replace('.', 'p').replace('-', 'm')
+		if(field["level2"] != None):
+			level += "_" + ('%g' % field["level2"]).replace('.', 'p').replace('-', 'm')
+		suffix = level + suffix
+	return base + suffix
+
+def level_text(value):
+	return '%g' % value
+
+# variables: Group the messages of one time into GrADS variables, isobaric fields become one multi-level variable (Levels in hPa).
+#  Returns (vars lines, zdef levels)
+def variables(messages):
+	levels = sorted(set(m["level"] / 100.0 for m in messages if m["level_type"] == 100 and m["level"] != None), reverse = True)
+	entries = []
+	seen = {}
+	for m in messages:
+		param = str(m["discipline"]) + "," + str(m["category"]) + "," + str(m["number"]) + ("," + str(m["stat"]) if "stat" in m else "")
+		name = field_name(m)
+		if(m["level_type"] == 100):
+			key = (name, param)
+			if key in seen:
+				seen[key][1] += 1
+				continue
+			seen[key] = [name, 1, "100", param]
+			entries.append(seen[key])
+			continue
+		surface = "0," + str(m["level_type"])
+		if(m["level"] != None and m["level_type"] != 1):
+			surface += "," + level_text(m["level"])
+			if(m["level2"] != None):
+				surface += "," + level_text(m["level2"])
+		key = (name, param, surface)
+		if key in seen:
+			continue
+		seen[key] = [name, 0, surface, param]
+		entries.append(seen[key])
+	lines = []
+	used = {}
+	for name, count, surface, param in entries:
+		# GrADS names are unique and at most 15 characters
+		short = name[0:15]
+		if short in used:
+			used[short] += 1
+			short = short[0:13] + str(used[short])
+		else:
+			used[short] = 0
+		if(surface == "100"):
+			lines.append(short + " " + str(count) + ",100 " + param + " ** isobaric " + name)
+		else:
+			lines.append(short + " " + surface + " " + param + " ** " + name)
+	return lines, levels
+
+# lambert_latlon: Latitude and longitude of the Lambert conformal grid point (i, j), 0-based from the first grid point (Scanning west to east, south to north)
+def lambert_latlon(grid, i, j):
+	phi1 = math.radians(grid["latin1"])
+	phi2 = math.radians(grid["latin2"])
+	if(abs(phi1 - phi2) < 1e-9):
+		n = math.sin(phi1)
+	else:
+		n = math.log(math.cos(phi1) / math.cos(phi2)) / math.log(math.tan(math.pi / 4 + phi2 / 2) / math.tan(math.pi / 4 + phi1 / 2))
+	F = math.cos(phi1) * math.tan(math.pi / 4 + phi1 / 2) ** n / n
+	lov = math.radians(grid["lov"])
+	def forward(lat, lon):
+		rho = EARTH_RADIUS * F / math.tan(math.pi / 4 + math.radians(lat) / 2) ** n
+		theta = n * (math.radians(lon) - lov)
+		return rho * math.sin(theta), -rho * math.cos(theta)
+	x0, y0 = forward(grid["la1"], grid["lo1"])
+	x = x0 + i * grid["dx"]
+	y = y0 + j * grid["dy"]
+	rho = math.copysign(math.hypot(x, y), n)
+	theta = math.atan2(x * math.copysign(1, n), -y * math.copysign(1, n))
+	lat = 2 * math.atan((EARTH_RADIUS * F / rho) ** (1.0 / n)) - math.pi / 2
+	lon = math.degrees(lov + theta / n)
+	return math.degrees(lat), (lon + 180.0) % 360.0 - 180.0
+
+def grid_lines(grid):
+	if(grid is None):
+		return ["* Unsupported grid, no pdef/xdef/ydef written"]
+	if(grid["template"] == 0):
+		lo1 = (grid["lo1"] + 180.0) % 360.0 - 180.0
+		dy = grid["dy"] if grid["la2"] >= grid["la1"] else -grid["dy"]
+		la1 = min(grid["la1"], grid["la2"])
+		return ["xdef " + str(grid["nx"]) + " linear " + '%g' % lo1 + " " + '%g' % grid["dx"],
+				"ydef " + str(grid["ny"]) + " linear " + '%g' % la1 + " " + '%g' % abs(dy)]
+	if(grid["template"] == 30):
+		# Lat/lon box around the domain, sampled along its edges, at about the grid spacing
+		nx = grid["nx"]
+		ny = grid["ny"]
+		points = []
+		for i in range(0, nx, max(1, nx // 50)):
+			points += [lambert_latlon(grid, i, 0), lambert_latlon(grid, i, ny - 1)]
+		for j in range(0, ny, max(1, ny // 50)):
+			points += [lambert_latlon(grid, 0, j), lambert_latlon(grid, nx - 1, j)]
+		points.append(lambert_latlon(grid, nx - 1, ny - 1))
+		lats = [p[0] for p in points]
+		lons = [p[1] for p in points]
+		res = grid["dx"] / (EARTH_RADIUS * math.pi / 180.0)
+		lo1 = (grid["lo1"] + 180.0) % 360.0 - 180.0
+		lov = (grid["lov"] + 180.0) % 360.0 - 180.0
+		return ["pdef " + str(nx) + " " + str(ny) + " lcc " + '%g' % grid["la1"] + " " + '%g' % lo1 + " 1 1 " + '%g' % grid["latin1"] + " " + '%g' % grid["latin2"] + " " +
+				'%g' % lov + " " + '%g' % grid["dx"] + " " + '%g' % grid["dy"],
+				"xdef " + str(int(math.ceil((max(lons) - min(lons)) / res)) + 1) + " linear " + '%.4f' % min(lons) + " " + '%.6f' % res,
+				"ydef " + str(int(math.ceil((max(lats) - min(lats)) / res)) + 1) + " linear " + '%.4f' % min(lats) + " " + '%.6f' % res]
+	return ["* Unsupported grid template 3." + str(grid["template"]) + ", no pdef/xdef/ydef written"]
+
+def valid_time(message):
+	return datetime.datetime.strptime(message["reftime"], "%Y%m%d%H%M%S") + datetime.timedelta(hours=message["forecast"])
+
+# control_file: The text of a GrADS control file for one GRIB2 file (dset is the file's name relative to the control file)
+def control_file(path, index, template = None, times = None, step = None):
+	messages = index["messages"]
+	lines, levels = variables(messages)
+	dset = os.path.basename(path) if template is None else template
+	out = "dset ^" + dset + "\n"
+	out += "index ^" + (os.path.basename(path) if template is None else "wrfprs") + ".idx\n"
+	out += "undef 9.999E+20\n"
+	out += "title " + dset + "\n"
+	out += "* produced by GribIndex.py\n"
+	out += "dtype grib2\n"
+	if template != None:
+		out += "options template\n"
+	out += "\n".join(grid_lines(index["grid"])) + "\n"
+	first = valid_time(messages[0]) if messages else datetime.datetime(1900, 1, 1)
+	out += "tdef " + str(times if times != None else 1) + " linear " + grads_time(first) + " " + str(step if step != None else 1) + "hr\n"
+	if levels:
+		out += "zdef " + str(len(levels)) + " levels " + " ".join(level_text(l) for l in levels) + "\n"
+	else:
+		out += "zdef 1 linear 1 1\n"
+	out += "vars " + str(len(lines)) + "\n"
+	out += "\n".join(lines) + "\n"
+	out += "endvars\n"
+	return out
+
+# index_and_write: Worker for the process pool, indexes one file and writes its control file. Returns (path, message count, error)
+def index_and_write(job):
+	path, ctlFile = job
+	try:
+		index = build_index(path)
+		if not index["messages"]:
+			return (path, 0, "no GRIB2 messages found")
+		with open(ctlFile, 'w') as f:
+			f.write(control_file(path, index))
+		return (path, len(index["messages"]), None)
+	except (IOError, OSError, ValueError, IndexError) as e:
+		return (path, 0, str(e))
+
+# GribIndex: Writes the GrADS control files of a set of GRIB2 files on a process pool (ctl_processes in control.txt, Default: CPU count),
+#  plus one template control file covering every forecast hour
+class GribIndex:
+	processes = 1
+	logger = None
+
+	def __init__(self, settings):
+		self.logger = Tools.loggedPrint.instance()
+		self.processes = os.cpu_count() or 1
+		if(settings.fetch("ctl_processes") != None):
+			self.processes = int(settings.fetch("ctl_processes"))
+
+	# write_controls: jobs is a list of (GRIB2 path, control file path), returns the list of files that failed
+	def write_controls(self, jobs):
+		if not jobs:
+			return []
+		if(self.processes <= 1 or len(jobs) == 1):
+			results = [index_and_write(job) for job in jobs]
+		else:
+			pool = Pool(processes=min(self.processes, len(jobs)))
+			try:
+				results = pool.map(index_and_write, jobs)
+			finally:
+				pool.close()
+				pool.join()
+		failed = []
+		for path, count, error in results:
+			if error != None:
+				self.logger.write("  -> GribIndex: " + path + ": " + error)
+				failed.append(path)
+		return failed
+
+	# write_template: One control file for every file matching template (A GrADS template, IE: WRFPRS.GrbF%f2), built from the cached
+	#  indexes of paths (In time order). The time step is taken from the first two files
+	def write_template(self, paths, template, ctlFile):
+		if not paths:
+			return False
+		indexes = [build_index(path) for path in paths]
+		if not indexes[0]["messages"]:
+			return False
+		step = 1
+		if(len(indexes) > 1 and indexes[1]["messages"]):
+			step = max(1, int(round((valid_time(indexes[1]["messages"][0]) - valid_time(indexes[0]["messages"][0])).total_seconds() / 3600.0)))
+		with open(ctlFile, 'w') as f:
+			f.write(control_file(paths[0], indexes[0], template = template, times = len(paths), step = step))
+		return True
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# IncrementalPost.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes used to post-process each wrfout frame while wrf.exe is still running
+
+import os
+import glob
+import time
+import subprocess
+import Tools
+import FileOps
+import JobTracker
+import PreparePyJob
+
+# netcdf_has_records: Checks the header of a NetCDF file, classic and 64-bit offset files (CDF1/2) and CDF5 files must report at least one
+#  record, NetCDF-4 (HDF5) files only need a valid signature as their record count is not in a fixed location
+def netcdf_has_records(path):
+	try:
+		with open(path, "rb") as f:
+			head = f.read(12)
+	except (IOError, OSError):
+		return False
+	if head[0:8] == b"\x89HDF\r\n\x1a\n":
+		return True
+	if head[0:4] in (b"CDF\x01", b"CDF\x02"):
+		numrecs = int.from_bytes(head[4:8], "big")
+	elif head[0:4] == b"CDF\x05":
+		numrecs = int.from_bytes(head[4:12], "big")
+	else:
+		return False
+	# 0xFFFFFFFF marks a file still being streamed, its records are not final yet
+	return numrecs > 0 and numrecs != 0xFFFFFFFF
+
+# FrameWatcher: Decides when the wrfout files in a directory are complete. With frames_per_outfile = 1 a file is done once wrf.exe has
+#  opened the next one. The newest file is also accepted once its size has not changed for settleTime seconds and its header reports a
+#  record, so the last frames do not have to wait for the model to finish. final = True accepts every file (wrf.exe has completed).
+class FrameWatcher:
+	pattern = ""
+	settleTime = 60
+	completed = []
+	sizes = {}
+
+	def __init__(self, outDir, settleTime = 60, pattern = "wrfout_d01_*"):
+		self.pattern = outDir + '/' + pattern
+		self.settleTime = settleTime
+		self.completed = []
+		self.sizes = {}
+
+	# poll: Returns the files that became complete since the last call, in time order
+	def poll(self, final = False):
+		files = sorted(glob.glob(self.pattern))
+		now = time.time()
+		done = []
+		for i, path in enumerate(files):
+			if path in self.completed:
+				continue
+			if final or i + 1 < len(files):
+				done.append(path)
+				continue
+			try:
+				size = os.path.getsize(path)
+			except OSError:
+				continue
+			last = self.sizes.get(path)
+			if last is None or last[0] != size:
+				self.sizes[path] = (size, now)
+			elif now - last[1] >= self.settleTime and netcdf_has_records(path):
+				done.append(path)
+		self.completed += done
+		return done
+
+# Frame: Mini class instance tracking the post-processing of one wrfout file
+class Frame:
+	wrfout = ""
+	workDir = ""
+	state = "pending"
+	jobID = None
+	process = None
+
+	def __init__(self, wrfout, workDir):
+		self.wrfout = wrfout
+		self.workDir = workDir
+		self.state = "pending"
+		self.jobID = None
+		self.process = None
+
+# IncrementalPost: Post-processes each wrfout frame as soon as FrameWatcher reports it complete. Every frame runs in its own
+#  postprd/frame_<date> directory (unipost.exe and the python scripts write fixed file names), UPP frames are submitted as their own
+#  jobs and python frames are run as local processes, with at most incremental_post_jobs frames running at once. Products are moved up to
+#  postprd. poll() is called from the wrf.exe wait loop and finish() runs the remaining frames once wrf.exe has completed.
+#  Progress is appended to postprd/incremental_post.txt.
+class IncrementalPost:
+	aSet = None
+	post = None
+	logger = None
+	fileOps = None
+	watcher = None
+	postDir = ""
+	maxRunning = 2
+	frames = []
+
+	def __init__(self, settings, postSteps):
+		self.aSet = settings
+		self.post = postSteps
+		self.logger = Tools.loggedPrint.instance()
+		self.fileOps = FileOps.FileOps(settings)
+		self.postDir = settings.fetch("rundir") + "/postprd"
+		settle = settings.fetch("incremental_post_settle")
+		self.watcher = FrameWatcher(settings.fetch("rundir") + "/output", int(settle) if settle != None else 60)
+		if(settings.fetch("incremental_post_jobs") != None):
+			self.maxRunning = int(settings.fetch("incremental_post_jobs"))
+		self.frames = []
+
+	def progress(self, text):
+		with open(self.postDir + "/incremental_post.txt", 'a') as f:
+			f.write(text + '\n')
+
+	# poll: Queue newly completed wrfout files, check running frames and start queued ones. final = True treats every file as complete
+	def poll(self, final = False):
+		for path in self.watcher.poll(final):
+			stamp = os.path.basename(path)[11:]
+			self.frames.append(Frame(path, self.postDir + "/frame_" + stamp))
+			self.logger.write("  -> Incremental post: " + os.path.basename(path) + " is complete, queued for post-processing")
+		self.check()
+		running = len([f for f in self.frames if f.state == "running"])
+		for frame in self.frames:
+			if(running >= self.maxRunning):
+				break
+			if(frame.state == "pending"):
+				self.start(frame)
+				running += 1
+
+	def start(self, frame):
+		self.fileOps.mkdir([frame.workDir])
+		if(self.aSet.fetch("post_run_unipost") == '1'):
+			jobFile = frame.workDir + "/upp_frame.job"
+			with open(jobFile, 'w') as target_file:
+				target_file.write(self.upp_job(frame))
+			with Tools.cd(frame.workDir):
+				jobSub = Tools.popen(self.aSet, "qsub upp_frame.job")
+			frame.jobID = jobSub.jobID
+		else:
+			self.fileOps.link([frame.wrfout], frame.workDir)
+			jobFile = frame.workDir + "/python_post.job"
+			with open(jobFile, 'w') as target_file:
+				target_file.write(PreparePyJob.PreparePyJob(self.aSet, frame.workDir, self.postDir).job_contents(frame.workDir))
+			self.fileOps.chmod_x([jobFile])
+			if(self.aSet.fetch("debugmode") == '1'):
+				print("D: " + jobFile)
+			else:
+				outFile = open(frame.workDir + "/python_post.out", 'w')
+				frame.process = subprocess.Popen([jobFile], cwd=frame.workDir, stdout=outFile, stderr=subprocess.STDOUT)
+				outFile.close()
+		frame.state = "running"
+		self.progress("started " + os.path.basename(frame.wrfout) + ("" if frame.jobID == None else " " + frame.jobID))
+
+	# upp_job: The job file running unipost.exe on a single frame in its own directory
+	def upp_job(self, frame):
+		nodes = str(self.post.upp_slots()[1])
+		out = "#!/bin/bash\n"
+		out += "#PBS -l nodes=" + nodes + ":ppn=" + self.aSet.fetch("num_upp_processors") + "\n"
+		stamp = os.path.basename(frame.wrfout)[11:]
+		out += "#PBS -N UPP_" + stamp[5:7] + stamp[8:10] + stamp[11:13] + "\n"
+		out += "#PBS -l walltime=" + self.aSet.fetch("upp_walltime") + "\n"
+		out += "#PBS -A climlab" + "\n\n"
+		out += "source " + self.aSet.fetch("sourcefile") + "\n"
+		out += "ulimit -s unlimited\n\n"
+		out += self.post.upp_task(frame.wrfout, frame.workDir, int(nodes) * int(self.aSet.fetch("num_upp_processors")), frame.workDir + "/upp_progress.txt")
+		return out
+
+	def check(self):
+		tracker = JobTracker.JobTracker.instance()
+		if any(f.jobID != None and f.state == "running" for f in self.frames):
+			tracker.refresh()
+		for frame in self.frames:
+			if(frame.state != "running"):
+				continue
+			if(frame.jobID != None):
+				if(tracker.state(frame.jobID) != JobTracker.EXITED):
+					continue
+				ok = self.log_contains(frame.workDir + "/upp_progress.txt", " done")
+			elif(frame.process != None):
+				if(frame.process.poll() is None):
+					continue
+				ok = self.log_contains(frame.workDir + "/pypost.log", "***SUCCESS***")
+			else:
+				# debugmode, nothing was run
+				ok = True
+			frame.state = "done" if ok else "failed"
+			self.progress(frame.state + " " + os.path.basename(frame.wrfout))
+			self.logger.write("  -> Incremental post: " + os.path.basename(frame.wrfout) + " " + frame.state)
+
+	def log_contains(self, path, text):
+		try:
+			with open(path, 'r', errors = "replace") as f:
+				return text in f.read()
+		except (IOError, OSError):
+			return False
+
+	# finish: Called once wrf.exe has completed, post-processes the remaining frames and holds until every frame is done.
+	#  Returns the number of frames, or -1 if any frame failed
+	def finish(self, timeDelay = 30):
+		self.poll(final = True)
+		while any(f.state in ("pending", "running") for f in self.frames):
+			time.sleep(timeDelay)
+			self.poll(final = True)
+		failed = [f for f in self.frames if f.state == "failed"]
+		for frame in failed:
+			self.logger.write("  -> Incremental post: Error: Post-processing failed for " + os.path.basename(frame.wrfout) + ", see " + frame.workDir)
+		return -1 if failed else len(self.frames)
@@ -0,0 +1,264 @@
+#!/usr/bin/python
+# JobTracker.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes used to track the scheduler state of submitted jobs through batched queries
+
+import os
+import datetime
+import threading
+import subprocess
+import Tools
+
+# Job states reported to waiting steps
+QUEUED = "queued"
+RUNNING = "running"
+EXITED = "exited"
+UNKNOWN = "unknown"
+
+# jobKey: Schedulers are inconsistent about the server suffix on job IDs (12345 vs. 12345.server), so match on the numeric portion
+def jobKey(jobID):
+	return str(jobID).strip().split('.')[0]
+
+# Job: Mini class instance that stores the last known scheduler information of a submitted job
+class Job:
+	jobID = ""
+	name = ""
+	state = UNKNOWN
+	exitCode = None
+	submitted = None
+	started = None
+	finished = None
+
+	def __init__(self, jobID, name):
+		self.jobID = jobID
+		self.name = name
+		self.state = QUEUED
+		self.exitCode = None
+		self.submitted = datetime.datetime.utcnow()
+		self.started = None
+		self.finished = None
+
+# PBSBackend: Submits through qsub and fetches the state of every outstanding job with a single qstat call
+class PBSBackend:
+	qstatCommand = "qstat -f"
+	stateMap = {"Q": QUEUED, "H": QUEUED, "W": QUEUED, "T": QUEUED, "S": QUEUED,
+				"R": RUNNING, "E": RUNNING, "B": RUNNING,
+				"C": EXITED, "F": EXITED, "X": EXITED}
+
+	def __init__(self, qstatCommand = None):
+		if(qstatCommand != None):
+			self.qstatCommand = qstatCommand
+
+	def submit(self, command):
+		stored = Tools.run_command(command)
+		tokens = stored[0].split()
+		return stored, (tokens[0] if tokens else None)
+
+	def cancel(self, jobIDs):
+		return Tools.run_command("qdel " + " ".join(jobIDs))
+
+	# query: Returns {jobKey: (state, exitCode)} for the requested jobs, jobs the server no longer knows about are reported as exited
+	def query(self, jobIDs):
+		stdout, stderr = Tools.run_command(self.qstatCommand + " " + " ".join(jobIDs))
+		results = {}
+		current = None
+		for line in stdout.splitlines():
+			if line.startswith("Job Id:"):
+				current = jobKey(line.split(":", 1)[1])
+				results[current] = [UNKNOWN, None]
+			elif current != None and '=' in line:
+				key, value = [part.strip() for part in line.split('=', 1)]
+				if(key == "job_state"):
+					results[current][0] = self.stateMap.get(value, UNKNOWN)
+				elif(key.lower() == "exit_status"):
+					try:
+						results[current][1] = int(value)
+					except ValueError:
+						pass
+		for jobID in jobIDs:
+			if not jobKey(jobID) in results and ("Unknown Job" in stderr or jobID in stderr):
+				results[jobKey(jobID)] = [EXITED, None]
+		return results
+
+# afterok: The job IDs a qsub command depends on through -W depend=afterok:<id>[:<id>...], empty if it has no dependencies
+def afterok(command):
+	tokens = command.split()
+	for i, token in enumerate(tokens[:-1]):
+		if(token == "-W" and tokens[i + 1].startswith("depend=afterok:")):
+			return tokens[i + 1].split(':')[1:]
+	return []
+
+# LocalBackend: A fake scheduler that runs the job scripts as local processes, used to exercise the tracker without PBS.
+#  queueDelay holds each job in the queued state for the given number of seconds before it starts. Jobs submitted with
+#  -W depend=afterok:<id> are held until their dependencies exit with code 0 and removed if one of them fails, as PBS does.
+class LocalBackend:
+	queueDelay = 0
+	counter = 0
+	jobs = {}
+
+	def __init__(self, queueDelay = 0):
+		self.queueDelay = queueDelay
+		self.counter = 0
+		self.jobs = {}
+
+	def submit(self, command):
+		script = command.split()[-1]
+		self.counter += 1
+		jobID = str(self.counter) + ".local"
+		self.jobs[jobKey(jobID)] = {"script": os.path.abspath(script), "cwd": os.getcwd(), "submitted": datetime.datetime.utcnow(), "process": None,
+									"after": [jobKey(dep) for dep in afterok(command)], "removed": False}
+		self.start_ready()
+		return [jobID + "\n", ""], jobID
+
+	def cancel(self, jobIDs):
+		for jobID in jobIDs:
+			job = self.jobs.get(jobKey(jobID))
+			if job is None:
+				continue
+			if job["process"] is None:
+				job["removed"] = True
+			elif job["process"].poll() is None:
+				job["process"].terminate()
+		return ["", ""]
+
+	# exited: The exit code of a finished job, None while it is queued or running (Or if it was removed)
+	def exited(self, key):
+		job = self.jobs.get(key)
+		if job is None or job["process"] is None or job["process"].poll() is None:
+			return None
+		return job["process"].returncode
+
+	def start_ready(self):
+		now = datetime.datetime.utcnow()
+		for key, job in list(self.jobs.items()):
+			if job["process"] is None and not job["removed"] and job["after"]:
+				if any(self.jobs.get(dep) is None or self.jobs[dep]["removed"] or not self.exited(dep) in (None, 0) for dep in job["after"]):
+					job["removed"] = True
+					continue
+				if any(self.exited(dep) is None for dep in job["after"]):
+					continue
+			if job["process"] is None and not job["removed"] and (now - job["submitted"]).total_seconds() >= self.queueDelay:
+				outFile = open(job["script"] + ".o" + key, "w")
+				job["process"] = subprocess.Popen(["bash", job["script"]], cwd=job["cwd"], stdout=outFile, stderr=subprocess.STDOUT)
+				outFile.close()
+
+	def query(self, jobIDs):
+		self.start_ready()
+		results = {}
+		for jobID in jobIDs:
+			job = self.jobs.get(jobKey(jobID))
+			if job is None or job["removed"]:
+				results[jobKey(jobID)] = [EXITED, None]
+			elif job["process"] is None:
+				results[jobKey(jobID)] = [QUEUED, None]
+			elif job["process"].poll() is None:
+				results[jobKey(jobID)] = [RUNNING, None]
+			else:
+				results[jobKey(jobID)] = [EXITED, job["process"].returncode]
+		return results
+
+# JobTracker: Singleton that records every job submitted through Tools.popen and refreshes their states at most once per interval.
+#  Steps running at the same time (See Pipeline) submit and wait from their own threads, jobs is only changed under the lock and
+#  read through a copy (all_jobs())
+@Tools.Singleton
+class JobTracker:
+	backend = None
+	interval = 60
+	jobs = {}
+	lastQuery = None
+	lock = None
+
+	def __init__(self):
+		self.backend = PBSBackend()
+		self.interval = 60
+		self.jobs = {}
+		self.lastQuery = None
+		self.lock = threading.Lock()
+
+	# configure: Select the backend and poll interval from control.txt (scheduler, scheduler_poll_interval)
+	def configure(self, settings):
+		if(settings.fetch("scheduler") == "local"):
+			self.backend = LocalBackend()
+		elif(settings.fetch("scheduler") == "pbspro"):
+			# PBS Pro drops finished jobs from qstat unless -x is given
+			self.backend = PBSBackend("qstat -x -f")
+		else:
+			self.backend = PBSBackend()
+		if(settings.fetch("scheduler_poll_interval") != None):
+			self.interval = int(settings.fetch("scheduler_poll_interval"))
+
+	def setBackend(self, backend, interval = None):
+		self.backend = backend
+		if(interval != None):
+			self.interval = interval
+
+	def submit(self, command):
+		stored, jobID = self.backend.submit(command)
+		if jobID:
+			self.track(jobID, command.split()[-1])
+		return stored, jobID
+
+	# cancel: Remove queued jobs and stop running ones (qdel)
+	def cancel(self, jobIDs):
+		if jobIDs:
+			self.backend.cancel(jobIDs)
+			Tools.loggedPrint.instance().write("JobTracker: Cancelled " + ", ".join(jobIDs))
+
+	def track(self, jobID, name):
+		with self.lock:
+			self.jobs[jobKey(jobID)] = Job(jobID, name)
+		Tools.loggedPrint.instance().write("JobTracker: Tracking job " + jobID + " (" + name + ")")
+
+	# all_jobs: A copy of the tracked jobs, safe to loop over while other threads submit
+	def all_jobs(self):
+		with self.lock:
+			return list(self.jobs.values())
+
+	def outstanding(self):
+		return [job.jobID for job in self.all_jobs() if job.state != EXITED]
+
+	# refresh: Query the backend for every outstanding job in one call, skipped if the last query is newer than the interval
+	def refresh(self, force = False):
+		now = datetime.datetime.utcnow()
+		with self.lock:
+			if(not force and self.lastQuery != None and (now - self.lastQuery).total_seconds() < self.interval):
+				return
+			self.lastQuery = now
+		pending = self.outstanding()
+		if not pending:
+			return
+		results = self.backend.query(pending)
+		for jobID in pending:
+			if not jobKey(jobID) in results:
+				continue
+			state, exitCode = results[jobKey(jobID)]
+			job = self.fetch(jobID)
+			if(job == None or state == UNKNOWN or state == job.state):
+				continue
+			if(state == RUNNING and job.started == None):
+				job.started = now
+			if(state == EXITED):
+				if(job.started == None):
+					job.started = now
+				job.finished = now
+				job.exitCode = exitCode
+			job.state = state
+			Tools.loggedPrint.instance().write("JobTracker: Job " + job.jobID + " (" + job.name + ") is now " + state + ("" if exitCode == None else ", exit code " + str(exitCode)))
+
+	def fetch(self, jobID):
+		with self.lock:
+			return self.jobs.get(jobKey(jobID))
+
+	# latest: The most recently submitted job with the given name (IE: wrf.job), None if no such job was submitted
+	def latest(self, name):
+		named = [job for job in self.all_jobs() if job.name == name]
+		return max(named, key = lambda job: job.submitted) if named else None
+
+	def state(self, jobID):
+		job = self.fetch(jobID)
+		return job.state if job else UNKNOWN
+
+	def exitCode(self, jobID):
+		job = self.fetch(jobID)
+		return job.exitCode if job else None
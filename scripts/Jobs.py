@@ -18,6 +18,60 @@ import Tools
 import Wait
 import Template
 import PreparePyJob
+import JobTracker
+import FileOps
+import GribIndex
+import Metrics
+import DataCache
+import PrerunJob
+import Staging
+import Validate
+
+# The logs and progress files watched by the holds of each job, removed before a new submission so the holds cannot fire on the files of an
+#  earlier run (A reattached job keeps them, See Jobs.submit())
+GEOGRID_LOGS = ["geogrid.log*"]
+PRERUN_LOGS = ["ungrib.log*", "metgrid.log*", "metgrid_log.txt", "prerun_progress.txt", "output/rsl.out.*", "output/rsl.error.*"]
+
+# job_exited: Builds the hold condition that fires once a submitted job leaves the scheduler, empty when no job ID was recorded (IE: debugmode)
+def job_exited(jobSub, retCode):
+	if(jobSub.jobID == None):
+		return []
+	return [{"jobID": jobSub.jobID, "jobState": JobTracker.EXITED, "retCode": retCode}]
+
+# job_exit_text: Short description of how a tracked job ended, used in the failure logs
+def job_exit_text(jobSub):
+	if(jobSub.jobID == None):
+		return "job exited"
+	return "job " + jobSub.jobID + " exited with code " + str(JobTracker.JobTracker.instance().exitCode(jobSub.jobID))
+
+# wrf_date: The date in the names of the files written by wrf.exe, the namelist template sets nocolons so times are written as HH_MM_SS
+def wrf_date(time):
+	return time.strftime("%Y-%m-%d_%H_%M_%S")
+
+# check_lines: Job file lines run after a stage's executables, the job exits with code 1 unless condition holds, so the scheduler
+#  removes every job depending on it (afterok). The outcome is appended to the progress file, onSuccess lines run before it is
+def check_lines(stage, condition, progressFile, onSuccess = ""):
+	contents = "\nif " + condition + "; then\n"
+	contents += onSuccess
+	contents += "\techo \"" + stage + " complete\" >> " + progressFile + "\n"
+	contents += "else\n"
+	contents += "\techo \"" + stage + " failed\" >> " + progressFile + "\n"
+	contents += "\texit 1\n"
+	contents += "fi\n"
+	return contents
+
+# read_progress: The stages reported in a progress file by check_lines(), {stage: "complete" | "failed"}
+def read_progress(path):
+	progress = {}
+	try:
+		with open(path) as f:
+			for line in f:
+				tokenized = line.split()
+				if len(tokenized) == 2:
+					progress[tokenized[0]] = tokenized[1]
+	except (IOError, OSError):
+		pass
+	return progress
 
 # JobSteps: Class responsible for handling the steps that involve job submission and checkup
 class JobSteps:
@@ -27,174 +81,347 @@ class JobSteps:
 	startTime = ""
 	dataDir = ""
 	wrfDir = ""
+	fileOps = None
+	state = None
 
-	def __init__(self, settings, modelParms):
+	def __init__(self, settings, modelParms, state = None):
 		self.aSet = settings
+		self.state = state
 		self.logger = Tools.loggedPrint.instance()
+		self.fileOps = FileOps.FileOps(settings)
 		self.modelParms = modelParms
 		self.dataDir = settings.fetch("datadir") + '/' + settings.fetch("modeldata")
 		self.wrfDir = settings.fetch("wrfdir")
 		self.startTime = settings.fetch("starttime")
 		# Copy important files to the directory
-		Tools.popen(self.aSet, "cp " + settings.fetch("headdir") + "run_files/* " + self.wrfDir + '/' + self.startTime[0:8] + "/output")
-		# Copy required WRF files
-		Tools.popen(self.aSet, "cp " + self.aSet.fetch("wrfrunfiles") + "* " + self.wrfDir + '/' + self.startTime[0:8] + "/output")
+		self.fileOps.copy([settings.fetch("headdir") + "run_files/*"], self.aSet.fetch("rundir") + "/output")
+		# Link the WRF tables and executables needed by real.exe and wrf.exe
+		Staging.Staging(settings).stage(self.aSet.fetch("rundir") + "/output")
 		# Move the generated files to the run directory		
-		Tools.popen(self.aSet, "mv namelist.input " + self.wrfDir + '/' + self.startTime[0:8] + "/output")	
+		self.fileOps.move(["namelist.input"], self.aSet.fetch("rundir") + "/output")
 	
+	# submit: qsub a step's job file from the current directory, or reattach to the job an earlier run of the program submitted for the
+	#  step (See RunState). clean is removed before a new submission only, the files of a reattached job are still being written.
+	#  The job is recorded in the run state. Returns (Tools.popen result, True if reattached)
+	def submit(self, step, jobFile, clean = None):
+		if self.state != None:
+			attached = self.state.attach(step)
+			if attached != None:
+				return attached, True
+		if clean != None:
+			self.fileOps.remove(clean)
+		self.fileOps.chmod_x([jobFile])
+		jobSub = Tools.popen(self.aSet, "qsub " + jobFile)
+		if(self.state != None and jobSub.jobID != None):
+			self.state.submitted(step, jobSub.jobID, jobFile)
+		return jobSub, False
+
+	@Metrics.timed("geogrid")
 	def run_geogrid(self):
 		Tools.Process.instance().Lock()
 		self.logger.write("run_geogrid(): Enter")
-		Tools.popen(self.aSet, "mv namelist.wps.geogrid " + self.wrfDir + '/' + self.startTime[0:8] + "/namelist.wps")
-		with Tools.cd(self.wrfDir + '/' + self.startTime[0:8]):				
-			Tools.popen(self.aSet, "chmod +x geogrid.job")
-			Tools.popen(self.aSet, "qsub geogrid.job")
+		cache = self.stage_cache()
+		key = cache.geogrid_key("namelist.wps.geogrid", self.aSet.fetch("tabledir")) if cache != None else None
+		if key != None and cache.fetch(key, self.run_dir() + "/output", self.run_dir()):
+			self.logger.write("run_geogrid(): Exit (geo_em files linked from the stage cache, " + key + ")")
+			Tools.Process.instance().Unlock()
+			return True
+		self.fileOps.move(["namelist.wps.geogrid"], self.aSet.fetch("rundir") + "/namelist.wps")
+		with Tools.cd(self.aSet.fetch("rundir")):				
+			# Files linked from the stage cache are read-only, clear them before geogrid.exe writes new ones
+			jobSub, attached = self.submit("geogrid", "geogrid.job", clean = GEOGRID_LOGS + (["output/geo_em.d0*"] if key != None else []))
 			# Now wait for the log files
 			try:
-				firstWait = [{"waitCommand": "(ls geogrid.log* && echo \"yes\") || echo \"no\"", "contains": "yes", "retCode": 1}]
-				wait1 = Wait.Wait(firstWait, timeDelay = 25)
-				wait1.hold()
+				firstWait = [{"watchFile": "geogrid.log*", "exists": True, "retCode": 1}] + job_exited(jobSub, 2)
+				wait1 = Wait.Wait(firstWait, timeDelay = 25, name = "geogrid start")
+				if(wait1.hold() == 2):
+					self.logger.write("run_geogrid(): Exit (Failed, " + job_exit_text(jobSub) + " before writing a log file)")
+					Tools.Process.instance().Unlock()
+					return False
 			except Wait.TimeExpiredException:
 				sys.exit("geogrid.exe job not completed, abort.")			
 			# Check for completion
 			self.logger.write("Log file detected, waiting for completion.")
 			try:
-				secondWait = [{"waitCommand": "tail -n 3 geogrid.log*", "contains": "Successful completion of program geogrid.exe", "retCode": 1},
-							  {"waitCommand": "tail -n 3 geogrid.log*", "contains": "fatal", "retCode": 2},
-							  {"waitCommand": "tail -n 3 geogrid.log*", "contains": "runtime", "retCode": 2},
-							  {"waitCommand": "tail -n 3 geogrid.log*", "contains": "error", "retCode": 2},]
-				wait2 = Wait.Wait(secondWait, timeDelay = 25)
+				secondWait = [{"watchFile": "geogrid.log*", "contains": "Successful completion of program geogrid.exe", "retCode": 1},
+							  {"watchFile": "geogrid.log*", "contains": "fatal", "tail": 3, "retCode": 2},
+							  {"watchFile": "geogrid.log*", "contains": "runtime", "tail": 3, "retCode": 2},
+							  {"watchFile": "geogrid.log*", "contains": "error", "tail": 3, "retCode": 2},] + job_exited(jobSub, 3)
+				wait2 = Wait.Wait(secondWait, timeDelay = 25, name = "geogrid")
 				wRC1 = wait2.hold()
 				if wRC1 == 1:
 					# Success condition, proceed to the next.
 					self.logger.write("Geogrid process sucessfully completed.")
+					if key != None:
+						cache.keep(key, ["output/geo_em.d0*"], self.run_dir())
 				elif wRC1 == 2:
 					self.logger.write("run_geogrid(): Exit (Failed, Code 2)")
 					Tools.Process.instance().Unlock()
 					return False
+				elif wRC1 == 3:
+					self.logger.write("run_geogrid(): Exit (Failed, " + job_exit_text(jobSub) + " without completing geogrid.exe)")
+					Tools.Process.instance().Unlock()
+					return False
 			except Wait.TimeExpiredException:
 				sys.exit("geogrid.exe job not completed, abort.")					
 		self.logger.write("run_geogrid(): Exit")
 		Tools.Process.instance().Unlock()
 	
+	@Metrics.timed("preprocessing")
 	def run_preprocessing(self):	
 		#ungrib.exe needs to run in the data directory
 		Tools.Process.instance().Lock()
 		self.logger.write("run_preprocessing(): Enter")
-		Tools.popen(self.aSet, "cp " + self.aSet.fetch("headdir") + "vtables/Vtable." + self.aSet.fetch("modeldata") + "* " + self.wrfDir + '/' + self.startTime[0:8])
-		Tools.popen(self.aSet, "mv namelist.wps* " + self.wrfDir + '/' + self.startTime[0:8])
-		mParms = self.modelParms.fetch()
-		with Tools.cd(self.wrfDir + '/' + self.startTime[0:8]):				
-			Tools.popen(self.aSet, "chmod +x prerun.job")
-			Tools.popen(self.aSet, "qsub prerun.job")
-			self.logger.write("Job has been submitted to the queue, waiting for log file to appear.")
-			# Now wait for the log files
-			try:
-				firstWait = [{"waitCommand": "(ls ungrib.log* && echo \"yes\") || echo \"no\"", "contains": "yes", "retCode": 1}]
-				wait1 = Wait.Wait(firstWait, timeDelay = 25)
-				wait1.hold()
-			except Wait.TimeExpiredException:
-				sys.exit("ungrib.exe job not completed, abort.")			
-			# Check for completion
-			self.logger.write("Log file detected, waiting for completion.")
-			try:
-				secondWait = [{"waitCommand": "tail -n 3 ungrib.log*", "contains": "Successful completion of program ungrib.exe", "retCode": 1},
-							  {"waitCommand": "tail -n 3 ungrib.log*", "contains": "fatal", "retCode": 2},
-							  {"waitCommand": "tail -n 3 ungrib.log*", "contains": "runtime", "retCode": 2},
-							  {"waitCommand": "tail -n 3 ungrib.log*", "contains": "error", "retCode": 2},]
-				wait2 = Wait.Wait(secondWait, timeDelay = 25)
-				wRC1 = wait2.hold()
-				if wRC1 == 1:
-					# Success condition, proceed to the next.
-					self.logger.write("Ungrib process sucessfully completed, starting metgrid process.")
-					try:
-						thirdWait = [{"waitCommand": "(ls metgrid.log* && echo \"yes\") || echo \"no\"", "contains": "yes", "retCode": 1}]
-						wait3 = Wait.Wait(thirdWait, timeDelay = 25)
-						wait3.hold()
-					except Wait.TimeExpiredException:
-						sys.exit("metgrid.exe job not completed, abort.")
-					self.logger.write("Log file detected, waiting for completion.")
-					#Now wait for the output file to be completed
-					try:
-						fourthWait = [{"waitCommand": "tail -n 3 metgrid.log.0000", "contains": "Successful completion of program metgrid.exe", "retCode": 1},
-									  {"waitCommand": "tail -n 3 metgrid.log.0000", "contains": "fatal", "retCode": 2},
-									  {"waitCommand": "tail -n 3 metgrid.log.0000", "contains": "runtime", "retCode": 2},
-									  {"waitCommand": "tail -n 3 metgrid.log.0000", "contains": "error", "retCode": 2},]
-						wait4 = Wait.Wait(fourthWait, timeDelay = 25)
-						wRC2 = wait4.hold()
-						if wRC2 == 1:
-							# Success Condition, proceed to real.exe
-							self.logger.write("Metgrid process sucessfully completed, starting real process.")
-							Tools.popen(self.aSet, "mv metgrid.log.0000 metgrid_log.txt")
-							Tools.popen(self.aSet, "rm metgrid.log.*")
-							try:
-								fifthWait = [{"waitCommand": "(ls output/rsl.out.0000 && echo \"yes\") || echo \"no\"", "contains": "yes", "retCode": 1}]
-								wait5 = Wait.Wait(fifthWait, timeDelay = 25)
-								wait5.hold()			
-							except Wait.TimeExpiredException:
-								sys.exit("real.exe job not completed, abort.")
-							self.logger.write("Log file detected, waiting for completion.")
-							#Now wait for the output file to be completed
-							try:
-								sixthWait = [{"waitCommand": "tail -n 3 output/rsl.out.0000", "contains": "SUCCESS COMPLETE REAL_EM", "retCode": 1},
-											  {"waitCommand": "tail -n 3 output/rsl.error.0000", "contains": "FATAL", "retCode": 2},
-											  {"waitCommand": "tail -n 3 output/rsl.error.0000", "contains": "runtime", "retCode": 2},
-											  {"waitCommand": "tail -n 3 output/rsl.error.0000", "contains": "error", "retCode": 2},]
-								wait6 = Wait.Wait(sixthWait, timeDelay = 60)
-								wRC3 = wait6.hold()
-								if wRC3 == 2:
-									self.logger.write("run_preprocessing(): Exit (Failed at real, Code 2)")
-									Tools.Process.instance().Unlock()
-									return False
-								else:
-									# Copy the log files.
-									Tools.popen(self.aSet, "mv output/rsl.out.0000 real_log.txt")
-									Tools.popen(self.aSet, "mv output/rsl.error.0000 real_error_log.txt")									
-									#Validate the presense of the two files.
-									file1 = os.popen("(ls output/wrfinput_d01 && echo \"yes\") || echo \"no\"").read()
-									file2 = os.popen("(ls output/wrfbdy_d01 && echo \"yes\") || echo \"no\"").read()
-									if("yes" in file1 and "yes" in file2):
-										self.logger.write("run_preprocessing(): Exit")
-										Tools.Process.instance().Unlock()
-										return True
-									self.logger.write("run_preprocessing(): Exit (Failed at real, did not find wrfinput_d01 and wrfbdy_d01")
-									Tools.Process.instance().Unlock()
-									return False					
-							except Wait.TimeExpiredException:
-								sys.exit("real.exe job not completed, abort.")							
-						elif wRC2 == 2:
-							self.logger.write("run_preprocessing(): Exit (Failed at metgrid, Code 2)")
-							Tools.Process.instance().Unlock()
-							return False
-					except Wait.TimeExpiredException:
-						sys.exit("metgrid.exe job not completed, abort.")					
-				elif wRC1 == 2:
-					self.logger.write("run_preprocessing(): Exit (Failed at ungrib, Code 2)")
-					Tools.Process.instance().Unlock()
-					return False
-			except Wait.TimeExpiredException:
-				sys.exit("ungrib.exe job not completed, abort.")			
+		self.fileOps.copy([self.aSet.fetch("headdir") + "vtables/Vtable." + self.aSet.fetch("modeldata") + "*"], self.aSet.fetch("rundir"))
+		self.fileOps.move(["namelist.wps*"], self.aSet.fetch("rundir"))
+		with Tools.cd(self.aSet.fetch("rundir")):
+			cache = self.stage_cache()
+			keys = self.stage_keys(cache) if cache != None else None
+			if keys != None and cache.fetch(keys["real"], "output", self.run_dir()):
+				self.logger.write("wrfinput/wrfbdy linked from the stage cache (" + keys["real"] + "), skipping the pre-processing job.")
+				Tools.Process.instance().Unlock()
+				return True
+			if keys != None and cache.fetch(keys["metgrid"], "output", self.run_dir()):
+				# Only real.exe needs to run (IE: A physics-only change)
+				self.logger.write("met_em files linked from the stage cache (" + keys["metgrid"] + "), running real.exe only.")
+				jobSub, attached = self.submit("preprocessing", self.write_stage_job("real.job", "WRF_REAL", "cd output\n" + self.prerun_mpirun("real.exe") + "\n"),
+											   clean = PRERUN_LOGS + ["output/wrfinput_d0*", "output/wrfbdy_d01"])
+				result = self.wait_for_real(jobSub)
+			elif keys != None and all(cache.fetch(key, ".", self.run_dir()) for key in keys["ungrib"].values()):
+				self.logger.write("Intermediate files linked from the stage cache, running metgrid.exe and real.exe only.")
+				mParms = self.modelParms.fetch()
+				commands = "cp namelist.wps." + mParms["FileExtentions"][0] + " namelist.wps\n" + self.prerun_mpirun("metgrid.exe") + "\n"
+				commands += "cd output\n" + self.prerun_mpirun("real.exe") + "\n"
+				jobSub, attached = self.submit("preprocessing", self.write_stage_job("metgrid_real.job", "WRF_METGRID", commands),
+											   clean = PRERUN_LOGS + ["output/met_em.d0*", "output/wrfinput_d0*", "output/wrfbdy_d01"])
+				self.logger.write("Job has been submitted to the queue, waiting for log file to appear.")
+				result = self.wait_for_metgrid(jobSub)
+			else:
+				result = self.run_prerun_job(cache != None)
+			if(result == True and keys != None):
+				self.store_stages(cache, keys)
+			return result
 		self.logger.write("run_preprocessing(): Failed to enter run directory")
 		Tools.Process.instance().Unlock()
-		return False	
+		return False
+
+	def run_dir(self):
+		return self.aSet.fetch("rundir")
+
+	# stage_cache: The StageCache when use_stage_cache is on, None otherwise (Or in debugmode)
+	def stage_cache(self):
+		if(self.aSet.fetch("use_stage_cache") != '1' or self.aSet.fetch("debugmode") == '1'):
+			return None
+		return DataCache.StageCache(self.aSet)
+
+	# stage_keys: The stage cache keys of this run's geogrid, ungrib (Per input stream), metgrid and real.exe outputs, run from the run directory
+	def stage_keys(self, cache):
+		mParms = self.modelParms.fetch()
+		tableDir = self.aSet.fetch("tabledir")
+		namelist = "namelist.wps." + mParms["FileExtentions"][0]
+		dataDir = self.dataDir + '/' + self.startTime
+		dates = PrerunJob.PrerunJob(self.aSet, mParms).dates()
+		keys = {"geogrid": cache.geogrid_key(namelist, tableDir), "ungrib": {}}
+		for i, ext in enumerate(mParms["FileExtentions"]):
+			inputs = [dataDir + '/' + d.strftime(mParms["InputFiles"][i]) for d in dates]
+			keys["ungrib"][ext] = cache.ungrib_key("namelist.wps." + ext, mParms["VTable"][i], inputs)
+		keys["metgrid"] = cache.metgrid_key(namelist, tableDir, keys["geogrid"], [keys["ungrib"][ext] for ext in mParms["FileExtentions"]])
+		keys["real"] = cache.real_key("output/namelist.input", keys["metgrid"])
+		return keys
+
+	# store_stages: Keep the outputs of a completed pre-processing job in the stage cache, stages already cached are left as they are
+	def store_stages(self, cache, keys):
+		stored = 0
+		for ext, key in keys["ungrib"].items():
+			stored += cache.keep(key, [ext + ":*"], self.run_dir())
+		stored += cache.keep(keys["metgrid"], ["output/met_em.d0*"], self.run_dir())
+		stored += cache.keep(keys["real"], ["output/wrfinput_d0*", "output/wrfbdy_d01"], self.run_dir())
+		self.logger.write("  -> " + str(stored) + " pre-processing files kept in the stage cache (" + cache.root + ")")
+
+	def prerun_mpirun(self, executable):
+		return "mpirun -np " + str(int(self.aSet.fetch("num_prerun_nodes")) * int(self.aSet.fetch("num_prerun_processors"))) + " " + executable
+
+	# write_stage_job: Write a pre-processing job running only the stages missing from the stage cache, returns the job file name
+	def write_stage_job(self, jobFile, jobName, commands):
+		with open(jobFile, 'w') as target_file:
+			target_file.write("#!/bin/bash\n")
+			target_file.write("#PBS -l nodes=" + self.aSet.fetch("num_prerun_nodes") + ":ppn=" + self.aSet.fetch("num_prerun_processors") + "\n")
+			target_file.write("#PBS -N " + jobName + "\n")
+			target_file.write("#PBS -l walltime=" + self.aSet.fetch("prerun_walltime") + "\n")
+			target_file.write("#PBS -A climlab" + "\n\n")
+			target_file.write("source " + self.aSet.fetch("sourcefile") + "\n")
+			target_file.write("ulimit -s unlimited\n")
+			target_file.write("cd " + self.run_dir() + "\n\n")
+			target_file.write(commands)
+		return jobFile
+
+	# run_prerun_job: Submit prerun.job (ungrib.exe, metgrid.exe and real.exe) and follow it, run from the run directory.
+	#  clearOutputs also removes the outputs of an earlier run first, as files linked from the stage cache are read-only
+	def run_prerun_job(self, clearOutputs = False):
+		clean = list(PRERUN_LOGS)
+		if clearOutputs:
+			clean += [ext + ":*" for ext in self.modelParms.fetch()["FileExtentions"]] + ["output/met_em.d0*", "output/wrfinput_d0*", "output/wrfbdy_d01"]
+		jobSub, attached = self.submit("preprocessing", "prerun.job", clean = clean)
+		if(self.aSet.fetch("pipeline_preprocessing") == '1'):
+			self.logger.write("Job has been submitted to the queue, following the pipeline progress.")
+			return self.wait_for_pipeline(jobSub)
+		self.logger.write("Job has been submitted to the queue, waiting for log file to appear.")
+		# Now wait for the log files
+		try:
+			firstWait = [{"watchFile": "ungrib.log*", "exists": True, "retCode": 1}] + job_exited(jobSub, 2)
+			wait1 = Wait.Wait(firstWait, timeDelay = 25, name = "ungrib start")
+			if(wait1.hold() == 2):
+				self.logger.write("run_preprocessing(): Exit (Failed, " + job_exit_text(jobSub) + " before writing a log file)")
+				Tools.Process.instance().Unlock()
+				return False
+		except Wait.TimeExpiredException:
+			sys.exit("ungrib.exe job not completed, abort.")			
+		# Check for completion
+		self.logger.write("Log file detected, waiting for completion.")
+		try:
+			secondWait = [{"watchFile": "ungrib.log*", "contains": "Successful completion of program ungrib.exe", "retCode": 1},
+						  {"watchFile": "ungrib.log*", "contains": "fatal", "tail": 3, "retCode": 2},
+						  {"watchFile": "ungrib.log*", "contains": "runtime", "tail": 3, "retCode": 2},
+						  {"watchFile": "ungrib.log*", "contains": "error", "tail": 3, "retCode": 2},] + job_exited(jobSub, 3)
+			wait2 = Wait.Wait(secondWait, timeDelay = 25, name = "ungrib")
+			wRC1 = wait2.hold()
+			if wRC1 == 1:
+				# Success condition, proceed to the next.
+				self.logger.write("Ungrib process sucessfully completed, starting metgrid process.")
+				return self.wait_for_metgrid(jobSub)
+			elif wRC1 == 2:
+				self.logger.write("run_preprocessing(): Exit (Failed at ungrib, Code 2)")
+				Tools.Process.instance().Unlock()
+				return False
+			elif wRC1 == 3:
+				self.logger.write("run_preprocessing(): Exit (Failed at ungrib, " + job_exit_text(jobSub) + ")")
+				Tools.Process.instance().Unlock()
+				return False
+		except Wait.TimeExpiredException:
+			sys.exit("ungrib.exe job not completed, abort.")			
+		Tools.Process.instance().Unlock()
+		return False
+
+	# wait_for_metgrid: Hold until metgrid.exe in the pre-processing job completes, then hold for real.exe, run from the run directory
+	def wait_for_metgrid(self, jobSub):
+		try:
+			thirdWait = [{"watchFile": "metgrid.log*", "exists": True, "retCode": 1}] + job_exited(jobSub, 2)
+			wait3 = Wait.Wait(thirdWait, timeDelay = 25, name = "metgrid start")
+			if(wait3.hold() == 2):
+				self.logger.write("run_preprocessing(): Exit (Failed, " + job_exit_text(jobSub) + " before starting metgrid.exe)")
+				Tools.Process.instance().Unlock()
+				return False
+		except Wait.TimeExpiredException:
+			sys.exit("metgrid.exe job not completed, abort.")
+		self.logger.write("Log file detected, waiting for completion.")
+		#Now wait for the output file to be completed
+		try:
+			fourthWait = [{"watchFile": "metgrid.log.0000", "contains": "Successful completion of program metgrid.exe", "retCode": 1},
+						  {"watchFile": "metgrid.log.0000", "contains": "fatal", "tail": 3, "retCode": 2},
+						  {"watchFile": "metgrid.log.0000", "contains": "runtime", "tail": 3, "retCode": 2},
+						  {"watchFile": "metgrid.log.0000", "contains": "error", "tail": 3, "retCode": 2},] + job_exited(jobSub, 3)
+			wait4 = Wait.Wait(fourthWait, timeDelay = 25, name = "metgrid")
+			wRC2 = wait4.hold()
+			if wRC2 == 1:
+				# Success Condition, proceed to real.exe
+				self.logger.write("Metgrid process sucessfully completed, starting real process.")
+				self.fileOps.move(["metgrid.log.0000"], "metgrid_log.txt")
+				self.fileOps.remove(["metgrid.log.*"])
+				return self.wait_for_real(jobSub)
+			elif wRC2 == 2:
+				self.logger.write("run_preprocessing(): Exit (Failed at metgrid, Code 2)")
+				Tools.Process.instance().Unlock()
+				return False
+			elif wRC2 == 3:
+				self.logger.write("run_preprocessing(): Exit (Failed at metgrid, " + job_exit_text(jobSub) + ")")
+				Tools.Process.instance().Unlock()
+				return False
+		except Wait.TimeExpiredException:
+			sys.exit("metgrid.exe job not completed, abort.")
+		Tools.Process.instance().Unlock()
+		return False
 		
-	def run_wrf(self):
+	# wait_for_pipeline: Follow prerun_progress.txt of a pipelined pre-processing job (See PrerunJob.pipeline_commands()), logging each
+	#  valid time as it passes through ungrib and metgrid, then hold for real.exe
+	def wait_for_pipeline(self, jobSub):
+		def progress(newText):
+			for line in newText["prerun_progress.txt"].splitlines():
+				self.logger.write("  -> Pre-processing: " + line)
+		try:
+			pipeWait = [{"watchFile": "prerun_progress.txt", "contains": "metgrid complete", "retCode": 1},
+						{"watchFile": "prerun_progress.txt", "contains": "ERROR", "retCode": 2},
+						{"watchFile": "ungrib.log", "contains": "ERROR: ungrib.exe failed", "retCode": 2},] + job_exited(jobSub, 3)
+			wait1 = Wait.Wait(pipeWait, timeDelay = 25, onNewText = progress, name = "ungrib/metgrid pipeline")
+			wRC = wait1.hold()
+			if wRC == 2:
+				self.logger.write("run_preprocessing(): Exit (Failed in the ungrib/metgrid pipeline, see prerun_progress.txt)")
+				Tools.Process.instance().Unlock()
+				return False
+			elif wRC == 3:
+				self.logger.write("run_preprocessing(): Exit (Failed in the ungrib/metgrid pipeline, " + job_exit_text(jobSub) + ")")
+				Tools.Process.instance().Unlock()
+				return False
+		except Wait.TimeExpiredException:
+			sys.exit("ungrib.exe/metgrid.exe pipeline not completed, abort.")
+		self.logger.write("Metgrid process sucessfully completed for every time, starting real process.")
+		return self.wait_for_real(jobSub)
+
+	# wait_for_real: Hold until real.exe in the pre-processing job completes and check for wrfinput_d01 and wrfbdy_d01, run from the run directory
+	def wait_for_real(self, jobSub):
+		try:
+			fifthWait = [{"watchFile": "output/rsl.out.0000", "exists": True, "retCode": 1}] + job_exited(jobSub, 2)
+			wait5 = Wait.Wait(fifthWait, timeDelay = 25, name = "real start")
+			if(wait5.hold() == 2):
+				self.logger.write("run_preprocessing(): Exit (Failed, " + job_exit_text(jobSub) + " before starting real.exe)")
+				Tools.Process.instance().Unlock()
+				return False
+		except Wait.TimeExpiredException:
+			sys.exit("real.exe job not completed, abort.")
+		self.logger.write("Log file detected, waiting for completion.")
+		#Now wait for the output file to be completed
+		try:
+			sixthWait = [{"watchFile": "output/rsl.out.0000", "contains": "SUCCESS COMPLETE REAL_EM", "retCode": 1},
+						  {"watchFile": "output/rsl.error.0000", "contains": "FATAL", "tail": 3, "retCode": 2},
+						  {"watchFile": "output/rsl.error.0000", "contains": "runtime", "tail": 3, "retCode": 2},
+						  {"watchFile": "output/rsl.error.0000", "contains": "error", "tail": 3, "retCode": 2},] + job_exited(jobSub, 3)
+			wait6 = Wait.Wait(sixthWait, timeDelay = 60, name = "real")
+			wRC3 = wait6.hold()
+			if wRC3 == 2:
+				self.logger.write("run_preprocessing(): Exit (Failed at real, Code 2)")
+				Tools.Process.instance().Unlock()
+				return False
+			elif wRC3 == 3:
+				self.logger.write("run_preprocessing(): Exit (Failed at real, " + job_exit_text(jobSub) + ")")
+				Tools.Process.instance().Unlock()
+				return False
+			else:
+				# Copy the log files.
+				self.fileOps.move(["output/rsl.out.0000"], "real_log.txt")
+				self.fileOps.move(["output/rsl.error.0000"], "real_error_log.txt")
+				#Validate the met_em, wrfinput and wrfbdy files from their headers
+				validate = Validate.Validate(self.aSet, self.modelParms)
+				if(validate.check(validate.met_em_jobs() + validate.input_jobs(), "pre-processing outputs")):
+					self.logger.write("run_preprocessing(): Exit")
+					Tools.Process.instance().Unlock()
+					return True
+				self.logger.write("run_preprocessing(): Exit (Failed at real, wrfinput_d01, wrfbdy_d01 or the met_em files are missing or invalid)")
+				Tools.Process.instance().Unlock()
+				return False					
+		except Wait.TimeExpiredException:
+			sys.exit("real.exe job not completed, abort.")							
+		return False
+		
+	# run_wrf: Submit wrf.exe and hold until it completes, incremental (IncrementalPost) is polled alongside the hold if given
+	@Metrics.timed("wrf")
+	def run_wrf(self, incremental = None):
 		Tools.Process.instance().Lock()
 		self.logger.write("run_wrf(): Enter")
-		with Tools.cd(self.wrfDir + '/' + self.startTime[0:8]):
-			# Do a quick file check to ensure wrf can run
-			file1 = os.popen("(ls output/wrfinput_d01 && echo \"yes\") || echo \"no\"").read()
-			file2 = os.popen("(ls output/wrfbdy_d01 && echo \"yes\") || echo \"no\"").read()
-			if(not ("yes" in file1 and "yes" in file2) and (not self.aSet.fetch("debugmode") == '1')):
-				self.logger.write("run_wrf(): Exit (Failed, cannot run wrf.exe without wrfinput_d01 and wrfbdy_d01)")
+		with Tools.cd(self.aSet.fetch("rundir")):
+			jobSub = self.submit_wrf()
+			if(jobSub == None):
+				self.logger.write("run_wrf(): Exit (Failed, cannot run wrf.exe without valid wrfinput_d01 and wrfbdy_d01)")
 				Tools.Process.instance().Unlock()
 				return False
-			# Remove the old log files as these are no longer needed
-			Tools.popen(self.aSet, "rm output/rsl.out.*")
-			Tools.popen(self.aSet, "rm output/rsl.error.*")	
-			# chmod the job and submit
-			Tools.popen(self.aSet, "chmod +x wrf.job")			
-			Tools.popen(self.aSet, "qsub wrf.job")
 			self.logger.write("Job has been submitted to the queue, waiting for log file to appear.")
 			if(self.aSet.fetch("debugmode") == '1'):
 				self.logger.write("Debug mode is active, skipping")
@@ -202,30 +429,30 @@ class JobSteps:
 				return True			
 			#Submit a wait condition for the file to appear
 			try:
-				firstWait = [{"waitCommand": "(ls output/rsl.out.0000 && echo \"yes\") || echo \"no\"", "contains": "yes", "retCode": 1}]
-				wait1 = Wait.Wait(firstWait, timeDelay = 25)
-				wait1.hold()			
+				firstWait = [{"watchFile": "output/rsl.out.0000", "exists": True, "retCode": 1}] + job_exited(jobSub, 2)
+				wait1 = Wait.Wait(firstWait, timeDelay = 25, name = "wrf start")
+				if(wait1.hold() == 2):
+					self.logger.write("run_wrf(): Exit (Failed, " + job_exit_text(jobSub) + " before writing a log file)")
+					Tools.Process.instance().Unlock()
+					return False
 			except Wait.TimeExpiredException:
 				sys.exit("wrf.exe job not completed, abort.")
 			self.logger.write("Log file detected, waiting for completion.")
 			#Now wait for the output file to be completed (Note: Allow 7 days from the output file first appearing to run)
 			try:
-				secondWait = [{"waitCommand": "tail -n 1 output/rsl.out.0000", "contains": "SUCCESS COMPLETE WRF", "retCode": 1},
-							  {"waitCommand": "tail -n 1 output/rsl.error.0000", "contains": "fatal", "retCode": 2},
-							  {"waitCommand": "tail -n 1 output/rsl.error.0000", "contains": "runtime", "retCode": 2},
-							  {"waitCommand": "tail -n 1 output/rsl.error.0000", "contains": "error", "retCode": 2},]
-				# Note: I have the script checking the files once every three minutes so we don't stack five calls rapidly, this can be modified later if needed.
-				wait2 = Wait.Wait(secondWait, timeDelay = 180)
+				# Note: The log files are followed in-process now, so a short poll no longer stacks shell calls, wake-ups on local writes are immediate.
+				wait2 = Wait.Wait(self.wrf_holds(jobSub), timeDelay = 30, onPoll = incremental.poll if incremental != None else None, name = "wrf")
 				wRC = wait2.hold()
 				if wRC == 2:
 					self.logger.write("run_wrf(): Exit (Failed, Code 2)")
 					Tools.Process.instance().Unlock()
 					return False
+				elif wRC == 3:
+					self.logger.write("run_wrf(): Exit (Failed, " + job_exit_text(jobSub) + " without completing wrf.exe)")
+					Tools.Process.instance().Unlock()
+					return False
 				else:
-					Tools.popen(self.aSet, "mv output/rsl.out.0000 wrf_log.txt")
-					Tools.popen(self.aSet, "mv output/rsl.error.0000 wrf_error_log.txt")
-					Tools.popen(self.aSet, "rm output/rsl.out.*")
-					Tools.popen(self.aSet, "rm output/rsl.error.*")					
+					self.collect_wrf_logs()
 					self.logger.write("run_wrf(): Exit")
 					Tools.Process.instance().Unlock()
 					return True				
@@ -235,43 +462,63 @@ class JobSteps:
 		Tools.Process.instance().Unlock()
 		return False			
 
+	# submit_wrf: Check the wrf.exe inputs and submit wrf.job (Or reattach to it), returns the Tools.popen result or None if wrfinput/wrfbdy are missing or invalid
+	def submit_wrf(self):
+		runDir = self.aSet.fetch("rundir")
+		validate = Validate.Validate(self.aSet, self.modelParms)
+		if(not validate.check(validate.input_jobs(), "wrf.exe inputs")):
+			return None
+		with Tools.cd(runDir):
+			# Remove the old log files as these are no longer needed, then submit
+			jobSub, attached = self.submit("wrf", "wrf.job", clean = ["output/rsl.out.*", "output/rsl.error.*"])
+		return jobSub
+
+	# wrf_holds: The hold conditions of a running wrf.job, 1 on success, 2 on an error in the logs and 3 if the job exits first.
+	#  The paths are absolute so several members can be followed from one directory (See Ensemble)
+	def wrf_holds(self, jobSub):
+		outDir = self.aSet.fetch("rundir") + "/output"
+		return [{"watchFile": outDir + "/rsl.out.0000", "contains": "SUCCESS COMPLETE WRF", "retCode": 1},
+				{"watchFile": outDir + "/rsl.error.0000", "contains": "FATAL CALLED", "tail": 3, "retCode": 2},
+				{"watchFile": outDir + "/rsl.error.0000", "contains": "fatal", "tail": 1, "retCode": 2},
+				{"watchFile": outDir + "/rsl.error.0000", "contains": "runtime", "tail": 1, "retCode": 2},
+				{"watchFile": outDir + "/rsl.error.0000", "contains": "error", "tail": 1, "retCode": 2},] + job_exited(jobSub, 3)
+
+	# collect_wrf_logs: Keep the rank 0 logs of a completed wrf.exe run as wrf_log.txt and wrf_error_log.txt, and remove the others
+	def collect_wrf_logs(self):
+		runDir = self.aSet.fetch("rundir")
+		self.fileOps.move([runDir + "/output/rsl.out.0000"], runDir + "/wrf_log.txt")
+		self.fileOps.move([runDir + "/output/rsl.error.0000"], runDir + "/wrf_error_log.txt")
+		self.fileOps.remove([runDir + "/output/rsl.out.*", runDir + "/output/rsl.error.*"])
+
 class Postprocessing_Steps:
 	aSet = None
 	modelParms = None
 	logger = None
 	startTime = ""
 	wrfDir = ""
+	fileOps = None
 
 	def __init__(self, settings, modelParms):
 		self.aSet = settings
 		self.logger = Tools.loggedPrint.instance()
+		self.fileOps = FileOps.FileOps(settings)
 		self.modelParms = modelParms
 		self.wrfDir = settings.fetch("wrfdir")
 		self.startTime = settings.fetch("starttime")
-		self.postDir = self.wrfDir + '/' + self.startTime[0:8] + "/postprd/"
+		self.postDir = self.aSet.fetch("rundir") + "/postprd/"
 		
 	# This method is mainly used for UPP post-processing as it requires some links to be established prior to running a Unipost.exe job. Python is skipped
+	@Metrics.timed("post prepare")
 	def prepare_postprocessing(self):
 		Tools.Process.instance().Lock()
 		if(self.aSet.fetch("post_run_unipost") == '1'):
 			self.logger.write("  5.a. UPP Flagged Active")
-			uppDir = self.aSet.fetch("headdir") + "post/UPP/"
-			if(self.aSet.fetch("unipost_out") == "grib"):
-				Tools.popen(self.aSet, "ln -fs " + uppDir + "parm/wrf_cntrl.parm " + self.postDir + "wrf_cntrl.parm")
-			elif(self.aSet.fetch("unipost_out") == "grib2"):
-				Tools.popen(self.aSet, "ln -fs " + uppDir + "parm/postcntrl.xml " + self.postDir + "postcntrl.xml")
-				Tools.popen(self.aSet, "ln -fs " + uppDir + "parm/postxconfig-NT.txt " + self.postDir + "postxconfig-NT.txt")
-				Tools.popen(self.aSet, "ln -fs " + uppDir + "parm/post_avblflds.xml " + self.postDir + "post_avblflds.xml")
-				Tools.popen(self.aSet, "ln -fs " + uppDir + "parm/params_grib2_tbl_new " + self.postDir + "params_grib2_tbl_new")
-			else:
+			if not self.aSet.fetch("unipost_out") in ("grib", "grib2"):
 				self.logger.write("  5.a. Error: Neither GRIB or GRIB2 is defined for UPP output processing, please modify control.txt, aborting")
 				Tools.Process.instance().Unlock()
 				return False
-			Tools.popen(self.aSet, "cp " + self.aSet.fetch("uppexecutables") + "unipost.exe " + self.postDir)
-			Tools.popen(self.aSet, "ln -sf " + uppDir + "scripts/cbar.gs " + self.postDir)
-			Tools.popen(self.aSet, "ln -fs " + uppDir + "parm/nam_micro_lookup.dat " + self.postDir)
-			Tools.popen(self.aSet, "ln -fs " + uppDir + "parm/hires_micro_lookup.dat " + self.postDir)
-			Tools.popen(self.aSet, "ln -fs " + uppDir + "includes/*.bin " + self.postDir)
+			self.fileOps.link(self.upp_links(), self.postDir)
+			self.fileOps.copy([self.aSet.fetch("uppexecutables") + "unipost.exe"], self.postDir)
 			self.logger.write("  5.a. Done")
 			Tools.Process.instance().Unlock()
 			return True
@@ -284,107 +531,199 @@ class Postprocessing_Steps:
 			Tools.Process.instance().Unlock()
 			return False
 			
-	def run_postprocessing(self):
+	# upp_links: The UPP parameter, lookup and script files linked into the directory unipost.exe runs in
+	def upp_links(self):
+		uppDir = self.aSet.fetch("headdir") + "post/UPP/"
+		links = []
+		if(self.aSet.fetch("unipost_out") == "grib"):
+			links += [uppDir + "parm/wrf_cntrl.parm"]
+		elif(self.aSet.fetch("unipost_out") == "grib2"):
+			links += [uppDir + "parm/postcntrl.xml", uppDir + "parm/postxconfig-NT.txt", uppDir + "parm/post_avblflds.xml", uppDir + "parm/params_grib2_tbl_new"]
+		links += [uppDir + "scripts/cbar.gs", uppDir + "parm/nam_micro_lookup.dat", uppDir + "parm/hires_micro_lookup.dat", uppDir + "includes/*.bin"]
+		return links
+
+	# upp_itag: The job file lines that write the itag file read by unipost.exe for one wrfout file (wrfout_dNN_YYYY-MM-DD_HH:MM:SS)
+	def upp_itag(self, iFile):
+		year = iFile[-19:-15]
+		month = iFile[-14:-12]
+		day = iFile[-11:-9]
+		hour = iFile[-8:-6]
+		minute = iFile[-5:-3]
+		second = iFile[-2:]
+		if(self.aSet.fetch("unipost_out") == "grib"):
+			return "cat > itag <<EOF\n" + iFile + '\n' + "netcdf\n" + str(year) + "-" + str(month) + "-" + str(day) + "_" + str(hour) + ":" + str(minute) + ":" + str(second) + '\n' + "NCAR\nEOF"
+		elif(self.aSet.fetch("unipost_out") == "grib2"):
+			return "cat > itag <<EOF\n" + iFile + '\n' + "netcdf\n" + "grib2\n" + str(year) + "-" + str(month) + "-" + str(day) + "_"  + str(hour) + ":" + str(minute) + ":" + str(second) + '\n' + "NCAR\nEOF"
+		#You should never end up here...
+		sys.exit("  5.b. Error: grib/grib2 not defined in control.txt")
+
+	# run_postprocessing: Runs the selected post-processing, with incremental (IncrementalPost) only the frames left when wrf.exe ended are run
+	@Metrics.timed("post")
+	def run_postprocessing(self, incremental = None):
+		if(incremental != None):
+			return self.finish_incremental(incremental)
 		if(self.aSet.fetch("post_run_unipost") == '1'):
 			return self.run_postprocessing_upp()
 		elif(self.aSet.fetch("post_run_python") == '1'):
-			post = PreparePyJob.PreparePyJob(self.aSet, self.wrfDir + '/' + self.startTime[0:8] + "/output", self.postDir)
+			post = PreparePyJob.PreparePyJob(self.aSet, self.aSet.fetch("rundir") + "/output", self.postDir)
 			return post.prepare_job()
 		else:
 			sys.exit("Error: run_postprocessing() called without a mode flagged, abort.")
 			return False
 		
-	def run_postprocessing_upp(self):
-		# Unipost needs to be run across multiple jobs that are broken up 24 hours of forecast per job.
-		#  this is done to prevent the job time limit from expiring while UPP is running.
+	def finish_incremental(self, incremental):
 		Tools.Process.instance().Lock()
-		curDir = os.path.dirname(os.path.abspath(__file__)) 
-		uppDir = self.aSet.fetch("headdir") + "post/UPP/"
-		fList = sorted(glob.glob(self.wrfDir + '/' + self.startTime[0:8] + "/output/wrfout*"))
-		fileCount = len(fList)
-		fLogs = []
-		upp_job_contents = ""
-		self.logger.write("  5.b. Running UPP on " + str(fileCount) + " wrfout files")
-		
-		upp_job_contents += "#!/bin/bash\n"
-		
-		upp_job_contents += "#PBS -l nodes=" + settings.fetch("num_upp_nodes") + ":ppn=" + settings.fetch("num_upp_processors") + "\n"
+		self.logger.write("  5.b. Finishing incremental post-processing")
+		fileCount = incremental.finish()
+		if(fileCount < 0):
+			self.logger.write("  5.b. Error: Incremental post-processing failed, see " + self.postDir + "incremental_post.txt")
+			Tools.Process.instance().Unlock()
+			return False
+		if(self.aSet.fetch("post_run_unipost") == '1'):
+			self.grib_to_ctl(fileCount)
+		self.logger.write("  5.b. Incremental post-processing completed (" + str(fileCount) + " frames).")
+		Tools.Process.instance().Unlock()
+		return True
+
+	# upp_slots: The number of unipost.exe tasks run at the same time and the nodes given to each (num_upp_nodes / upp_ensemble_nodes_per_hour)
+	def upp_slots(self):
+		nodes = int(self.aSet.fetch("num_upp_nodes"))
+		perTask = int(self.aSet.fetch("upp_ensemble_nodes_per_hour")) if self.aSet.fetch("upp_ensemble_nodes_per_hour") != None else nodes
+		perTask = max(1, min(perTask, nodes))
+		return max(1, nodes // perTask), perTask
+
+	# upp_task: The job file lines that run unipost.exe on one wrfout file in its own working directory (Each task needs its own itag and
+	#  fort.* files), the WRFPRS output is moved to postprd and "<wrfout name> done" or "<wrfout name> failed" is appended to progressFile.
+	#  machineFile, if given, limits mpirun to the task's share of the job's nodes.
+	def upp_task(self, iFile, workDir, ranks, progressFile, machineFile = None):
+		name = os.path.basename(iFile)
+		out = "mkdir -p " + workDir + "\n"
+		out += "cd " + workDir + "\n"
+		for link in self.upp_links():
+			out += "ln -sf " + link + " .\n"
+		out += "ln -sf " + self.postDir + "unipost.exe .\n"
+		out += self.upp_itag(iFile) + "\n"
+		out += "rm -f fort.*\n"
+		if(self.aSet.fetch("unipost_out") == "grib"):
+			out += "ln -sf wrf_cntrl.parm fort.14\n"
+		out += "if mpirun -np " + str(ranks) + (" -machinefile " + machineFile if machineFile != None else "") + " unipost.exe > unipost.log 2>&1 && mv WRFPRS* " + self.postDir + "; then\n"
+		out += "  echo \"" + name + " done\" >> " + progressFile + "\n"
+		out += "else\n"
+		out += "  echo \"" + name + " failed\" >> " + progressFile + "\n"
+		out += "fi\n"
+		return out
+
+	# upp_job: The upp.job script running unipost.exe on each of the files in fList, see run_postprocessing_upp()
+	def upp_job(self, fList):
+		slots, nodesPerTask = self.upp_slots()
+		ppn = int(self.aSet.fetch("num_upp_processors"))
+		progressFile = self.postDir + "upp_progress.txt"
+		upp_job_contents = "#!/bin/bash\n"
+		upp_job_contents += "#PBS -l nodes=" + self.aSet.fetch("num_upp_nodes") + ":ppn=" + self.aSet.fetch("num_upp_processors") + "\n"
 		upp_job_contents += "#PBS -N WRF_UPP" + "\n"
-		upp_job_contents += "#PBS -l walltime=" + settings.fetch("upp_walltime") + "\n"
+		upp_job_contents += "#PBS -l walltime=" + self.aSet.fetch("upp_walltime") + "\n"
 		upp_job_contents += "#PBS -A climlab" + "\n\n"
 		upp_job_contents += "source " + self.aSet.fetch("sourcefile") + "\n"
 		upp_job_contents += "ulimit -s unlimited\n\n"
-		upp_job_contents += "cd " + self.aSet.fetch("wrfdir") + '/' + self.aSet.fetch("starttime")[0:8] + "/postprd" + "\n\n"		
+		upp_job_contents += "cd " + self.postDir + "\n"
+		upp_job_contents += "rm -f " + progressFile + "\n"
+		upp_job_contents += "sort -u $PBS_NODEFILE > upp_nodes.txt\n"
+		for slot in range(slots):
+			upp_job_contents += "sed -n '" + str(slot * nodesPerTask + 1) + "," + str((slot + 1) * nodesPerTask) + "p' upp_nodes.txt | awk '{for(i=0;i<" + str(ppn) + ";i++) print}' > upp_machinefile." + str(slot) + "\n"
+		upp_job_contents += "\n"
+		for slot in range(slots):
+			upp_job_contents += "(\n"
+			for iFile in fList[slot::slots]:
+				upp_job_contents += self.upp_task(iFile, self.postDir + "upp_" + os.path.basename(iFile)[11:], nodesPerTask * ppn, progressFile, self.postDir + "upp_machinefile." + str(slot))
+			upp_job_contents += ") &\n\n"
+		upp_job_contents += "wait\n"
+		upp_job_contents += "echo \"Job Complete\" >> " + progressFile + "\n"
+		return upp_job_contents
+
+	# run_postprocessing_upp: Runs unipost.exe on every wrfout file in one job. The job's nodes are split into slots of
+	#  upp_ensemble_nodes_per_hour nodes, each slot has its own machinefile cut from $PBS_NODEFILE and works through its share of the
+	#  files one at a time, every file in its own postprd/upp_<date> directory. Completion is tracked per file in postprd/upp_progress.txt.
+	def run_postprocessing_upp(self):
+		Tools.Process.instance().Lock()
+		fList = sorted(glob.glob(self.aSet.fetch("rundir") + "/output/wrfout*"))
+		fileCount = len(fList)
+		if(fileCount <= 0):
+			self.logger.write("  5.b. Error: No wrfout files found, nothing to post-process.")
+			Tools.Process.instance().Unlock()
+			return False
+		validate = Validate.Validate(self.aSet, self.modelParms)
+		if(not validate.check(validate.wrfout_jobs(fList), "wrfout files")):
+			self.logger.write("  5.b. Error: Truncated or invalid wrfout files, not submitting UPP.")
+			Tools.Process.instance().Unlock()
+			return False
+		slots, nodesPerTask = self.upp_slots()
+		progressFile = self.postDir + "upp_progress.txt"
+		self.logger.write("  5.b. Running UPP on " + str(fileCount) + " wrfout files, " + str(slots) + " at a time on " + str(nodesPerTask) + " node(s) each")
+		upp_job_contents = self.upp_job(fList)
 		
 		with Tools.cd(self.postDir):
-			for iFile in fList:
-				dNum = iFile[-23:-20]
-				year = iFile[-19:-15]
-				month = iFile[-14:-12]
-				day = iFile[-11:-9]
-				hour = iFile[-8:-6]
-				minute = iFile[-5:-3]
-				second = iFile[-2:]
-				logName = "unipost_log_" + dNum + "_" + year + "_" + month + "_" + day + "_" + hour + ":" + minute + ":" + second + ".log"
-				fLogs.append(logName)
-				catCMD = ""
-				if(self.aSet.fetch("unipost_out") == "grib"):
-					catCMD = "cat > itag <<EOF\n" + iFile + '\n' + "netcdf\n" + str(year) + "-" + str(month) + "-" + str(day) + "_" + str(hour) + ":" + str(minute) + ":" + str(second) + '\n' + "NCAR\nEOF"
-				elif(self.aSet.fetch("unipost_out") == "grib2"):
-					catCMD = "cat > itag <<EOF\n" + iFile + '\n' + "netcdf\n" + "grib2\n" + str(year) + "-" + str(month) + "-" + str(day) + "_"  + str(hour) + ":" + str(minute) + ":" + str(second) + '\n' + "NCAR\nEOF"					
-				else:
-					#You should never end up here...
-					sys.exit("  5.b. Error: grib/grib2 not defined in control.txt")
-				upp_job_contents += catCMD
-				upp_job_contents += '\n' + "rm fort.*"
-				if(self.aSet.fetch("unipost_out") == "grib"):
-					upp_job_contents += "\nln -sf " + uppDir + "parm/wrf_cntrl.parm fort.14"
-				
-				aprun = "mpirun -np " + str(int(settings.fetch("num_upp_nodes")) * int(settings.fetch("num_upp_processors"))) + " unipost.exe > " + logName + " &\n"
-				aprun += "sleep 5\n"
-				upp_job_contents += "\n" + aprun + '\n\n'
-				
-				aprun = ""
-
-			upp_job_contents += "wait\necho \"Job Complete\""
 			with open("upp.job", 'w') as target_file:
 				target_file.write(upp_job_contents)
-			Tools.popen(self.aSet, "chmod +x upp.job")
+			self.fileOps.chmod_x(["upp.job"])
+			# The job clears upp_progress.txt when it starts, but "Job Complete" of an earlier run must not end the hold while it is queued
+			self.fileOps.remove(["upp_progress.txt"])
 			self.logger.write("   -> Submitting upp job to the queue")
 			jobSub = Tools.popen(self.aSet, "qsub upp.job")
-			self.logger.write("   -> Job file submitted, wait for " + jobSub.fetch()[0].rstrip("\n\r") + ".output")
-			# Wait for all logs to flag as job complete
+			if(self.aSet.fetch("debugmode") == '1'):
+				Tools.Process.instance().Unlock()
+				return True
+			# Follow the per-file progress until the job reports that every slot is done
+			def progress(newText):
+				for line in newText["upp_progress.txt"].splitlines():
+					self.logger.write("   -> UPP: " + line)
 			try:
-				wCond = [{"waitCommand": "tail -n 2 " + jobSub.fetch()[0].rstrip("\n\r") + ".output", "contains": "Job Complete", "retCode": 1},]
-				waitCond = Wait.Wait(wCond, timeDelay = 60)
+				wCond = [{"watchFile": "upp_progress.txt", "contains": "Job Complete", "retCode": 1},] + job_exited(jobSub, 2)
+				waitCond = Wait.Wait(wCond, timeDelay = 60, onNewText = progress, name = "upp")
 				wRC = waitCond.hold()			
-				if wRC == 1:
+				if wRC == 2:
+					self.logger.write("  5.b. Error: UPP " + job_exit_text(jobSub) + " before reporting completion.")
 					Tools.Process.instance().Unlock()
+					return False
 			except Wait.TimeExpiredException:
 				sys.exit("unipost.exe job not completed, abort.")
 			self.logger.write("   -> Unipost Job Completed, Verifying files.")
-			# Run a quick ls -l test to ensure the number of files present matches what we're expecting
-			fCountTest = Tools.popen(self.aSet, "ls -l WRFPRS*")
-			cmdTxt = fCountTest.fetch()
-			strCount = fCountTest[fCountTest.rfind('F'):]
-			self.logger.write("  5.b. All UPP jobs completed (F" + int(strCount) + " found).")
-			if(not (int(strCount)) == (fileCount - 1)):
-				self.logger.write("  5.b. Error: Number of expected files (" + fileCount + ") does not match actual count (" + int(strCount) + 1 + ").")
+			with open("upp_progress.txt") as f:
+				finished = [line.split()[0] for line in f if line.rstrip().endswith(" done")]
+			missing = [os.path.basename(iFile) for iFile in fList if not os.path.basename(iFile) in finished]
+			if missing:
+				self.logger.write("  5.b. Error: unipost.exe failed for " + str(len(missing)) + " of " + str(fileCount) + " files: " + ", ".join(missing))
 				Tools.Process.instance().Unlock()
 				return False
+			self.logger.write("  5.b. All UPP tasks completed (" + str(len(glob.glob(self.postDir + "WRFPRS*"))) + " WRFPRS files found).")
 			# Now that we have our PRS files, we can convert those to CTL files
-			self.logger.write("  5.b. Running GRIB to CTL process.")
-			if(self.aSet.fetch("unipost_out") == "grib"):
-				for fHour in range(0, fileCount):
-					fStr = "0" + str(fHour) if fHour < 10 else str(fHour)
-					inFile = "WRFPRS.GrbF" + fStr
-					Tools.popen(self.aSet, uppDir + "scripts/grib2ctl.pl " + self.postDir + '/' + inFile + " > " + self.postDir + "/wrfprs_f" + fStr + ".ctl")
-			elif(self.aSet.fetch("unipost_out") == "grib2"):
-				for fHour in range(0, fileCount):
-					fStr = "0" + str(fHour) if fHour < 10 else str(fHour)
-					inFile = "WRFPRS.GrbF" + fStr
-					Tools.popen(self.aSet, uppDir + "scripts/g2ctl.pl " + self.postDir + '/' + inFile + " > " + self.postDir + "/wrfprs_f" + fStr + ".ctl")
-			#To-Do Note: Fork off to GrADS here...
-			self.logger.write("  5.b. GRIB to CTL processes completed.")
+			self.grib_to_ctl(fileCount)
 			Tools.Process.instance().Unlock()
-			return True
\ No newline at end of file
+			return True
+
+	# grib_to_ctl: Write a GrADS control file for each WRFPRS.GrbF<hour> file in the postprd directory. GRIB2 files are indexed from their
+	#  section headers by GribIndex on a process pool (Indexes are cached while a file is unchanged), along with one template control
+	#  file (wrfprs.ctl) covering every hour. GRIB1 files still go through grib2ctl.pl.
+	@Metrics.timed("grib to ctl")
+	def grib_to_ctl(self, fileCount):
+		uppDir = self.aSet.fetch("headdir") + "post/UPP/"
+		self.logger.write("  5.b. Running GRIB to CTL process.")
+		fList = sorted(glob.glob(self.postDir + "WRFPRS.GrbF*[0-9]"), key = lambda path: int(path.split("GrbF")[-1]))
+		if(len(fList) != fileCount):
+			self.logger.write("  5.b. Warning: Expected " + str(fileCount) + " WRFPRS files, found " + str(len(fList)))
+		if(self.aSet.fetch("unipost_out") == "grib"):
+			for inFile in fList:
+				fStr = inFile.split("GrbF")[-1]
+				Tools.popen(self.aSet, uppDir + "scripts/grib2ctl.pl " + inFile + " > " + self.postDir + "wrfprs_f" + fStr + ".ctl")
+		elif(self.aSet.fetch("unipost_out") == "grib2"):
+			if(self.aSet.fetch("debugmode") == '1'):
+				print("D: GribIndex " + str(len(fList)) + " files in " + self.postDir)
+			else:
+				indexer = GribIndex.GribIndex(self.aSet)
+				failed = indexer.write_controls([(inFile, self.postDir + "wrfprs_f" + inFile.split("GrbF")[-1] + ".ctl") for inFile in fList])
+				if failed:
+					self.logger.write("  5.b. Warning: No control file written for " + str(len(failed)) + " of " + str(len(fList)) + " files")
+				# UPP pads the forecast hour to two digits, as does the GrADS %f2 template
+				if(indexer.write_template([inFile for inFile in fList if not inFile in failed], "WRFPRS.GrbF%f2", self.postDir + "wrfprs.ctl")):
+					self.logger.write("   -> Template control file written to " + self.postDir + "wrfprs.ctl")
+		#To-Do Note: Fork off to GrADS here...
+		self.logger.write("  5.b. GRIB to CTL processes completed.")
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+# LogWatcher.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes used to follow log files in-process, reading only the bytes appended since the last poll
+
+import os
+import glob
+import select
+import time
+import ctypes
+import ctypes.util
+
+# Inotify constants (See inotify(7))
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# The number of complete lines kept for each watched file, the longest tail a hold can test (See LogWatcher.tail())
+TAIL_LINES = 10
+
+# Inotify: Small ctypes wrapper around the kernel inotify interface, used to wake the watcher as soon as a watched directory changes.
+#  Note: inotify only sees writes made by this host, files written by compute nodes on a shared filesystem are still caught by the poll timeout.
+class Inotify:
+	fd = -1
+	libc = None
+	watches = {}
+
+	def __init__(self):
+		self.fd = -1
+		self.watches = {}
+		try:
+			self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+			self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		except (OSError, AttributeError, TypeError):
+			self.fd = -1
+
+	def available(self):
+		return self.fd >= 0
+
+	def watch(self, directory):
+		if not self.available() or directory in self.watches:
+			return
+		wd = self.libc.inotify_add_watch(self.fd, directory.encode(), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+		if(wd >= 0):
+			self.watches[directory] = wd
+
+	def fileno(self):
+		return self.fd
+
+	# wait: Block for up to timeout seconds, returns True if the kernel flagged a change in a watched directory
+	def wait(self, timeout):
+		if not self.available() or not self.watches:
+			return False
+		ready, _, _ = select.select([self.fd], [], [], timeout)
+		if not ready:
+			return False
+		self.drain()
+		return True
+
+	# drain: Clear any pending events, we only care that something changed, not what changed
+	def drain(self):
+		while True:
+			try:
+				if not os.read(self.fd, 4096):
+					return
+			except (BlockingIOError, InterruptedError):
+				return
+			except OSError:
+				return
+
+	def close(self):
+		if(self.fd >= 0):
+			os.close(self.fd)
+		self.fd = -1
+		self.watches = {}
+
+# WatchedFile: An open handle on a single log file, tracks the read offset so each poll only returns the newly appended text
+class WatchedFile:
+	path = ""
+	handle = None
+	inode = None
+	offset = 0
+	pending = ""
+	lastLine = ""
+	lines = []
+
+	def __init__(self, path):
+		self.path = path
+		self.handle = None
+		self.inode = None
+		self.offset = 0
+		self.pending = ""
+		self.lastLine = ""
+		self.lines = []
+
+	def open(self):
+		try:
+			self.handle = open(self.path, "rb")
+		except (IOError, OSError):
+			self.handle = None
+			return False
+		self.inode = os.fstat(self.handle.fileno()).st_ino
+		self.offset = 0
+		self.pending = ""
+		self.lines = []
+		return True
+
+	# read: Returns the text appended to the file since the last call, re-opening the file if it was replaced or truncated
+	def read(self):
+		if self.handle is None and not self.open():
+			return ""
+		try:
+			st = os.stat(self.path)
+		except OSError:
+			st = None
+		if st is not None and st.st_ino != self.inode:
+			self.close()
+			if not self.open():
+				return ""
+		elif st is not None and st.st_size < self.offset:
+			self.handle.seek(0)
+			self.offset = 0
+			self.pending = ""
+			self.lines = []
+		self.handle.seek(self.offset)
+		data = self.handle.read()
+		if not data:
+			return ""
+		self.offset += len(data)
+		text = data.decode("utf-8", "replace")
+		# Hold any trailing partial line so conditions can still match once the rest of the line is written
+		combined = self.pending + text
+		cut = combined.rfind('\n')
+		if(cut >= 0):
+			lines = combined[:cut].split('\n')
+			if lines:
+				self.lastLine = lines[-1]
+			self.lines = (self.lines + lines)[-TAIL_LINES:]
+		self.pending = combined[cut + 1:]
+		return combined
+
+	def close(self):
+		if self.handle is not None:
+			self.handle.close()
+		self.handle = None
+
+# LogWatcher: Follows every file matching a set of glob patterns, keeping the handles open between polls
+class LogWatcher:
+	patterns = []
+	files = {}
+	notify = None
+	minDelay = 1.0
+
+	def __init__(self, patterns):
+		self.patterns = list(patterns)
+		self.files = {}
+		self.notify = Inotify()
+
+	def matches(self, pattern):
+		return sorted(glob.glob(pattern))
+
+	def exists(self, pattern):
+		return len(self.matches(pattern)) > 0
+
+	# poll: Read the new text from every watched file in one pass, returns {pattern: new text across all matching files}
+	def poll(self):
+		newText = {}
+		for pattern in self.patterns:
+			chunks = []
+			for path in self.matches(pattern):
+				if path not in self.files:
+					self.files[path] = WatchedFile(path)
+				text = self.files[path].read()
+				if text:
+					chunks.append(text)
+			newText[pattern] = "".join(chunks)
+		return newText
+
+	# lastLine: The final complete line of the most recently matched file for a pattern (Mirrors "tail -n 1")
+	def lastLine(self, pattern):
+		paths = self.matches(pattern)
+		if not paths or paths[-1] not in self.files:
+			return ""
+		wFile = self.files[paths[-1]]
+		return wFile.pending if wFile.pending else wFile.lastLine
+
+	# tail: The last count lines of every matched file read so far (Mirrors "tail -n <count>"), a trailing partial line counts as one
+	def tail(self, pattern, count):
+		tails = []
+		for path in self.matches(pattern):
+			if path in self.files:
+				wFile = self.files[path]
+				lines = wFile.lines + ([wFile.pending] if wFile.pending else [])
+				tails.append("\n".join(lines[-count:]))
+		return "\n".join(tails)
+
+	# sleep: Wait until either a watched directory changes or the timeout expires
+	def sleep(self, timeout):
+		for pattern in self.patterns:
+			directory = os.path.dirname(os.path.abspath(pattern))
+			if os.path.isdir(directory):
+				self.notify.watch(directory)
+		if(self.notify.available() and self.notify.watches):
+			# Rate limit wake-ups so a file being rewritten constantly cannot spin the poll loop
+			if self.notify.wait(timeout):
+				time.sleep(min(self.minDelay, timeout))
+		else:
+			time.sleep(timeout)
+
+	def close(self):
+		for wFile in self.files.values():
+			wFile.close()
+		self.files = {}
+		self.notify.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# Logging.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains the program logger, records are queued to a background thread that writes them to the run's log file in batches
+
+import os
+import re
+import json
+import queue
+import atexit
+import datetime
+import threading
+
+# Messages starting with a step number (IE: "  4.b. Running pre-processing executables") set the current step
+STEP_PATTERN = re.compile(r"^\s*(\d+(?:\.[a-z0-9]+)*)\.?\s")
+
+# make_run_id: A run ID unique to this process, IE: 20190526-001500-12345-a1b2
+def make_run_id():
+	return datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid()) + "-" + os.urandom(2).hex()
+
+# Logger: Writes each record as one JSON line (ts, run, step, level, msg and any extra fields) to wrf_run_script_<run ID>.log in the
+#  scripts directory and prints the message (Except debug records). Records are queued and written by a background thread that keeps the file open and
+#  flushes once per batch (Every flushInterval seconds, or sooner once batchSize records are waiting). close() and program exit drain the queue.
+#  Access through Logger.instance() (Or Tools.loggedPrint.instance()).
+class Logger:
+	_instance = None
+	runID = ""
+	filePath = ""
+	step = ""
+	flushInterval = 1.0
+	batchSize = 500
+	records = None
+	writer = None
+	lock = None
+
+	def __init__(self):
+		self.runID = make_run_id()
+		self.filePath = os.path.dirname(os.path.abspath(__file__)) + "/wrf_run_script_" + self.runID + ".log"
+		self.step = ""
+		self.records = queue.Queue()
+		self.writer = None
+		self.lock = threading.Lock()
+		atexit.register(self.close)
+
+	@classmethod
+	def instance(cls):
+		if cls._instance is None:
+			cls._instance = cls()
+		return cls._instance
+
+	# set_step: Set the step attached to the following records, steps are also picked up from numbered messages
+	def set_step(self, step):
+		self.step = step
+
+	# write: Log a message, level is info, warning, error or debug. fields is an optional dictionary of extra values for the record
+	def write(self, out, level = "info", fields = None):
+		out = str(out)
+		match = STEP_PATTERN.match(out)
+		if match:
+			self.step = match.group(1)
+		record = {"ts": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"), "run": self.runID, "step": self.step, "level": level, "msg": out}
+		if fields != None:
+			record.update(fields)
+		with self.lock:
+			self.start()
+			self.records.put(record)
+		if(level != "debug"):
+			print(out)
+
+	# start: Start the writer thread if it is not running, called with the lock held
+	def start(self):
+		if self.writer is None:
+			self.writer = threading.Thread(target = self.run, args = (self.records,), name = "Logger")
+			self.writer.daemon = True
+			self.writer.start()
+
+	# run: The writer thread, collects the waiting records and writes them in one go. A None record ends the thread
+	def run(self, records):
+		handle = open(self.filePath, "a")
+		try:
+			running = True
+			while running:
+				batch = []
+				try:
+					batch.append(records.get(timeout = self.flushInterval))
+					while len(batch) < self.batchSize:
+						batch.append(records.get_nowait())
+				except queue.Empty:
+					pass
+				if None in batch:
+					batch = [r for r in batch if r != None]
+					running = False
+				if batch:
+					handle.write("".join(json.dumps(r, default = str) + '\n' for r in batch))
+					handle.flush()
+		finally:
+			handle.close()
+
+	# close: Write every queued record and stop the writer thread, a later write() starts a new one on a new queue
+	def close(self):
+		with self.lock:
+			writer = self.writer
+			if writer is None:
+				return
+			self.records.put(None)
+			self.writer = None
+			self.records = queue.Queue()
+		writer.join()
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# Metrics.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes and methods used to time the program steps and export the timings of each run
+
+import os
+import json
+import atexit
+import datetime
+import functools
+import threading
+import Tools
+import JobTracker
+
+def seconds_between(start, end):
+	return max(0.0, (end - start).total_seconds())
+
+# overlap: The seconds of [start, end] that fall inside [spanStart, spanEnd]
+def overlap(start, end, spanStart, spanEnd):
+	if start is None or end is None:
+		return 0.0
+	return seconds_between(max(start, spanStart), min(end, spanEnd)) if end > spanStart and start < spanEnd else 0.0
+
+# job_times: Split the time of a job that falls inside a span into queue time (Submitted to started) and run time (Started to finished),
+#  from the JobTracker timestamps. A job still queued or running counts up to the span's end
+def job_times(job, spanStart, spanEnd):
+	started = job.started if job.started != None else spanEnd
+	finished = job.finished if job.finished != None else spanEnd
+	return overlap(job.submitted, started, spanStart, spanEnd), overlap(started, finished, spanStart, spanEnd)
+
+# Span: Context manager timing one step of the program. Nested spans record their parent. The jobs submitted during the span
+#  (Or the given jobIDs, IE: the jobs a Wait is holding on) have their time split into queue wait and run time
+class Span:
+	name = ""
+	parent = None
+	jobIDs = None
+	start = None
+	end = None
+	status = "ok"
+
+	def __init__(self, name, jobIDs = None):
+		self.name = name
+		self.jobIDs = jobIDs
+		self.parent = None
+		self.start = None
+		self.end = None
+		self.status = "ok"
+
+	def __enter__(self):
+		metrics = Metrics.instance()
+		stack = metrics.thread_stack()
+		self.parent = stack[-1].name if stack else None
+		self.start = datetime.datetime.utcnow()
+		stack.append(self)
+		return self
+
+	def __exit__(self, etype, value, traceback):
+		self.end = datetime.datetime.utcnow()
+		if etype != None:
+			self.status = "exit" if issubclass(etype, SystemExit) else "error"
+		metrics = Metrics.instance()
+		stack = metrics.thread_stack()
+		if self in stack:
+			stack.remove(self)
+		metrics.add(self)
+		return False
+
+	# fail: Mark the span as failed without raising (IE: The step returned False)
+	def fail(self):
+		self.status = "failed"
+
+	def jobs(self):
+		tracker = JobTracker.JobTracker.instance()
+		if self.jobIDs != None:
+			return [job for job in (tracker.fetch(jobID) for jobID in self.jobIDs) if job != None]
+		return [job for job in tracker.all_jobs() if self.start <= job.submitted <= self.end]
+
+	def record(self):
+		queued = 0.0
+		running = 0.0
+		jobs = self.jobs()
+		for job in jobs:
+			q, r = job_times(job, self.start, self.end)
+			queued += q
+			running += r
+		return {"name": self.name, "parent": self.parent, "status": self.status,
+				"start": self.start.strftime("%Y-%m-%dT%H:%M:%SZ"), "end": self.end.strftime("%Y-%m-%dT%H:%M:%SZ"),
+				"seconds": seconds_between(self.start, self.end), "queue_seconds": queued, "run_seconds": running,
+				"jobs": [job.jobID for job in jobs]}
+
+# span: Shorthand for a Span, used as "with Metrics.span("cleanup"):"
+def span(name, jobIDs = None):
+	return Span(name, jobIDs)
+
+# timed: Decorator timing every call of a function as a span, a False return value marks the span as failed
+def timed(name):
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			with Span(name) as s:
+				result = function(*args, **kwargs)
+				if result is False:
+					s.fail()
+				return result
+		return wrapper
+	return decorator
+
+# Metrics: Singleton collecting the finished spans of the run. configure() is called once the settings are loaded, export() writes
+#  run_metrics.json to the run directory (Or the path given to export_to()) and, if metrics_textfile is set in control.txt, a
+#  Prometheus textfile-collector file.
+#  A run that exits before finish() is exported as failed. Spans close in several threads at once (See Pipeline), stacks and spans
+#  are only changed under the lock and read through a copy.
+@Tools.Singleton
+class Metrics:
+	aSet = None
+	stacks = {}
+	spans = []
+	started = None
+	status = None
+	exported = False
+	target = None
+	lock = None
+
+	def __init__(self):
+		self.aSet = None
+		self.stacks = {}
+		self.spans = []
+		self.started = datetime.datetime.utcnow()
+		self.status = None
+		self.exported = False
+		self.target = None
+		self.lock = threading.Lock()
+
+	def configure(self, settings):
+		self.aSet = settings
+		atexit.register(self.export)
+
+	# export_to: Write the run summary to path instead of the run directory (IE: A campaign, which has no run directory of its own)
+	def export_to(self, path):
+		self.target = path
+
+	# thread_stack: The open spans of the calling thread, steps run at the same time (See Pipeline) nest their spans separately
+	def thread_stack(self):
+		with self.lock:
+			return self.stacks.setdefault(threading.get_ident(), [])
+
+	def add(self, span):
+		record = span.record()
+		with self.lock:
+			self.spans.append(record)
+		Tools.loggedPrint.instance().write("Metrics: " + span.name + " took " + str(round(record["seconds"], 1)) + " s (" + span.status + ")",
+										   level = "debug", fields = {"span": record})
+
+	# all_spans: A copy of the finished spans
+	def all_spans(self):
+		with self.lock:
+			return list(self.spans)
+
+	# finish: Mark the run as complete and export its metrics
+	def finish(self, success = True):
+		self.status = "success" if success else "failed"
+		self.export()
+
+	# stages: Totals per span name, the top-level spans are the program steps
+	def stages(self):
+		totals = {}
+		for s in self.all_spans():
+			stage = totals.setdefault(s["name"], {"parent": s["parent"], "count": 0, "seconds": 0.0, "queue_seconds": 0.0, "run_seconds": 0.0})
+			stage["count"] += 1
+			for key in ["seconds", "queue_seconds", "run_seconds"]:
+				stage[key] += s[key]
+		return totals
+
+	def summary(self):
+		finished = datetime.datetime.utcnow()
+		return {"run": Tools.loggedPrint.instance().runID, "starttime": self.aSet.fetch("starttime"), "status": self.status if self.status != None else "failed",
+				"started": self.started.strftime("%Y-%m-%dT%H:%M:%SZ"), "finished": finished.strftime("%Y-%m-%dT%H:%M:%SZ"),
+				"seconds": seconds_between(self.started, finished), "stages": self.stages(), "spans": self.all_spans()}
+
+	def prometheus(self, summary):
+		label = lambda name: "{stage=\"" + name.replace("\\", "\\\\").replace("\"", "\\\"") + "\"}"
+		stages = summary["stages"]
+		out = "# HELP wrf_run_seconds Wall time of the last run\n"
+		out += "# TYPE wrf_run_seconds gauge\n"
+		out += "wrf_run_seconds " + str(summary["seconds"]) + "\n"
+		out += "# HELP wrf_run_success 1 if the last run completed every step\n"
+		out += "# TYPE wrf_run_success gauge\n"
+		out += "wrf_run_success " + ("1" if summary["status"] == "success" else "0") + "\n"
+		out += "# HELP wrf_run_last_finished_timestamp_seconds Time the last run ended\n"
+		out += "# TYPE wrf_run_last_finished_timestamp_seconds gauge\n"
+		out += "wrf_run_last_finished_timestamp_seconds " + str((datetime.datetime.strptime(summary["finished"], "%Y-%m-%dT%H:%M:%SZ") - datetime.datetime(1970, 1, 1)).total_seconds()) + "\n"
+		for metric, key, text in [("wrf_run_stage_seconds", "seconds", "Wall time of each stage of the last run"),
+								  ("wrf_run_stage_queue_seconds", "queue_seconds", "Time the jobs of each stage spent queued"),
+								  ("wrf_run_stage_job_run_seconds", "run_seconds", "Time the jobs of each stage spent running")]:
+			out += "# HELP " + metric + " " + text + "\n"
+			out += "# TYPE " + metric + " gauge\n"
+			for name in sorted(stages):
+				out += metric + label(name) + " " + str(stages[name][key]) + "\n"
+		return out
+
+	# export: Write the run summary (Once per run), files are written to a temporary name and renamed so readers never see a partial file
+	def export(self):
+		if self.exported or self.aSet is None:
+			return
+		self.exported = True
+		summary = self.summary()
+		runDir = self.aSet.fetch("rundir")
+		target = runDir + "/run_metrics.json" if os.path.isdir(runDir) else self.aSet.fetch("headdir") + "run_metrics.json"
+		if(self.target != None):
+			target = self.target
+		try:
+			with open(target + ".tmp", 'w') as f:
+				json.dump(summary, f, indent = 1)
+			os.rename(target + ".tmp", target)
+			textFile = self.aSet.fetch("metrics_textfile")
+			if(textFile != None):
+				with open(textFile + ".tmp", 'w') as f:
+					f.write(self.prometheus(summary))
+				os.rename(textFile + ".tmp", textFile)
+		except (IOError, OSError) as e:
+			Tools.loggedPrint.instance().write("Metrics: Failed to export the run metrics: " + str(e), level = "warning")
+			return
+		Tools.loggedPrint.instance().write("Metrics: Run summary written to " + target + " (" + summary["status"] + ", " + str(round(summary["seconds"], 1)) + " s)")
@@ -8,9 +8,11 @@ import datetime
 import time
 import os
 import sys
-from multiprocessing.pool import ThreadPool
 import Tools
+import Downloader
+import DataCache
 import ApplicationSettings
+import Metrics
 
 # ModelDataParameters: Mini class instance that stores information about various WRF data
 class ModelDataParameters():
@@ -26,6 +28,7 @@ class ModelDataParameters():
 				"FGExt": "\'3D\', \'FLX\'",
 				"HourDelta": 6,
 				"ConstantsFile": "constant_file",
+				"InputFiles": ["3D_%Y%m%d%H.grb2", "flx_%Y%m%d%H.grb2"],
 				"CanDownloadDirectly": True,
 			},
 			"NARR": {
@@ -34,6 +37,7 @@ class ModelDataParameters():
 				"FGExt": "NARR",
 				"HourDelta": 3,
 				"ConstantsFile": "NARR.constants",
+				"InputFiles": ["merged_AWIP32.%Y%m%d%H"],
 				"CanDownloadDirectly": False,
 			},
 		}	
@@ -71,6 +75,7 @@ class ModelData():
 		logger.write("  -> Run Days: " + str(self.runDays))
 		logger.write("  -> Run Hours: " + str(self.runHours))
 		
+	@Metrics.timed("download")
 	def fetchFiles(self):
 		model = self.aSet.fetch("modeldata")
 		mParms = self.modelParms.fetch()
@@ -88,9 +93,33 @@ class ModelData():
 			if not os.path.isdir(dirPath):
 				os.system("mkdir " + dirPath)	
 				
-			t = ThreadPool(processes=6)
-			rs = t.map(self.pooled_download, dates)
-			t.close()
+			cache = None
+			if(self.aSet.fetch("use_data_cache") == '1'):
+				cache = DataCache.ModelDataCache(self.aSet)
+			tasks = []
+			keys = {}
+			hits = 0
+			for date in dates:
+				for task in self.download_tasks(date):
+					# Files already in the shared cache are linked into the run's data directory instead of being downloaded
+					if cache != None:
+						keys[task.dest] = cache.key(model, self.startTime, date, os.path.basename(task.dest))
+						if cache.link(keys[task.dest], dirPath, dirPath):
+							hits += 1
+							continue
+					tasks.append(task)
+			if cache != None:
+				logger.write("  - " + str(hits) + " model data files linked from the cache (" + cache.root + ").")
+			results = Downloader.Downloader(self.aSet).fetch(tasks)
+			failed = [r for r in results if not r.ok]
+			logger.write("  - " + str(len(results) - len(failed)) + " of " + str(len(results)) + " model data files are present (" + str(len([r for r in results if r.skipped])) + " already downloaded).")
+			if failed:
+				for r in failed:
+					logger.write("  - Error: Failed to download " + r.task.url + " (" + str(r.error) + ")")
+				sys.exit("")
+			if cache != None:
+				for r in results:
+					cache.store(keys[r.task.dest], {os.path.basename(r.task.dest): r.task.dest}, dirPath)
 		else:	
 			if not os.path.isdir(dirPath):
 				logger.write("  - Error: The selected data source does not support automatic downloading, and the data directory is not found.")
@@ -100,8 +129,10 @@ class ModelData():
 				logger.write("  - Error: Missing required input data to run WRF and the source does not allow automatic downloading, abort.")
 				sys.exit("")
 	
-	def pooled_download(self, timeObject):
+	# download_tasks: Returns the Downloader.DownloadTask list of files needed for a single forecast time
+	def download_tasks(self, timeObject):
 		model = self.aSet.fetch("modeldata")
+		tasks = []
 		if(model == "CFSv2"):
 			prs_lnk = "https://nomads.ncdc.noaa.gov/modeldata/cfsv2_forecast_6-hourly_9mon_pgbf/"
 			flx_lnk = "https://nomads.ncdc.noaa.gov/modeldata/cfsv2_forecast_6-hourly_9mon_flxf/"
@@ -111,10 +142,9 @@ class ModelData():
 			sgrb2link = flx_lnk + strTime[0:4] + '/' + strTime[0:6] + '/' + strTime[0:8] + '/' + strTime + "/flxf" + timeObject.strftime('%Y%m%d%H') + ".01." + strTime + ".grb2"
 			pgrb2writ = self.dataDir + '/' + strTime + "/3D_" + timeObject.strftime('%Y%m%d%H') + ".grb2"
 			sgrb2writ = self.dataDir + '/' + strTime + "/flx_" + timeObject.strftime('%Y%m%d%H') + ".grb2"
-			if not os.path.isfile(pgrb2writ):
-				os.system("wget " + pgrb2link + " -O " + pgrb2writ)
-			if not os.path.isfile(sgrb2writ):
-				os.system("wget " + sgrb2link + " -O " + sgrb2writ)	
+			tasks.append(Downloader.DownloadTask(pgrb2link, pgrb2writ, verify = Downloader.grib_complete))
+			tasks.append(Downloader.DownloadTask(sgrb2link, sgrb2writ, verify = Downloader.grib_complete))
+		return tasks
 				
 	def files_present(self, date_list):
 		logger = Tools.loggedPrint.instance()
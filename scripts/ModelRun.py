@@ -0,0 +1,432 @@
+#!/usr/bin/python
+# ModelRun.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains the class that runs the steps of one model run, used by Application.py for a single run and by Ensemble.py for each member
+
+import sys
+import os
+import ModelData
+import Cleanup
+import Template
+import Jobs
+import Tools
+import JobTracker
+import FileOps
+import PerfDB
+import PrerunJob
+import IncrementalPost
+import Metrics
+import RunState
+import Pipeline
+import Segments
+
+# ModelRun: The steps of one model run, in the order Application.py calls them. Each run holds its own settings (AppSettings), run
+#  directory and run state, so several runs can be prepared and tracked by the same program (See Ensemble)
+class ModelRun():
+	aSet = None
+	modelParms = None
+	mParms = None
+	logger = None
+	prc = None
+	state = None
+	runDir = ""
+	tWrite = None
+	jobs = None
+	incremental = None
+	segments = None
+	save_nproc_x = -1
+	save_nproc_y = -1
+
+	def __init__(self, settings, modelParms):
+		self.aSet = settings
+		self.modelParms = modelParms
+		self.mParms = modelParms.fetch()
+		self.logger = Tools.loggedPrint.instance()
+		self.prc = Cleanup.PostRunCleanup(settings)
+		self.runDir = settings.fetch("rundir")
+		self.state = RunState.RunState(settings)
+		self.tWrite = None
+		self.jobs = None
+		self.incremental = None
+		self.segments = None
+		self.save_nproc_x = -1
+		self.save_nproc_y = -1
+
+	# setup: Prepare the run directory and select the wrf.exe decomposition (Step 1)
+	def setup(self):
+		settings = self.aSet
+		logger = self.logger
+		state = self.state
+		runDir = self.runDir
+		prc = self.prc
+		if state.resuming():
+			# The files of the steps already done (And of any job still running) are kept
+			logger.write(" - Resuming the run in " + runDir + ": " + state.describe())
+		else:
+			prc.performClean(cleanAll = False, cleanOutFiles = True, cleanErrorFiles = True, cleanInFiles = True, cleanBdyFiles = False, cleanWRFOut = False, cleanModelData = False)
+		if(settings.fetch("run_prerunsteps") == '1'):
+			FileOps.FileOps(settings).mkdir([runDir, runDir + "/output", runDir + "/wrfout", runDir + "/postprd"])
+		else:
+			logger.write(" 1. run_prerunsteps is turned off, directories have not been created")
+		recommended = None
+		if(settings.fetch("wrf_auto_select") == '1'):
+			logger.write("  - Selecting the WRF job size from past runs of this domain")
+			objective = settings.fetch("wrf_auto_select_objective")
+			ranked = PerfDB.PerfDB(settings).recommend(settings, objective = objective if objective != None else "walltime")
+			if not ranked:
+				logger.write("   - No past runs of this domain and physics have been recorded, using the control.txt settings")
+			else:
+				recommended = ranked[0]
+				for c in ranked[0:3]:
+					logger.write("    > " + str(c["num_wrf_nodes"]) + "x" + str(c["num_wrf_processors"]) + " ranks, X: " + str(c["nproc_x"]) + ", Y: " + str(c["nproc_y"]) + 
+								 ", Tiles: " + str(c["wrf_numtiles"]) + ", I/O: " + str(c["wrf_nio_groups"]) + "x" + str(c["wrf_nio_tasks_per_group"]) + 
+								 " (" + str(c["samples"]) + " runs, " + str(round(c["wall_seconds"] / 3600.0, 2)) + " h, " + str(round(c["core_hours"], 1)) + " core-h)")
+				for key in ["num_wrf_nodes", "num_wrf_processors", "wrf_numtiles", "wrf_nio_groups", "wrf_nio_tasks_per_group"]:
+					settings.override(key, recommended[key])
+				settings.assembleKeys()
+				self.save_nproc_x = recommended["nproc_x"]
+				self.save_nproc_y = recommended["nproc_y"]
+		logger.write("  - Checking if WRF Node decomposition is required")
+		if(recommended != None):
+			logger.write("   - No, using the decomposition of the selected past run, X: " + str(self.save_nproc_x) + ", Y: " + str(self.save_nproc_y) + ".")
+		elif(settings.fetch("wrf_detect_proc_count") == '1'):
+			logger.write("   - Yes.")
+			ranked = Tools.rank_decompositions(int(settings.fetch("e_we")), 
+												int(settings.fetch("e_sn")), 
+												int(settings.fetch("num_wrf_nodes")), 
+												int(settings.fetch("num_wrf_processors")), 
+												int(settings.fetch("wrf_nio_groups")), 
+												int(settings.fetch("wrf_nio_tasks_per_group")))
+			if not ranked:
+				logger.write(" 1. Failed to find a decomposition given the input settings in control.txt, please adjust your settings")
+				sys.exit("")
+			for c in ranked[0:3]:
+				logger.write("    > Candidate X: " + str(c["nproc_x"]) + ", Y: " + str(c["nproc_y"]) + " (Patch " + str(c["patch_x"]) + "x" + str(c["patch_y"]) + 
+							 ", Halo " + str(round(c["halo"], 3)) + ", I/O Aligned: " + str(c["io_aligned"]) + ", Score " + str(round(c["score"], 3)) + ")")
+			self.save_nproc_x = ranked[0]["nproc_x"]
+			self.save_nproc_y = ranked[0]["nproc_y"]
+			logger.write("   - Found a viable decomposition, X: " + str(self.save_nproc_x) + ", Y: " + str(self.save_nproc_y) + ".")
+		else:
+			logger.write("   - No.")
+		logger.write(" 1. Done.")
+
+	# download: Fetch the model data (Step 2)
+	def download(self):
+		settings = self.aSet
+		logger = self.logger
+		state = self.state
+		#Step 2: Download Data Files
+		logger.write(" 2. Downloading Model Data Files")
+		modelData = ModelData.ModelData(settings, self.modelParms)
+		if(settings.fetch("run_prerunsteps") == '1'):
+			if state.valid("download"):
+				logger.write(" 2. Model data was downloaded by an earlier run, skipping")
+			else:
+				modelData.fetchFiles()
+				state.complete("download", [settings.fetch("datadir") + '/' + settings.fetch("modeldata") + '/' + settings.fetch("starttime") + "/*"])
+		else:
+			logger.write(" 2. run_prerunsteps is turned off, model data has not been downloaded")
+		logger.write(" 2. Done")
+
+	# write_files: Write the namelist and job files (Step 3)
+	def write_files(self):
+		settings = self.aSet
+		logger = self.logger
+		mParms = self.mParms
+		#Step 3: Generate run files
+		logger.write(" 3. Generating job files and creating templated files")
+		settings.add_replacementKey("[interval_seconds]", mParms["HourDelta"] * 60 * 60)
+		settings.add_replacementKey("[constants_name]", settings.fetch("constantsdir") + '/' + mParms["ConstantsFile"])
+		self.tWrite = Template.Template_Writer(settings)
+		tWrite = self.tWrite
+		if(settings.fetch("run_prerunsteps") == '1'):
+			i = 0
+			unresolved = []
+			for ext in mParms["FileExtentions"]:
+				unresolved += tWrite.generateTemplatedFile(settings.fetch("headdir") + "templates/namelist.wps.template", "namelist.wps." + ext, extraKeys = {"[ungrib_prefix]": ext, "[fg_name]": mParms["FGExt"]})
+				if(i == 0):
+					FileOps.FileOps(settings).copy(["namelist.wps." + ext], "namelist.wps.geogrid")
+				i += 1
+			if(settings.fetch("ungrib_parallel") == '1' or settings.fetch("pipeline_preprocessing") == '1'):
+				unresolved += PrerunJob.PrerunJob(settings, mParms).write_namelists(tWrite)
+			if(settings.fetch("pipeline_preprocessing") == '1'):
+				unresolved += PrerunJob.PrerunJob(settings, mParms).write_metgrid_namelists(tWrite)
+			# RF 10/19: real.exe requires nproc_x/nproc_y to be -1, update the settings
+			settings.add_replacementKey("[nproc_x]", str("-1"))
+			settings.add_replacementKey("[nproc_y]", str("-1"))
+			settings.add_replacementKey("[io_form_input]", str("11"))
+			settings.add_replacementKey("[io_form_boundary]", str("11"))			
+			unresolved += tWrite.generateTemplatedFile(settings.fetch("headdir") + "templates/namelist.input.template", "namelist.input")
+			if unresolved:
+				logger.write(" 3. Failed to generate namelist files, the following keys have no value: " + ", ".join(sorted(set(unresolved))))
+				sys.exit(" 3. ERROR: Unresolved template keys, check control.txt for missing or misspelled settings")
+		else:
+			logger.write(" 3. run_prerunsteps is turned off, template files have not been created")
+		if(self.write_job_files(settings, mParms) == False):
+			logger.write(" 3. Failed to generate job files... abort")
+			sys.exit("")
+		logger.write(" 3. Done")
+
+	# preprocess: Run geogrid and the pre-processing job (Steps 4.a and 4.b)
+	def preprocess(self):
+		self.geogrid()
+		self.prerun()
+
+	# geogrid: Stage the run files and run geogrid (Step 4.a)
+	def geogrid(self):
+		settings = self.aSet
+		logger = self.logger
+		state = self.state
+		runDir = self.runDir
+		#Step 4: Run the WRF steps
+		logger.write(" 4. Run WRF Steps")
+		self.jobs = Jobs.JobSteps(settings, self.modelParms, state)
+		jobs = self.jobs
+		logger.write("  4.a. Checking for geogrid flag...")
+		Tools.Process.instance().HoldUntilOpen(breakTime = 86400)
+		if(settings.fetch("run_geogrid") == '1' and state.valid("geogrid")):
+			logger.write("  4.a. geo_em files were written by an earlier run, skipping step")
+		elif(settings.fetch("run_geogrid") == '1'):
+			logger.write("  4.a. Geogrid flag is set, preparing geogrid job.")
+			if(jobs.run_geogrid() == False):
+				state.failed("geogrid")
+			else:
+				state.complete("geogrid", [runDir + "/output/geo_em.d0*"])
+			logger.write("  4.a. Geogrid job Done")
+		else:
+			logger.write("  4.a. Geogrid flag is not set, skipping step")
+		logger.write("  4.a. Done")
+
+	# prerun: Run the pre-processing job, ungrib.exe, metgrid.exe and real.exe (Step 4.b)
+	def prerun(self):
+		settings = self.aSet
+		logger = self.logger
+		state = self.state
+		runDir = self.runDir
+		jobs = self.jobs
+		logger.write("  4.b. Running pre-processing executables")
+		if(settings.fetch("use_io_vars") == '1'):
+			FileOps.FileOps(settings).copy([settings.fetch("headdir") + "io_vars/IO_VARS.txt"], settings.fetch("rundir") + "/output/IO_VARS.txt")
+		Tools.Process.instance().HoldUntilOpen(breakTime = 86400)
+		if(settings.fetch("run_preprocessing_jobs") == '1' and state.valid("preprocessing")):
+			logger.write("  4.b. wrfinput/wrfbdy files were written by an earlier run, skipping this step")
+		elif(settings.fetch("run_preprocessing_jobs") == '1'):
+			if(jobs.run_preprocessing() == False):
+				state.failed("preprocessing")
+				logger.write("   4.b. Error in pre-processing jobs")
+				logger.close()		
+				sys.exit("   4.b. ERROR: Pre-processing jobs failed, check error logs")
+			state.complete("preprocessing", [runDir + "/output/wrfinput_d0*", runDir + "/output/wrfbdy_d01"])
+		else:
+			logger.write("  4.b. run_preprocessing_jobs is turned off, skiping this step")
+		Tools.Process.instance().HoldUntilOpen(breakTime = 86400)
+		logger.write("  4.b. Done")
+
+	# prepare_wrf: Write the wrf.exe namelist and prepare incremental post-processing (Step 4.c)
+	def prepare_wrf(self):
+		settings = self.aSet
+		logger = self.logger
+		logger.write("  4.c. Running WRF Model")
+		self.write_wrf_namelist("namelist.input")
+		# Ensemble members submit their wrf.job together (See Ensemble), they are not split into segments
+		if(Segments.segmented(settings) and settings.fetch("ensemble_file") == None):
+			self.segments = Segments.Segments(settings, self.modelParms)
+			self.segments.write(self.tWrite)
+		logger.write("   4.c. > Starting wrf.exe job process")
+		if(settings.fetch("run_wrf") == '1' and settings.fetch("run_postprocessing") == '1' and settings.fetch("incremental_post") == '1'):
+			# Post-processing is prepared up front so each wrfout frame can be processed while wrf.exe runs
+			logger.write("   4.c. > Incremental post-processing is on, preparing post-processing")
+			post = Jobs.Postprocessing_Steps(settings, self.modelParms)
+			if(post.prepare_postprocessing() == False):
+				logger.close()
+				sys.exit("   4.c. ERROR: post-processing process failed to initialize, check error file.")
+			self.incremental = IncrementalPost.IncrementalPost(settings, post)
+
+	# write_wrf_namelist: Write the wrf.exe namelist.input to the output folder as fileName (See Chain for namelist.input.wrf)
+	def write_wrf_namelist(self, fileName):
+		settings = self.aSet
+		logger = self.logger
+		logger.write("   4.c. > Updating settings for nproc_x/nproc_y")
+		# RF 10/19: Now nuke the real.exe namelist file and load in the wrf settings, then run.
+		settings.add_replacementKey("[nproc_x]", str(self.save_nproc_x))
+		settings.add_replacementKey("[nproc_y]", str(self.save_nproc_y))
+		settings.add_replacementKey("[io_form_input]", str("2"))
+		settings.add_replacementKey("[io_form_boundary]", str("2"))
+		if self.tWrite.generateTemplatedFile(settings.fetch("headdir") + "templates/namelist.input.template", fileName):
+			logger.write("   4.c. Failed to generate namelist.input for wrf.exe")
+			sys.exit("   4.c. ERROR: Unresolved template keys in namelist.input, check control.txt")
+		FileOps.FileOps(settings).move([fileName], settings.fetch("rundir") + "/output/" + fileName)
+
+	# wrf: Run wrf.exe (Step 4.c)
+	def wrf(self):
+		settings = self.aSet
+		logger = self.logger
+		state = self.state
+		if(settings.fetch("run_wrf") == '1' and state.valid("wrf")):
+			logger.write("  4.c. wrf.exe was completed by an earlier run, skiping wrf.exe process")
+		elif(settings.fetch("run_wrf") == '1'):
+			if self.segments != None:
+				success = self.segments.run(self.incremental)
+			else:
+				success = self.jobs.run_wrf(self.incremental)
+			if(success == False):
+				state.failed("wrf")
+				logger.write("   4.c. Error at WRF.exe")
+				logger.close()		
+				sys.exit("   4.c. ERROR: wrf.exe process failed to complete, check error file.")	
+			self.wrf_complete()
+			# Segmented runs span several jobs, only the timings in the joined logs are recorded
+			self.record_wrf(JobTracker.JobTracker.instance().latest("wrf.job") if self.segments == None else None)
+		else:
+			logger.write("  4.c. run_wrf is turned off, skiping wrf.exe process")				
+
+	# wrf_complete: Record a completed wrf.exe run in the run state
+	def wrf_complete(self):
+		self.state.complete("wrf", [self.runDir + "/wrf_log.txt", self.runDir + "/output/wrfout*"])
+
+	# record_wrf: Add the timings of the completed wrf.exe run (job is its JobTracker entry) to PerfDB
+	def record_wrf(self, job):
+		if(self.aSet.fetch("debugmode") != '1'):
+			PerfDB.PerfDB(self.aSet).record(self.aSet, self.runDir + "/wrf_log.txt", self.save_nproc_x, self.save_nproc_y, job)
+
+	# post: Run post-processing (Step 5)
+	def post(self):
+		settings = self.aSet
+		logger = self.logger
+		state = self.state
+		runDir = self.runDir
+		#Step 5: Run postprocessing steps
+		if(settings.fetch("run_postprocessing") == '1' and state.valid("post")):
+			logger.write(" 5. Post-processing was completed by an earlier run, skipping step")
+		elif(settings.fetch("run_postprocessing") == '1'):
+			logger.write(" 5. Running post-processing")
+			post = Jobs.Postprocessing_Steps(settings, self.modelParms)
+			Tools.Process.instance().HoldUntilOpen(breakTime = 86400)
+			if(self.incremental == None and post.prepare_postprocessing() == False):
+				logger.write("   5. Error initializing post-processing")
+				logger.close()			
+				sys.exit("   5. ERROR: post-processing process failed to initialize, check error file.")
+			Tools.Process.instance().HoldUntilOpen(breakTime = 86400)
+			if(post.run_postprocessing(self.incremental) == False):
+				state.failed("post")
+				logger.write("   5. Error running post-processing")
+				logger.close()				
+				sys.exit("   5. ERROR: post-processing process failed to complete, check error file.")			
+			state.complete("post", [runDir + "/postprd/*"])
+			logger.write(" 5. Done")
+		else:
+			logger.write(" 5. Post-processing flag disabled, skipping step")
+
+	# cleanup: Remove the temporary files of the run (Step 6), cleanModelData is False while other runs still read the model data
+	def cleanup(self, cleanModelData = True):
+		logger = self.logger
+		prc = self.prc
+		#Step 6: Cleanup
+		logger.write(" 6. Cleaning Temporary Files")
+		with Metrics.span("cleanup"):
+			prc.performClean(cleanAll = False, cleanOutFiles = True, cleanErrorFiles = True, cleanInFiles = True, cleanBdyFiles = True, cleanWRFOut = False, cleanModelData = cleanModelData)
+		logger.write(" 6. Done")		
+
+	# run_all: Run every step of a single run, steps that fail exit the program. The steps run as a graph (See Pipeline): the model data
+	#  is downloaded while the namelists and job files are written and the geogrid job runs, the pre-processing job waits for both
+	def run_all(self):
+		pipeline = Pipeline.Pipeline()
+		pipeline.add("setup", self.setup, outputs = ["rundir", "decomposition"])
+		pipeline.add("download", self.download, inputs = ["rundir"], outputs = ["model data"])
+		pipeline.add("job files", self.write_files, inputs = ["rundir"], outputs = ["namelists", "job files"])
+		pipeline.add("geogrid", self.geogrid, inputs = ["namelists", "job files"], outputs = ["geo_em", "staged run files"])
+		pipeline.add("pre-processing", self.prerun, inputs = ["geo_em", "staged run files", "model data"], outputs = ["wrfinput"])
+		pipeline.add("wrf namelist", self.prepare_wrf, inputs = ["wrfinput", "decomposition"], outputs = ["wrf namelist"])
+		pipeline.add("wrf", self.wrf_done, inputs = ["wrf namelist"], outputs = ["wrfout"])
+		pipeline.add("post-processing", self.post, inputs = ["wrfout"], outputs = ["postprd"])
+		pipeline.add("cleanup", self.cleanup, inputs = ["postprd"])
+		return pipeline.run()
+
+	# wrf_done: Run wrf.exe and close step 4
+	def wrf_done(self):
+		self.wrf()
+		self.logger.write("  4.c. Done")
+		self.logger.write(" 4. Done")
+
+	@Metrics.timed("job files")
+	def write_job_files(self, settings, mParms):
+		logger = Tools.loggedPrint.instance()
+		logger.write("  -> Writing job files")
+		with Tools.cd(settings.fetch("rundir")):
+			# Write geogrid.job
+			logger.write("  -- writting geogrid.job")
+			with open("geogrid.job", 'w') as target_file:
+				target_file.write("#!/bin/bash\n")
+				target_file.write("#PBS -l nodes=" + settings.fetch("num_prerun_nodes") + ":ppn=" + settings.fetch("num_prerun_processors") + "\n")
+				target_file.write("#PBS -N WRF_GEOGRID" + "\n")
+				target_file.write("#PBS -l walltime=" + settings.fetch("geogrid_walltime") + "\n")
+				target_file.write("#PBS -A climlab" + "\n\n")
+				
+				target_file.write("source " + settings.fetch("sourcefile") + '\n')
+				target_file.write("ulimit -s unlimited\n\n")	
+
+				target_file.write("cd " + settings.fetch("rundir") + "\n\n")
+				
+				target_file.write("mpirun -np " + str(int(settings.fetch("num_prerun_nodes")) * int(settings.fetch("num_prerun_processors"))) + " geogrid.exe" + '\n')
+			logger.write("  -- Done")
+			# Write prerun.job
+			logger.write("  -- writting prerun.job")
+			with open("prerun.job", 'w') as target_file:
+				target_file.write("#!/bin/bash\n")
+				target_file.write("#PBS -l nodes=" + settings.fetch("num_prerun_nodes") + ":ppn=" + settings.fetch("num_prerun_processors") + "\n")
+				target_file.write("#PBS -N WRF_PREPROCESSING" + "\n")
+				target_file.write("#PBS -l walltime=" + settings.fetch("prerun_walltime") + "\n")
+				target_file.write("#PBS -A climlab" + "\n\n")
+				
+				target_file.write("source " + settings.fetch("sourcefile") + '\n')
+				target_file.write("ulimit -s unlimited\n")
+
+				target_file.write("cd " + settings.fetch("rundir") + "\n\n")			
+				if(settings.fetch("pipeline_preprocessing") == '1'):
+					# metgrid.exe runs on each valid time as soon as ungrib.exe has written it, real.exe follows the last time
+					prerun = PrerunJob.PrerunJob(settings, mParms)
+					logger.write("  -- " + str(len(prerun.slices)) + " concurrent ungrib.exe processes, pipelined into metgrid.exe")
+					target_file.write(prerun.pipeline_commands("mpirun -np " + str(int(settings.fetch("num_prerun_nodes")) * int(settings.fetch("num_prerun_processors"))) + " metgrid.exe") + '\n')
+				elif(settings.fetch("ungrib_parallel") == '1'):
+					# Each input stream (And date slice) runs ungrib.exe at the same time in its own subdirectory
+					prerun = PrerunJob.PrerunJob(settings, mParms)
+					logger.write("  -- " + str(len(prerun.slices)) + " concurrent ungrib.exe processes")
+					target_file.write(prerun.job_commands() + '\n')
+				else:
+					target_file.write("./link_grib.csh " + settings.fetch("datadir") + '/' + settings.fetch("modeldata") + '/' + settings.fetch("starttime") + '/' + '\n')
+					i = 0
+					for ext in mParms["FileExtentions"]:
+						target_file.write("cp " + mParms["VTable"][i] + " Vtable" + '\n')
+						target_file.write("cp namelist.wps." + ext + " namelist.wps" + '\n')
+						target_file.write("./ungrib.exe &" + '\n')
+						target_file.write("PID_Ungrib=$!" + '\n')
+						target_file.write("wait $PID_Ungrib" + '\n')
+						i += 1
+				if(settings.fetch("pipeline_preprocessing") != '1'):
+					# The next process is metgrid.
+					target_file.write("mpirun -np " + str(int(settings.fetch("num_prerun_nodes")) * int(settings.fetch("num_prerun_processors"))) + " metgrid.exe &" + '\n')
+					target_file.write("PID_Metgrid=$!" + '\n')
+					target_file.write("wait $PID_Metgrid" + "\n\n")	
+				# Finally, run the real.exe process
+				target_file.write("cd " + settings.fetch("rundir") + '/' + "output\n\n")
+				target_file.write("mpirun -np " + str(int(settings.fetch("num_prerun_nodes")) * int(settings.fetch("num_prerun_processors"))) + " real.exe &" + '\n')
+				target_file.write("PID_Real=$!" + '\n')
+				target_file.write("wait $PID_Real" + "\n\n")
+			logger.write("  -- Done")	
+			# Write wrf.job
+			logger.write("  -- writting wrf.job")
+			with open("wrf.job", 'w') as target_file:		
+				target_file.write("#!/bin/bash\n")
+				target_file.write("#PBS -l nodes=" + settings.fetch("num_wrf_nodes") + ":ppn=" + settings.fetch("num_wrf_processors") + "\n")
+				target_file.write("#PBS -N WRF_MODEL" + "\n")
+				target_file.write("#PBS -l walltime=" + settings.fetch("wrf_walltime") + "\n")
+				target_file.write("#PBS -A climlab" + "\n\n")
+
+				target_file.write("source " + settings.fetch("sourcefile") + '\n')
+				target_file.write("ulimit -s unlimited\n")				
+				target_file.write("cd " + settings.fetch("rundir") + '/' + "output\n\n")
+				target_file.write("mpirun -np " + str(int(settings.fetch("num_wrf_nodes")) * int(settings.fetch("num_wrf_processors"))) + " wrf.exe" + '\n')		
+			logger.write("  -- Done")
+		logger.write("  -> All file write operations complete")	
+		return True
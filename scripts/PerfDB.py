@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# PerfDB.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes used to record the performance of past wrf.exe runs and recommend job sizes from them
+
+import os
+import re
+import json
+import sqlite3
+import datetime
+import Tools
+
+# Timing lines written by wrf.exe to rsl.out.0000, IE:
+#  Timing for main: time 2019-05-26_00:00:20 on domain   1:    1.23456 elapsed seconds
+#  Timing for Writing wrfout_d01_2019-05-26_01:00:00 for domain        1:    0.54321 elapsed seconds
+MAIN_PATTERN = re.compile(r"Timing for main: time (\S+) on domain\s+(\d+):\s+([0-9.]+) elapsed seconds")
+WRITE_PATTERN = re.compile(r"Timing for Writing (\S+) for domain\s+(\d+):\s+([0-9.]+) elapsed seconds")
+
+# The namelist physics options that change the cost of a time step, runs are only compared when all of these match
+PHYSICS_KEYS = ["mp_physics", "ra_lw_physics", "ra_sw_physics", "radt", "sf_sfclay_physics", "sf_surface_physics",
+				"bl_pbl_physics", "bldt", "cu_physics", "cudt", "sf_urban_physics", "hail_opt", "num_land_cat", "num_soil_layers"]
+
+# parse_rsl: Returns (list of (model time, domain, seconds) from the "Timing for main" lines, total seconds spent writing output)
+def parse_rsl(path):
+	steps = []
+	writing = 0.0
+	with open(path, 'r', errors = "replace") as f:
+		for line in f:
+			match = MAIN_PATTERN.search(line)
+			if match:
+				steps.append((match.group(1), int(match.group(2)), float(match.group(3))))
+				continue
+			match = WRITE_PATTERN.search(line)
+			if match:
+				writing += float(match.group(3))
+	return steps, writing
+
+# RunRecord: Mini class instance describing the configuration and timings of one wrf.exe run
+class RunRecord:
+	values = {}
+
+	def __init__(self, settings, nproc_x, nproc_y):
+		self.values = {
+			"recorded": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+			"starttime": settings.fetch("starttime"),
+			"domain": domain_key(settings),
+			"physics": physics_key(settings),
+			"e_we": int(settings.fetch("e_we")),
+			"e_sn": int(settings.fetch("e_sn")),
+			"e_vert": int(settings.fetch("e_vert")),
+			"dx_y": float(settings.fetch("dx_y")),
+			"nodes": int(settings.fetch("num_wrf_nodes")),
+			"ppn": int(settings.fetch("num_wrf_processors")),
+			"nproc_x": int(nproc_x),
+			"nproc_y": int(nproc_y),
+			"numtiles": int(settings.fetch("wrf_numtiles")),
+			"nio_groups": int(settings.fetch("wrf_nio_groups")),
+			"nio_tasks": int(settings.fetch("wrf_nio_tasks_per_group")),
+			"forecast_hours": 24 * int(settings.fetch("rundays")) + int(settings.fetch("runhours")),
+			"steps": 0,
+			"step_mean": None,
+			"step_max": None,
+			"main_seconds": None,
+			"write_seconds": None,
+			"queue_seconds": None,
+			"wall_seconds": None,
+		}
+
+	# addTimings: Fill in the step statistics from the parsed rsl.out.0000 timings (Domain 1 only, nests run inside its steps)
+	def addTimings(self, steps, writing):
+		seconds = [s for time, domain, s in steps if domain == 1]
+		if not seconds:
+			return
+		self.values["steps"] = len(seconds)
+		self.values["main_seconds"] = sum(seconds)
+		self.values["step_mean"] = sum(seconds) / len(seconds)
+		self.values["step_max"] = max(seconds)
+		self.values["write_seconds"] = writing
+
+	# addJob: Fill in the queue and wall time from the JobTracker timestamps, these are only as precise as the poll interval
+	def addJob(self, job):
+		if job is None or job.started is None or job.finished is None:
+			return
+		self.values["queue_seconds"] = (job.started - job.submitted).total_seconds()
+		self.values["wall_seconds"] = (job.finished - job.started).total_seconds()
+
+def domain_key(settings):
+	return settings.fetch("e_we") + "x" + settings.fetch("e_sn") + "x" + settings.fetch("e_vert") + "@" + settings.fetch("dx_y") + ":" + settings.fetch("map_proj") + ":" + settings.fetch("ref_lat") + "," + settings.fetch("ref_lon")
+
+def physics_key(settings):
+	return json.dumps(dict((key, settings.fetch(key)) for key in PHYSICS_KEYS), sort_keys = True)
+
+# PerfDB: The SQLite store of past runs (perfdb in control.txt, Default: headdir/perf.db)
+class PerfDB:
+	path = ""
+	logger = None
+	columns = ["recorded", "starttime", "domain", "physics", "e_we", "e_sn", "e_vert", "dx_y", "nodes", "ppn", "nproc_x", "nproc_y",
+			   "numtiles", "nio_groups", "nio_tasks", "forecast_hours", "steps", "step_mean", "step_max", "main_seconds", "write_seconds",
+			   "queue_seconds", "wall_seconds"]
+
+	def __init__(self, settings):
+		self.logger = Tools.loggedPrint.instance()
+		self.path = settings.fetch("perfdb")
+		if(self.path == None):
+			self.path = settings.fetch("headdir") + "perf.db"
+		with self.connect() as db:
+			db.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, recorded TEXT, starttime TEXT, domain TEXT, physics TEXT, " +
+					   "e_we INTEGER, e_sn INTEGER, e_vert INTEGER, dx_y REAL, nodes INTEGER, ppn INTEGER, nproc_x INTEGER, nproc_y INTEGER, " +
+					   "numtiles INTEGER, nio_groups INTEGER, nio_tasks INTEGER, forecast_hours INTEGER, steps INTEGER, step_mean REAL, step_max REAL, " +
+					   "main_seconds REAL, write_seconds REAL, queue_seconds REAL, wall_seconds REAL)")
+			db.execute("CREATE TABLE IF NOT EXISTS steps (run INTEGER, model_time TEXT, domain INTEGER, seconds REAL)")
+			db.execute("CREATE INDEX IF NOT EXISTS runs_domain ON runs (domain, physics)")
+
+	def connect(self):
+		# The database may sit on a shared filesystem, wait out other runs instead of failing on a locked file
+		return sqlite3.connect(self.path, timeout = 60)
+
+	# record: Store the run described by settings along with the timings parsed from its rsl.out.0000 log, returns the run's id
+	def record(self, settings, logFile, nproc_x, nproc_y, job = None):
+		if not os.path.isfile(logFile):
+			self.logger.write("PerfDB: " + logFile + " does not exist, run not recorded")
+			return None
+		steps, writing = parse_rsl(logFile)
+		run = RunRecord(settings, nproc_x, nproc_y)
+		run.addTimings(steps, writing)
+		run.addJob(job)
+		if(run.values["steps"] == 0):
+			self.logger.write("PerfDB: No timing lines found in " + logFile + ", run not recorded")
+			return None
+		with self.connect() as db:
+			cursor = db.execute("INSERT INTO runs (" + ", ".join(self.columns) + ") VALUES (" + ", ".join(["?"] * len(self.columns)) + ")",
+								[run.values[c] for c in self.columns])
+			runID = cursor.lastrowid
+			db.executemany("INSERT INTO steps (run, model_time, domain, seconds) VALUES (?, ?, ?, ?)", [(runID, t, d, s) for t, d, s in steps])
+		self.logger.write("PerfDB: Recorded run " + str(runID) + " (" + str(run.values["steps"]) + " steps, " + str(round(run.values["step_mean"], 3)) + " s/step)")
+		return runID
+
+	# recommend: Rank the configurations used for this domain and physics by projected wall time (objective "walltime") or core-hours
+	#  ("corehours") for the requested forecast length. The projection is the mean time per step times the step count for the run length,
+	#  plus output time scaled the same way. Configurations with fewer than minSamples runs are left out.
+	def recommend(self, settings, objective = "walltime", minSamples = 1):
+		forecastHours = 24 * int(settings.fetch("rundays")) + int(settings.fetch("runhours"))
+		with self.connect() as db:
+			rows = db.execute("SELECT nodes, ppn, nproc_x, nproc_y, numtiles, nio_groups, nio_tasks, COUNT(*), " +
+							  "SUM(main_seconds + write_seconds) / SUM(forecast_hours), AVG(step_mean) " +
+							  "FROM runs WHERE domain = ? AND physics = ? AND steps > 0 AND forecast_hours > 0 " +
+							  "GROUP BY nodes, ppn, nproc_x, nproc_y, numtiles, nio_groups, nio_tasks",
+							  (domain_key(settings), physics_key(settings))).fetchall()
+		candidates = []
+		for nodes, ppn, nproc_x, nproc_y, numtiles, nio_groups, nio_tasks, samples, perHour, stepMean in rows:
+			if(samples < minSamples):
+				continue
+			wall = perHour * forecastHours
+			candidates.append({"num_wrf_nodes": nodes, "num_wrf_processors": ppn, "nproc_x": nproc_x, "nproc_y": nproc_y,
+							   "wrf_numtiles": numtiles, "wrf_nio_groups": nio_groups, "wrf_nio_tasks_per_group": nio_tasks,
+							   "samples": samples, "step_mean": stepMean, "wall_seconds": wall, "core_hours": wall * nodes * ppn / 3600.0})
+		key = "core_hours" if objective == "corehours" else "wall_seconds"
+		return sorted(candidates, key = lambda c: c[key])
+
+	# seconds_per_hour: The mean wrf.exe time per forecast hour of the past runs of this domain and physics on the current job size
+	#  (num_wrf_nodes x num_wrf_processors), None if there are none. Used to size restart segments (See Segments)
+	def seconds_per_hour(self, settings):
+		with self.connect() as db:
+			row = db.execute("SELECT SUM(main_seconds + write_seconds) / SUM(forecast_hours) FROM runs " +
+							 "WHERE domain = ? AND physics = ? AND nodes = ? AND ppn = ? AND steps > 0 AND forecast_hours > 0",
+							 (domain_key(settings), physics_key(settings), int(settings.fetch("num_wrf_nodes")), int(settings.fetch("num_wrf_processors")))).fetchone()
+		return row[0] if row != None else None
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# Pipeline.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes used to run the steps of a model run as a dependency graph, each step starts as soon as the steps producing its
+#  inputs are done so independent steps (IE: The model data download and the geogrid job) run at the same time
+
+import threading
+from multiprocessing.pool import ThreadPool
+import Tools
+
+# Step: One step of the graph. inputs and outputs name what the step reads and produces (IE: "model data", "geo_em"), the producer of
+#  each input is found from the outputs of the other steps
+class Step:
+	name = ""
+	function = None
+	inputs = []
+	outputs = []
+	needs = []
+
+	def __init__(self, name, function, inputs = None, outputs = None):
+		self.name = name
+		self.function = function
+		self.inputs = inputs if inputs != None else []
+		self.outputs = outputs if outputs != None else []
+		self.needs = []
+
+# Pipeline: Runs the added steps on a thread pool in dependency order. The program waits on a condition that each step signals when it
+#  returns, a step that fails (IE: sys.exit) stops the pipeline and its exception is raised again once no other step is running, the
+#  steps that have not started are skipped. Steps that run at the same time must not change the working directory while the others
+#  use relative paths (The model data download only uses absolute paths).
+#  Shared state safe to use from a step thread: the logger (Tools.loggedPrint), JobTracker (Submitting, waiting and all_jobs()),
+#  Metrics spans, RunState and Tools.Process, each guards its state with a lock. Anything else shared between steps (IE: the
+#  settings) must not be changed by a step while another step may read it
+class Pipeline:
+	steps = []
+	logger = None
+	condition = None
+	done = []
+	running = []
+	error = None
+
+	def __init__(self):
+		self.steps = []
+		self.logger = Tools.loggedPrint.instance()
+		self.condition = threading.Condition()
+		self.done = []
+		self.running = []
+		self.error = None
+
+	def add(self, name, function, inputs = None, outputs = None):
+		self.steps.append(Step(name, function, inputs, outputs))
+
+	# resolve: Find the steps each step needs, every input must be the output of exactly one other step
+	def resolve(self):
+		producers = {}
+		for step in self.steps:
+			for output in step.outputs:
+				if output in producers:
+					raise ValueError("Pipeline: " + output + " is produced by both " + producers[output] + " and " + step.name)
+				producers[output] = step.name
+		for step in self.steps:
+			for needed in step.inputs:
+				if not needed in producers:
+					raise ValueError("Pipeline: No step produces " + needed + " (Needed by " + step.name + ")")
+			step.needs = sorted(set(producers[needed] for needed in step.inputs))
+
+	def ready(self, step):
+		return not step.name in self.done and not step.name in self.running and all(need in self.done for need in step.needs)
+
+	# call: Run one step on a pool thread and signal the program when it returns
+	def call(self, step):
+		error = None
+		try:
+			step.function()
+		except BaseException as e:
+			error = e
+		with self.condition:
+			self.running.remove(step.name)
+			if error != None:
+				if self.error == None:
+					self.error = error
+					self.logger.write("Pipeline: Step " + step.name + " failed, no further steps will start", level = "error")
+			else:
+				self.done.append(step.name)
+			self.condition.notify_all()
+
+	def run(self):
+		self.resolve()
+		pool = ThreadPool(len(self.steps))
+		try:
+			with self.condition:
+				while True:
+					if self.error == None:
+						for step in self.steps:
+							if self.ready(step):
+								self.running.append(step.name)
+								waiting = [s.name for s in self.steps if not s.name in self.done and not s.name in self.running]
+								self.logger.write("Pipeline: Starting " + step.name + ("" if not waiting else " (Waiting: " + ", ".join(waiting) + ")"), level = "debug")
+								pool.apply_async(self.call, (step,))
+					if not self.running:
+						break
+					self.condition.wait()
+		finally:
+			pool.close()
+		if self.error != None:
+			raise self.error
+		skipped = [step.name for step in self.steps if not step.name in self.done]
+		if skipped:
+			raise ValueError("Pipeline: Steps with unmet dependencies (Cycle in the graph): " + ", ".join(skipped))
+		return True
@@ -8,6 +8,7 @@
 import glob
 import Tools
 import Wait
+import FileOps
 
 class PreparePyJob:
 	aSet = None
@@ -22,18 +23,9 @@ class PreparePyJob:
 		self.targetDir = targetDir
 		self.logger = Tools.loggedPrint.instance()
 		
-	# prepare_job: This function writes the post-processing job file
-	def prepare_job(self):
-		Tools.Process.instance().Lock()	
-		self.logger.write("  5.b. Entering prepare_job(), constructing job file.")
-		fList = sorted(glob.glob(self.wrfOutDir + "/wrfout*"))
-		fileCount = len(fList)
+	# job_contents: The python_post.job script, the post-processing logs are written to logDir
+	def job_contents(self, logDir):
 		out_job_contents = ""
-		self.logger.write("  5.b. " + str(fileCount) + " wrfout files have been found.")
-		if(fileCount <= 0):
-			# Something went wrong.
-			self.logger.write("  No files found, something is wrong, please check the output directory to ensure the wrfout* files are present.")
-			return False
 		out_job_contents += "#!/bin/bash\n"
 		out_job_contents += "source " + self.aSet.fetch("sourcefile") + "\n"
 		out_job_contents += "source activate " + self.aSet.fetch("condamodule") + "\n"
@@ -44,24 +36,38 @@ class PreparePyJob:
 		out_job_contents += "export PYTHON_POST_NODES=" + self.aSet.fetch("num_python_nodes") + "\n"
 		out_job_contents += "export PYTHON_POST_THREADS=" + self.aSet.fetch("python_threads_per_rank") + "\n"
 		out_job_contents += "export PYTHON_POST_FIRSTTIME=" + self.aSet.fetch("starttime") + "\n"
-		out_job_contents += "export PYTHON_POST_LOG_DIR=" + self.targetDir + "/\n\n"
+		out_job_contents += "export PYTHON_POST_LOG_DIR=" + logDir + "/\n\n"
 		
 		out_job_contents += "cd " + self.aSet.fetch("postdir") + "/Python\n\n"
 		
 		out_job_contents += "python PythonPost.py&\n"
 		out_job_contents += "PID_PyPost=$!\n"
 		out_job_contents += "wait $PID_PyPost\n\n"
+		return out_job_contents
+
+	# prepare_job: This function writes the post-processing job file
+	def prepare_job(self):
+		Tools.Process.instance().Lock()	
+		self.logger.write("  5.b. Entering prepare_job(), constructing job file.")
+		fList = sorted(glob.glob(self.wrfOutDir + "/wrfout*"))
+		fileCount = len(fList)
+		self.logger.write("  5.b. " + str(fileCount) + " wrfout files have been found.")
+		if(fileCount <= 0):
+			# Something went wrong.
+			self.logger.write("  No files found, something is wrong, please check the output directory to ensure the wrfout* files are present.")
+			return False
+		out_job_contents = self.job_contents(self.targetDir)
 		
 		with Tools.cd(self.targetDir):
 			with open("python_post.job", 'w') as target_file:
 				target_file.write(out_job_contents)		
-			Tools.popen(self.aSet, "chmod +x python_post.job")
+			FileOps.FileOps(self.aSet).chmod_x(["python_post.job"])
 			self.logger.write("   -> Starting Python Post Processing Script, moving this script to holding pattern")
 			jobSub = Tools.popen(self.aSet, "./python_post.job")	
 
 			try:
-				wCond = [{"waitCommand": "tail -n 3 pypost.log", "contains": "***SUCCESS***", "retCode": 1},
-						 {"waitCommand": "tail -n 3 pypost.log", "contains": "***FAIL***", "retCode": 2}]
+				wCond = [{"watchFile": "pypost.log", "contains": "***SUCCESS***", "retCode": 1},
+						 {"watchFile": "pypost.log", "contains": "***FAIL***", "retCode": 2}]
 				waitCond = Wait.Wait(wCond, timeDelay = 60)
 				wRC = waitCond.hold()			
 				if wRC == 1:
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# PrerunJob.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# This class instance is responsible for planning the concurrent ungrib.exe slices of the pre-processing job and writing their
+#  namelists and job file commands
+
+import datetime
+import Tools
+
+# UngribSlice: Mini class instance describing one ungrib.exe process, a single input stream (Vtable) over a contiguous range of dates
+class UngribSlice:
+	ext = ""
+	vtable = ""
+	index = 0
+	dates = []
+
+	def __init__(self, ext, vtable, index, dates):
+		self.ext = ext
+		self.vtable = vtable
+		self.index = index
+		self.dates = dates
+
+	def name(self):
+		return "ungrib_" + self.ext + "_" + str(self.index)
+
+	def namelist(self):
+		return "namelist.wps." + self.ext + "." + str(self.index)
+
+# PrerunJob: Splits ungrib.exe into one process per input stream, and optionally per date range (ungrib_slices in control.txt).
+#  Each slice runs in its own ungrib_<stream>_<n> subdirectory of the run directory with its own Vtable, namelist.wps and GRIBFILE links
+#  (Only the files of its own dates), so the slices can run at the same time. The intermediate files are moved back to the run
+#  directory for metgrid and the slice logs are joined into ungrib.log once every slice has finished.
+#  In pipelined mode (pipeline_preprocessing) metgrid.exe follows the slices one valid time at a time, see pipeline_commands().
+class PrerunJob:
+	aSet = None
+	mParms = None
+	logger = None
+	slices = []
+
+	def __init__(self, settings, mParms):
+		self.aSet = settings
+		self.mParms = mParms
+		self.logger = Tools.loggedPrint.instance()
+		self.slices = self.plan()
+
+	def dates(self):
+		start = datetime.datetime.strptime(self.aSet.fetch("starttime"), "%Y%m%d%H")
+		end = start + datetime.timedelta(days=int(self.aSet.fetch("rundays")), hours=int(self.aSet.fetch("runhours")))
+		dates = []
+		current = start
+		while current <= end:
+			dates.append(current)
+			current += datetime.timedelta(hours=self.mParms["HourDelta"])
+		return dates
+
+	# plan: Build the slice list, every ungrib.exe is serial and runs on the job's first node, so slices are capped at num_prerun_processors
+	def plan(self):
+		dates = self.dates()
+		streams = len(self.mParms["FileExtentions"])
+		count = int(self.aSet.fetch("ungrib_slices")) if self.aSet.fetch("ungrib_slices") != None else 1
+		cap = max(1, int(self.aSet.fetch("num_prerun_processors")) // streams)
+		if(count > cap):
+			self.logger.write("  -> ungrib_slices reduced from " + str(count) + " to " + str(cap) + " (num_prerun_processors / input streams)")
+			count = cap
+		count = max(1, min(count, len(dates)))
+		chunk = len(dates) // count
+		extra = len(dates) % count
+		slices = []
+		i = 0
+		for ext in self.mParms["FileExtentions"]:
+			first = 0
+			for index in range(count):
+				size = chunk + (1 if index < extra else 0)
+				slices.append(UngribSlice(ext, self.mParms["VTable"][i], index, dates[first:first + size]))
+				first += size
+			i += 1
+		return slices
+
+	# write_namelists: Render namelist.wps.<stream>.<n> for each slice, returns the list of unresolved keys
+	def write_namelists(self, tWrite):
+		unresolved = []
+		for s in self.slices:
+			unresolved += tWrite.generateTemplatedFile(self.aSet.fetch("headdir") + "templates/namelist.wps.template", s.namelist(),
+													   extraKeys = {"[ungrib_prefix]": s.ext, "[fg_name]": self.mParms["FGExt"],
+																	"[start_date]": s.dates[0].strftime('%Y-%m-%d_%H:%M:%S'),
+																	"[end_date]": s.dates[-1].strftime('%Y-%m-%d_%H:%M:%S')})
+		return unresolved
+
+	# write_metgrid_namelists: Render namelist.wps.metgrid.<YYYYMMDDHH> for each valid time (Pipelined mode), returns the list of unresolved keys
+	def write_metgrid_namelists(self, tWrite):
+		unresolved = []
+		for d in self.dates():
+			unresolved += tWrite.generateTemplatedFile(self.aSet.fetch("headdir") + "templates/namelist.wps.template", "namelist.wps.metgrid." + d.strftime('%Y%m%d%H'),
+													   extraKeys = {"[ungrib_prefix]": self.mParms["FileExtentions"][0], "[fg_name]": self.mParms["FGExt"],
+																	"[start_date]": d.strftime('%Y-%m-%d_%H:%M:%S'),
+																	"[end_date]": d.strftime('%Y-%m-%d_%H:%M:%S')})
+		return unresolved
+
+	# start_slices: The prerun.job lines that start every slice in the background, each slice writes its exit code to .done when it ends
+	def start_slices(self):
+		dataDir = self.aSet.fetch("datadir") + '/' + self.aSet.fetch("modeldata") + '/' + self.aSet.fetch("starttime")
+		out = ""
+		out += "rm -rf ungrib_*\n"
+		out += "UNGRIB_PIDS=\"\"\n"
+		for s in self.slices:
+			files = [dataDir + '/' + d.strftime(pattern) for d in s.dates for pattern in self.mParms["InputFiles"]]
+			out += "mkdir " + s.name() + "\n"
+			out += "cd " + s.name() + "\n"
+			out += "../link_grib.csh " + " ".join(files) + "\n"
+			out += "cp ../" + s.vtable + " Vtable\n"
+			out += "cp ../" + s.namelist() + " namelist.wps\n"
+			out += "(../ungrib.exe > ungrib.stdout 2>&1; echo $? > .done) &\n"
+			out += "UNGRIB_PIDS=\"$UNGRIB_PIDS $!\"\n"
+			out += "cd ..\n"
+		return out
+
+	# finish_slices: The prerun.job lines that wait for every slice and write ungrib.log, the job exits if any slice failed
+	def finish_slices(self, gather = True):
+		out = ""
+		out += "UNGRIB_FAILED=\"\"\n"
+		out += "for PID in $UNGRIB_PIDS; do wait $PID; done\n"
+		out += "for DIR in " + " ".join(s.name() for s in self.slices) + "; do\n"
+		out += "  grep -q \"Successful completion of program ungrib.exe\" $DIR/ungrib.log 2>/dev/null || UNGRIB_FAILED=\"$UNGRIB_FAILED $DIR\"\n"
+		out += "done\n"
+		# ungrib.log is written in one step once every slice is done, so the wait in Jobs.run_preprocessing() sees a single final result
+		out += "if [ -n \"$UNGRIB_FAILED\" ]; then\n"
+		out += "  echo \"ERROR: ungrib.exe failed in$UNGRIB_FAILED, see ungrib_*/ungrib.log\" > .ungrib.log.tmp\n"
+		out += "  mv .ungrib.log.tmp ungrib.log\n"
+		out += "  exit 1\n"
+		out += "fi\n"
+		if gather:
+			for ext in self.mParms["FileExtentions"]:
+				out += "mv ungrib_" + ext + "_*/" + ext + ":* .\n"
+		out += "for DIR in " + " ".join(s.name() for s in self.slices) + "; do echo \"== $DIR\"; cat $DIR/ungrib.log; done > .ungrib.log.tmp\n"
+		out += "mv .ungrib.log.tmp ungrib.log\n"
+		return out
+
+	# job_commands: The prerun.job lines that run every slice at the same time and gather the results, run from the run directory
+	def job_commands(self):
+		return self.start_slices() + self.finish_slices()
+
+	# pipeline_commands: The prerun.job lines for pipelined pre-processing. The slices are started, then metgrid.exe (metgridCommand) runs
+	#  once per valid time as soon as every stream has finished writing that time's intermediate file. A time's file is complete once
+	#  the slice has started the next time's file, or the slice has ended successfully. Each step is appended to prerun_progress.txt,
+	#  which Jobs.run_preprocessing() follows, and real.exe can start right after the last time. The metgrid logs are joined into metgrid_log.txt.
+	def pipeline_commands(self, metgridCommand):
+		out = ""
+		out += "rm -f prerun_progress.txt metgrid_log.txt metgrid.log.*\n"
+		out += "ungrib_ready() { [ -f \"$1/$2\" ] && { { [ -n \"$3\" ] && [ -f \"$1/$3\" ]; } || { [ -f \"$1/.done\" ] && grep -q \"Successful completion of program ungrib.exe\" \"$1/ungrib.log\" 2>/dev/null; }; }; }\n"
+		out += "ungrib_lost() { [ -f \"$1/.done\" ] && ! { [ -f \"$1/$2\" ] && grep -q \"Successful completion of program ungrib.exe\" \"$1/ungrib.log\" 2>/dev/null; }; }\n"
+		out += "pipeline_error() { echo \"ERROR: $1\" >> prerun_progress.txt; exit 1; }\n"
+		out += self.start_slices()
+		for d in self.dates():
+			stamp = d.strftime('%Y-%m-%d_%H')
+			ready = []
+			lost = []
+			links = []
+			for s in self.slices:
+				if not d in s.dates:
+					continue
+				pos = s.dates.index(d)
+				nextFile = s.ext + ":" + s.dates[pos + 1].strftime('%Y-%m-%d_%H') if pos + 1 < len(s.dates) else ""
+				ready.append("ungrib_ready " + s.name() + " " + s.ext + ":" + stamp + " \"" + nextFile + "\"")
+				lost.append("  ungrib_lost " + s.name() + " " + s.ext + ":" + stamp + " && pipeline_error \"ungrib.exe did not write " + s.ext + ":" + stamp + " in " + s.name() + "\"\n")
+				links.append("ln -sf " + s.name() + "/" + s.ext + ":" + stamp + " " + s.ext + ":" + stamp + "\n")
+			out += "until " + " && ".join(ready) + "; do\n"
+			out += "".join(lost)
+			out += "  sleep 5\n"
+			out += "done\n"
+			out += "".join(links)
+			out += "echo \"ungrib " + stamp + "\" >> prerun_progress.txt\n"
+			out += "cp namelist.wps.metgrid." + d.strftime('%Y%m%d%H') + " namelist.wps\n"
+			out += metgridCommand + "\n"
+			out += "grep -q \"Successful completion of program metgrid.exe\" metgrid.log.0000 || pipeline_error \"metgrid.exe failed at " + stamp + "\"\n"
+			out += "cat metgrid.log.0000 >> metgrid_log.txt\n"
+			out += "rm -f metgrid.log.*\n"
+			out += "echo \"metgrid " + stamp + "\" >> prerun_progress.txt\n"
+		out += self.finish_slices(gather = False)
+		out += "echo \"metgrid complete\" >> prerun_progress.txt\n"
+		return out
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# RunState.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes used to record the progress of a run in its run directory, so an interrupted run can resume where it stopped
+
+import os
+import glob
+import json
+import hashlib
+import datetime
+import threading
+import Tools
+import JobTracker
+
+# The run steps in program order
+STEPS = ["download", "geogrid", "preprocessing", "wrf", "post"]
+
+# The steps reading the outputs of each step, completing a step drops their records as their inputs have changed. geogrid does not
+#  read the model data, so the two can complete in either order (See Pipeline)
+DEPENDENTS = {"download": ["preprocessing", "wrf", "post"],
+			  "geogrid": ["preprocessing", "wrf", "post"],
+			  "preprocessing": ["wrf", "post"],
+			  "wrf": ["post"],
+			  "post": []}
+
+# Settings that only select which steps run or how the program behaves, changing these keeps the saved state
+IGNORED_SETTINGS = ["run_prerunsteps", "run_geogrid", "run_preprocessing_jobs", "run_wrf", "run_postprocessing", "debugmode",
+					"scheduler_poll_interval", "fileops_threads", "download_threads", "download_retries", "metrics_textfile",
+					"campaign_start", "campaign_end", "campaign_interval", "campaign_cycles_in_flight", "campaign_prefetch", "campaign_ledger", "submit_chain"]
+
+# fingerprint: Size and modification time of a file, None if it does not exist
+def fingerprint(path):
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	return str(st.st_size) + ":" + str(st.st_mtime_ns)
+
+def config_key(settings):
+	values = dict((key, value) for key, value in settings.settings.items() if not key in IGNORED_SETTINGS)
+	return hashlib.sha1(json.dumps(values, sort_keys = True).encode()).hexdigest()
+
+# AttachedJob: Stands in for the Tools.popen result of a job submitted by an earlier run of the program
+class AttachedJob:
+	stored = ["", ""]
+	jobID = None
+
+	def __init__(self, jobID):
+		self.stored = ["", ""]
+		self.jobID = jobID
+
+	def fetch(self):
+		return self.stored
+
+# RunState: The state of one run, saved to run_state.json in the run directory. Each completed step records the fingerprints of its
+#  outputs and is skipped by later runs of the program while those files are unchanged, each submitted job is recorded so a restarted
+#  program can reattach to it instead of submitting it again. The state is discarded when the settings change (See config_key()).
+class RunState:
+	aSet = None
+	path = ""
+	key = ""
+	steps = {}
+	logger = None
+	lock = None
+
+	def __init__(self, settings):
+		self.aSet = settings
+		self.logger = Tools.loggedPrint.instance()
+		self.path = settings.fetch("rundir") + "/run_state.json"
+		self.key = config_key(settings)
+		self.steps = {}
+		# Steps running at the same time (See Pipeline) record their progress in one file, every change to steps is made and saved
+		#  under the lock (Re-entrant, as save() takes it again)
+		self.lock = threading.RLock()
+		try:
+			with open(self.path) as f:
+				saved = json.load(f)
+			if(saved.get("config") == self.key):
+				self.steps = saved.get("steps", {})
+			else:
+				self.logger.write("RunState: The settings have changed since " + self.path + " was written, previous progress is discarded")
+		except (IOError, OSError, ValueError):
+			pass
+
+	# resuming: True if an earlier run of the program recorded progress for this run
+	def resuming(self):
+		return len(self.steps) > 0
+
+	def describe(self):
+		return ", ".join(name + " (" + self.steps[name]["status"] + ")" for name in STEPS if name in self.steps)
+
+	def save(self):
+		if(self.aSet.fetch("debugmode") == '1' or not os.path.isdir(os.path.dirname(self.path))):
+			return
+		with self.lock:
+			with open(self.path + ".tmp", 'w') as f:
+				json.dump({"config": self.key, "starttime": self.aSet.fetch("starttime"), "steps": self.steps}, f, indent = 1)
+			os.rename(self.path + ".tmp", self.path)
+
+	# valid: True if the step completed and every output it recorded still has the same fingerprint
+	def valid(self, step):
+		with self.lock:
+			record = self.steps.get(step)
+		if record is None or record["status"] != "complete" or not record["outputs"]:
+			return False
+		for path, saved in record["outputs"].items():
+			if(fingerprint(path) != saved):
+				self.logger.write("RunState: " + path + " has changed since the " + step + " step completed, the step will run again")
+				return False
+		return True
+
+	# complete: Record a step as completed, patterns are globs of the files it produced
+	def complete(self, step, patterns):
+		outputs = {}
+		for pattern in patterns:
+			for path in sorted(glob.glob(pattern)):
+				outputs[path] = fingerprint(path)
+		with self.lock:
+			for later in DEPENDENTS[step]:
+				self.steps.pop(later, None)
+			self.steps[step] = {"status": "complete", "finished": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), "outputs": outputs}
+			self.save()
+
+	def failed(self, step):
+		with self.lock:
+			self.steps[step] = {"status": "failed", "finished": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), "outputs": {}}
+			self.save()
+
+	# submitted: Record the job running a step
+	def submitted(self, step, jobID, jobFile):
+		with self.lock:
+			self.steps[step] = {"status": "submitted", "jobID": jobID, "jobFile": jobFile, "outputs": {}}
+			self.save()
+
+	# attach: The job an earlier run submitted for the step, if the step did not finish. The job is tracked again and returned as an
+	#  AttachedJob, its logs are then followed as if it had just been submitted. Returns None if there is nothing to attach to.
+	def attach(self, step):
+		with self.lock:
+			record = self.steps.get(step)
+		if record is None or record["status"] != "submitted" or record.get("jobID") is None:
+			return None
+		tracker = JobTracker.JobTracker.instance()
+		if tracker.fetch(record["jobID"]) is None:
+			tracker.track(record["jobID"], record["jobFile"])
+		tracker.refresh(force = True)
+		self.logger.write("RunState: Reattaching to job " + record["jobID"] + " (" + record["jobFile"] + "), now " + tracker.state(record["jobID"]))
+		return AttachedJob(record["jobID"])
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# Segments.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains the class used to split a wrf.exe run into restart segments, each run by its own job in a chain of job dependencies
+
+import os
+import sys
+import glob
+import datetime
+import Jobs
+import Tools
+import Wait
+import FileOps
+import PerfDB
+import JobTracker
+import Validate
+
+# The progress file written by the segment jobs (See Jobs.check_lines()), in the run directory
+PROGRESS_FILE = "wrf_segments.txt"
+# The share of a segment's walltime planned for integration, the rest covers start up and writing the restart files
+SEGMENT_MARGIN = 0.8
+# The segment length used when wrf_segment_hours is not set and no past run of the domain is recorded in PerfDB
+DEFAULT_SEGMENT_HOURS = 12
+
+# walltime_seconds: The seconds in a PBS walltime (HH:MM:SS)
+def walltime_seconds(walltime):
+	seconds = 0
+	for part in walltime.split(':'):
+		seconds = seconds * 60 + int(part)
+	return seconds
+
+# segmented: True if wrf.exe is run in restart segments (wrf_segment_walltime or wrf_segment_hours is set)
+def segmented(settings):
+	return settings.fetch("wrf_segment_walltime") != None or settings.fetch("wrf_segment_hours") != None
+
+# Segments: Splits the wrf.exe run into segments of the same number of forecast hours, the restart interval. Each segment has its own
+#  namelist (namelist.input.seg<N>, restart = .true. after the first) and job (wrf_seg<N>.job, asking for wrf_segment_walltime), and
+#  each job depends on the one before it (qsub -W depend=afterok:<id>). A job exits with an error unless wrf.exe completed and wrote
+#  the restart file the next segment starts from, so the rest of the chain is removed. The outcome of each segment is appended to
+#  wrf_segments.txt in the run directory (wrf_seg<N> for each segment, wrf for the last one), a run started again resumes from the
+#  last restart file written after wrfinput_d01.
+class Segments:
+	aSet = None
+	modelParms = None
+	logger = None
+	fileOps = None
+	runDir = ""
+	outDir = ""
+	progressFile = ""
+	hours = DEFAULT_SEGMENT_HOURS
+	bounds = []
+
+	def __init__(self, settings, modelParms):
+		self.aSet = settings
+		self.modelParms = modelParms
+		self.logger = Tools.loggedPrint.instance()
+		self.fileOps = FileOps.FileOps(settings)
+		self.runDir = settings.fetch("rundir")
+		self.outDir = self.runDir + "/output"
+		self.progressFile = self.runDir + '/' + PROGRESS_FILE
+		self.hours = self.segment_hours()
+		self.bounds = []
+		start = settings.startTime
+		while start < settings.endTime:
+			end = min(start + datetime.timedelta(hours = self.hours), settings.endTime)
+			self.bounds.append((start, end))
+			start = end
+		self.logger.write("   4.c. > wrf.exe runs in " + str(len(self.bounds)) + " restart segments of " + str(self.hours) + " forecast hours")
+
+	# segment_hours: wrf_segment_hours if set, otherwise the forecast hours that fit in wrf_segment_walltime (Less SEGMENT_MARGIN) at the
+	#  speed of the past runs of this domain on the same job size
+	def segment_hours(self):
+		settings = self.aSet
+		if(settings.fetch("wrf_segment_hours") != None):
+			return max(1, int(settings.fetch("wrf_segment_hours")))
+		perHour = PerfDB.PerfDB(settings).seconds_per_hour(settings)
+		if(perHour == None or perHour <= 0):
+			self.logger.write("   4.c. > No past runs of this domain on " + settings.fetch("num_wrf_nodes") + "x" + settings.fetch("num_wrf_processors") +
+							  " ranks in PerfDB, using " + str(DEFAULT_SEGMENT_HOURS) + " hour segments")
+			return DEFAULT_SEGMENT_HOURS
+		hours = max(1, int(walltime_seconds(settings.fetch("wrf_segment_walltime")) * SEGMENT_MARGIN / perHour))
+		self.logger.write("   4.c. > Past runs take " + str(round(perHour, 1)) + " s per forecast hour, " + str(hours) + " hours fit in " + settings.fetch("wrf_segment_walltime"))
+		return hours
+
+	def stage(self, i):
+		return "wrf" if i == len(self.bounds) - 1 else "wrf_seg" + str(i + 1)
+
+	def job_file(self, i):
+		return "wrf_seg" + str(i + 1) + ".job"
+
+	# restart_file: The restart file written at the end of segment i, io_form_restart 102 writes one file per rank (<name>_NNNN)
+	def restart_file(self, i):
+		return "wrfrst_d01_" + Jobs.wrf_date(self.bounds[i][1])
+
+	# write: Write the namelist and job file of every segment, the wrf.exe replacement keys must be set (See ModelRun.write_wrf_namelist())
+	def write(self, tWrite):
+		settings = self.aSet
+		for i, (start, end) in enumerate(self.bounds):
+			keys = {"[restart]": ".true." if i > 0 else ".false.",
+					"[restart_interval]": str(self.hours * 60),
+					"[run_days]": "0",
+					"[run_hours]": str(int((end - start).total_seconds() // 3600)),
+					"[start_year]": str(start.year), "[start_month]": str(start.month), "[start_day]": str(start.day), "[start_hour]": str(start.hour),
+					"[end_year]": str(end.year), "[end_month]": str(end.month), "[end_day]": str(end.day), "[end_hour]": str(end.hour)}
+			name = "namelist.input.seg" + str(i + 1)
+			if tWrite.generateTemplatedFile(settings.fetch("headdir") + "templates/namelist.input.template", name, extraKeys = keys):
+				self.logger.write("   4.c. Failed to generate " + name + " for wrf.exe")
+				sys.exit("   4.c. ERROR: Unresolved template keys in namelist.input, check control.txt")
+			self.fileOps.move([name], self.outDir + '/' + name)
+			with open(self.runDir + '/' + self.job_file(i), 'w') as target_file:
+				target_file.write(self.job_contents(i))
+
+	def job_contents(self, i):
+		settings = self.aSet
+		walltime = settings.fetch("wrf_segment_walltime") if settings.fetch("wrf_segment_walltime") != None else settings.fetch("wrf_walltime")
+		logs = ["../wrf_log_seg" + str(n + 1) + ".txt" for n in range(len(self.bounds))]
+		errorLogs = ["../wrf_error_log_seg" + str(n + 1) + ".txt" for n in range(len(self.bounds))]
+		contents = "#!/bin/bash\n"
+		contents += "#PBS -l nodes=" + settings.fetch("num_wrf_nodes") + ":ppn=" + settings.fetch("num_wrf_processors") + "\n"
+		contents += "#PBS -N WRF_SEG" + str(i + 1) + "\n"
+		contents += "#PBS -l walltime=" + walltime + "\n"
+		contents += "#PBS -A climlab" + "\n\n"
+		contents += "source " + settings.fetch("sourcefile") + '\n'
+		contents += "ulimit -s unlimited\n"
+		contents += "cd " + self.outDir + "\n\n"
+		contents += "rm -f rsl.out.* rsl.error.*\n"
+		contents += "cp namelist.input.seg" + str(i + 1) + " namelist.input\n"
+		contents += "mpirun -np " + str(int(settings.fetch("num_wrf_nodes")) * int(settings.fetch("num_wrf_processors"))) + " wrf.exe" + '\n'
+		contents += "mv rsl.out.0000 " + logs[i] + "\n"
+		contents += "mv rsl.error.0000 " + errorLogs[i] + "\n"
+		contents += "rm -f rsl.out.* rsl.error.*\n"
+		condition = "grep -q \"SUCCESS COMPLETE WRF\" " + logs[i]
+		onSuccess = ""
+		if(i < len(self.bounds) - 1):
+			condition += " && ls " + self.restart_file(i) + "* > /dev/null 2>&1"
+		else:
+			# The logs of every segment are joined as the logs of a single run (See PerfDB)
+			onSuccess = "\tcat " + " ".join(logs) + " > ../wrf_log.txt\n\tcat " + " ".join(errorLogs) + " > ../wrf_error_log.txt\n"
+		contents += Jobs.check_lines(self.stage(i), condition, self.progressFile, onSuccess = onSuccess)
+		return contents
+
+	# pending: The first segment left to run, segments after the first start from the restart file of the one before, which must have
+	#  been written after the current wrfinput_d01
+	def pending(self):
+		progress = Jobs.read_progress(self.progressFile)
+		try:
+			inputTime = os.stat(self.outDir + "/wrfinput_d01").st_mtime
+		except OSError:
+			return 0
+		first = 0
+		for i in range(len(self.bounds) - 1):
+			restarts = glob.glob(self.outDir + '/' + self.restart_file(i) + "*")
+			if(progress.get(self.stage(i)) != "complete" or not restarts or min(os.stat(path).st_mtime for path in restarts) < inputTime):
+				break
+			first = i + 1
+		return first
+
+	# stages: The segments from first to the last, as stages of a job chain (See Chain)
+	def stages(self, first):
+		return [{"stage": self.stage(i), "dir": self.runDir, "jobFile": self.job_file(i)} for i in range(first, len(self.bounds))]
+
+	# run: Submit the segments left to run as a dependency chain and follow them, incremental (IncrementalPost) is polled alongside.
+	#  Returns True once the last segment is complete
+	def run(self, incremental = None):
+		settings = self.aSet
+		first = self.pending()
+		if(first > 0):
+			self.logger.write("  4.c. Resuming wrf.exe from segment " + str(first + 1) + " of " + str(len(self.bounds)) + " (" + self.restart_file(first - 1) + ")")
+		else:
+			validate = Validate.Validate(settings, self.modelParms)
+			if(not validate.check(validate.input_jobs(), "wrf.exe inputs")):
+				self.logger.write("  4.c. Cannot run wrf.exe without valid wrfinput_d01 and wrfbdy_d01")
+				return False
+			self.fileOps.remove([self.progressFile])
+		submitted = []
+		previous = None
+		for stage in self.stages(first):
+			command = "qsub " + ("-W depend=afterok:" + previous + " " if previous != None else "")
+			with Tools.cd(self.runDir):
+				self.fileOps.chmod_x([stage["jobFile"]])
+				jobSub = Tools.popen(settings, command + stage["jobFile"])
+			if(settings.fetch("debugmode") != '1' and jobSub.jobID == None):
+				self.logger.write("  4.c. Failed to submit " + stage["jobFile"] + ": " + jobSub.fetch()[1].strip())
+				JobTracker.JobTracker.instance().cancel([s[1].jobID for s in submitted])
+				return False
+			submitted.append((stage, jobSub))
+			previous = jobSub.jobID if jobSub.jobID != None else "<" + stage["stage"] + ">"
+		self.logger.write("  4.c. " + str(len(submitted)) + " wrf.exe segments submitted")
+		if(settings.fetch("debugmode") == '1'):
+			return True
+		for n, (stage, jobSub) in enumerate(submitted):
+			i = first + n
+			try:
+				holds = [{"watchFile": self.progressFile, "contains": stage["stage"] + " complete", "retCode": 1},
+						 {"watchFile": self.progressFile, "contains": stage["stage"] + " failed", "retCode": 2},] + Jobs.job_exited(jobSub, 3)
+				wRC = Wait.Wait(holds, timeDelay = 30, onPoll = incremental.poll if incremental != None else None, name = "wrf segment " + str(i + 1)).hold()
+			except Wait.TimeExpiredException:
+				sys.exit("wrf.exe job not completed, abort.")
+			if wRC != 1:
+				self.logger.write("  4.c. wrf.exe segment " + str(i + 1) + " failed (" + ("See wrf_log_seg" + str(i + 1) + ".txt" if wRC == 2 else Jobs.job_exit_text(jobSub)) + ")")
+				JobTracker.JobTracker.instance().cancel([s[1].jobID for s in submitted[n + 1:]])
+				return False
+			self.logger.write("  4.c. wrf.exe segment " + str(i + 1) + " of " + str(len(self.bounds)) + " complete (" + Jobs.wrf_date(self.bounds[i][1]) + ")")
+		return True
@@ -0,0 +1,348 @@
+#!/usr/bin/python
+# SplitJoin.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes and methods used to read and join the per-rank NetCDF files written with io_form 102 (IE: wrfrst, met_em), and the
+#  command used to list or join them:
+#   python SplitJoin.py list <directory>
+#   python SplitJoin.py join <split file name> [<output file>]
+
+import os
+import re
+import sys
+import mmap
+import glob
+import array
+import itertools
+from multiprocessing import Pool
+import Tools
+import Validate
+
+# The rank io_form 102 appends to each file name (<name>_NNNN)
+RANK_SUFFIX = re.compile(r"^(.+)_([0-9]{4,})$")
+
+# The decomposed dimensions: The tile's patch start attribute, the global attribute holding the full length and the difference between
+#  the two (Unstaggered dimensions are one shorter than the grid dimension)
+PATCH_DIMENSIONS = {
+	"west_east": ("WEST-EAST_PATCH_START_UNSTAG", "WEST-EAST_GRID_DIMENSION", -1),
+	"west_east_stag": ("WEST-EAST_PATCH_START_STAG", "WEST-EAST_GRID_DIMENSION", 0),
+	"south_north": ("SOUTH-NORTH_PATCH_START_UNSTAG", "SOUTH-NORTH_GRID_DIMENSION", -1),
+	"south_north_stag": ("SOUTH-NORTH_PATCH_START_STAG", "SOUTH-NORTH_GRID_DIMENSION", 0),
+}
+
+# array typecodes of the NetCDF types (NC_BYTE to NC_UINT64), the data in the files is big-endian
+TYPECODES = {1: 'b', 2: 'B', 3: 'h', 4: 'i', 5: 'f', 6: 'd', 7: 'B', 8: 'H', 9: 'I', 10: 'q', 11: 'Q'}
+
+# The commands of the tool
+COMMANDS = ["list", "join"]
+
+# rank_files: The per-rank files of a split file, in rank order
+def rank_files(name):
+	found = []
+	for path in glob.glob(name + "_[0-9][0-9][0-9][0-9]*"):
+		match = RANK_SUFFIX.match(path)
+		if(match and match.group(1) == name):
+			found.append((int(match.group(2)), path))
+	return [path for rank, path in sorted(found)]
+
+# split_sets: The split files in a directory, {name: [per-rank files]}
+def split_sets(directory):
+	sets = {}
+	for path in glob.glob(os.path.join(directory, "*_[0-9][0-9][0-9][0-9]*")):
+		match = RANK_SUFFIX.match(path)
+		if match:
+			sets.setdefault(match.group(1), []).append(path)
+	return dict((name, rank_files(name)) for name in sets)
+
+def product(values):
+	result = 1
+	for value in values:
+		result *= value
+	return result
+
+# strides: The byte stride of each dimension of a C ordered array
+def strides(shape, size):
+	result = []
+	for i in range(len(shape)):
+		result.append(product(shape[i + 1:]) * size)
+	return result
+
+# copy_tile: Copy one tile of a variable from source into the full-domain variable in target, one row of the innermost dimension at a
+#  time. source is a memoryview of the mapped rank file so rows are read without an intermediate copy
+def copy_tile(source, sourceBegin, target, targetBegin, tileShape, fullShape, offsets, size):
+	if not tileShape:
+		target[targetBegin:targetBegin + size] = source[sourceBegin:sourceBegin + size]
+		return
+	row = tileShape[-1] * size
+	tileStrides = strides(tileShape, size)
+	fullStrides = strides(fullShape, size)
+	targetBegin += sum(offset * stride for offset, stride in zip(offsets, fullStrides))
+	for index in itertools.product(*[range(n) for n in tileShape[:-1]]):
+		s = sourceBegin + sum(i * stride for i, stride in zip(index, tileStrides))
+		t = targetBegin + sum(i * stride for i, stride in zip(index, fullStrides))
+		target[t:t + row] = source[s:s + row]
+
+def pack(value, size):
+	return value.to_bytes(size, "big")
+
+def name_bytes(name, countSize):
+	raw = name.encode("ascii")
+	return pack(len(raw), countSize) + raw + b"\x00" * (Validate.padded(len(raw)) - len(raw))
+
+def attribute_bytes(attributes, countSize):
+	if not attributes:
+		return pack(0, 4) + pack(0, countSize)
+	out = pack(Validate.NC_ATTRIBUTE, 4) + pack(len(attributes), countSize)
+	for name, ncType, count, raw in attributes:
+		out += name_bytes(name, countSize) + pack(ncType, 4) + pack(count, countSize) + raw + b"\x00" * (Validate.padded(len(raw)) - len(raw))
+	return out
+
+# join_variables: Worker for the process pool, copies the tiles of the named variables into the output file (Already sized and holding
+#  its header). Returns (variables copied, error)
+def join_variables(job):
+	name, outPath, names = job
+	try:
+		split = SplitFile(name)
+		try:
+			with open(outPath, "r+b") as f:
+				out = mmap.mmap(f.fileno(), 0)
+			target = memoryview(out)
+			try:
+				header = Validate.parse_classic(out)
+				begins = dict((var["name"], var["begin"]) for var in header["variables"])
+				for varName in names:
+					split.copy(varName, target, begins[varName], header["recordSize"])
+			finally:
+				target.release()
+				out.flush()
+				out.close()
+		finally:
+			split.close()
+		return (len(names), None)
+	except (IOError, OSError, ValueError, IndexError, KeyError) as e:
+		return (0, str(e))
+
+# SplitFile: The per-rank files of one split file (<name>_0000, <name>_0001, ...). Each rank file holds the patch of one MPI rank, its
+#  place in the domain is taken from the patch start attributes in its header. Rank files are memory mapped, a variable is assembled
+#  from the tiles when it is read (read()) or written to a joined classic NetCDF file (join(), variables copied on a process pool)
+class SplitFile:
+	name = ""
+	tiles = []
+	dimensions = {}
+	numrecs = 0
+
+	def __init__(self, name):
+		self.name = name
+		self.tiles = []
+		paths = rank_files(name)
+		if not paths:
+			raise ValueError("No per-rank files found for " + name)
+		try:
+			for path in paths:
+				with open(path, "rb") as f:
+					data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+				tile = {"path": path, "data": data, "view": memoryview(data)}
+				self.tiles.append(tile)
+				if not data[0:4] in (b"CDF\x01", b"CDF\x02", b"CDF\x05"):
+					raise ValueError(path + " is not a classic NetCDF file")
+				tile["header"] = Validate.parse_classic(data)
+				tile["offsets"] = self.patch_offsets(path, tile["header"])
+			first = self.tiles[0]["header"]
+			self.numrecs = first["numrecs"]
+			self.dimensions = {}
+			for dimName, length in first["dimensionList"]:
+				if dimName in PATCH_DIMENSIONS:
+					length = first["attributes"][PATCH_DIMENSIONS[dimName][1]][0] + PATCH_DIMENSIONS[dimName][2]
+				self.dimensions[dimName] = length
+			self.check_tiles()
+		except (IOError, OSError, ValueError, IndexError, KeyError):
+			self.close()
+			raise
+
+	def patch_offsets(self, path, header):
+		offsets = {}
+		for dimName, length in header["dimensionList"]:
+			if dimName in PATCH_DIMENSIONS:
+				start = header["attributes"].get(PATCH_DIMENSIONS[dimName][0])
+				if(start == None):
+					raise ValueError(path + " has no " + PATCH_DIMENSIONS[dimName][0] + " attribute (Not written with io_form 102)")
+				offsets[dimName] = start[0] - 1
+		return offsets
+
+	# check_tiles: Every rank must hold the same records and the tiles must cover the domain
+	def check_tiles(self):
+		for tile in self.tiles:
+			if(tile["header"]["numrecs"] != self.numrecs):
+				raise ValueError(tile["path"] + " holds " + str(tile["header"]["numrecs"]) + " records, rank 0 holds " + str(self.numrecs))
+		if("west_east" in self.dimensions and "south_north" in self.dimensions):
+			covered = sum(tile["header"]["dimensions"]["west_east"] * tile["header"]["dimensions"]["south_north"] for tile in self.tiles)
+			if(covered != self.dimensions["west_east"] * self.dimensions["south_north"]):
+				raise ValueError(str(len(self.tiles)) + " rank files cover " + str(covered) + " of " + str(self.dimensions["west_east"] * self.dimensions["south_north"]) +
+								 " grid points, a rank file is missing")
+
+	def close(self):
+		for tile in self.tiles:
+			tile["view"].release()
+			tile["data"].close()
+		self.tiles = []
+
+	def variable(self, varName, tile = None):
+		for var in (tile if tile != None else self.tiles[0])["header"]["variables"]:
+			if(var["name"] == varName):
+				return var
+		raise KeyError("No variable " + varName + " in " + self.name)
+
+	def variables(self):
+		return [var["name"] for var in self.tiles[0]["header"]["variables"]]
+
+	# dimension_names: The dimensions of a variable, the record dimension first for record variables
+	def dimension_names(self, varName):
+		dimensionList = self.tiles[0]["header"]["dimensionList"]
+		return [dimensionList[dimID][0] for dimID in self.variable(varName)["dims"]]
+
+	# shape: The full-domain shape of a variable, records included
+	def shape(self, varName):
+		var = self.variable(varName)
+		names = self.dimension_names(varName)
+		return ([self.numrecs] if var["record"] else []) + [self.dimensions[n] for n in (names[1:] if var["record"] else names)]
+
+	# copy: Copy every tile of a variable into target (A writable buffer) where the full-domain variable starts at begin. Records are
+	#  recordSize bytes apart in target, records limits the copy to those records (Written one after the other)
+	def copy(self, varName, target, begin, recordSize = 0, records = None):
+		names = self.dimension_names(varName)
+		decomposed = any(n in PATCH_DIMENSIONS for n in names)
+		for tile in self.tiles:
+			if(not decomposed and tile is not self.tiles[0]):
+				# Variables without a decomposed dimension (IE: Times, ZNU) are the same on every rank
+				break
+			header = tile["header"]
+			var = self.variable(varName, tile)
+			dimIDs = var["dims"][1:] if var["record"] else var["dims"]
+			dimNames = names[1:] if var["record"] else names
+			tileShape = [header["dimensionList"][dimID][1] for dimID in dimIDs]
+			fullShape = [self.dimensions[n] for n in dimNames]
+			offsets = [tile["offsets"].get(n, 0) for n in dimNames]
+			size = Validate.TYPE_SIZES[var["type"]]
+			if not var["record"]:
+				copy_tile(tile["view"], var["begin"], target, begin, tileShape, fullShape, offsets, size)
+				continue
+			for n, record in enumerate(records if records != None else range(self.numrecs)):
+				copy_tile(tile["view"], var["begin"] + record * header["recordSize"], target, begin + n * recordSize, tileShape, fullShape, offsets, size)
+
+	# read: Assemble one variable (One record of it if record is given) without joining the rest of the file. Returns (shape, values),
+	#  values is an array.array in native byte order, or bytes for NC_CHAR variables
+	def read(self, varName, record = None):
+		var = self.variable(varName)
+		shape = self.shape(varName)
+		if(var["record"] and record != None):
+			shape = shape[1:]
+		size = Validate.TYPE_SIZES[var["type"]]
+		out = bytearray(product(shape) * size)
+		target = memoryview(out)
+		try:
+			self.copy(varName, target, 0, product(shape[1:]) * size if var["record"] else 0, [record] if record != None else None)
+		finally:
+			target.release()
+		if(var["type"] == 2):
+			return (shape, bytes(out))
+		values = array.array(TYPECODES[var["type"]])
+		values.frombytes(bytes(out))
+		if(sys.byteorder == "little"):
+			values.byteswap()
+		return (shape, values)
+
+	# layout: The joined file's header, CDF2 (Or CDF5 once a variable no longer fits in 4 GiB) with the full-domain dimensions and the
+	#  patch attributes covering the domain. Returns (header bytes, total size)
+	def layout(self):
+		first = self.tiles[0]["header"]
+		sizes = {}
+		for var in first["variables"]:
+			names = self.dimension_names(var["name"])
+			sizes[var["name"]] = Validate.TYPE_SIZES[var["type"]] * product(self.dimensions[n] for n in (names[1:] if var["record"] else names))
+		version = 5 if any(size > 2 ** 32 - 4 for size in sizes.values()) else 2
+		countSize = 8 if version == 5 else 4
+		# The patch of the joined file is the whole domain
+		fixed = {}
+		for dimName, (startName, gridName, delta) in PATCH_DIMENSIONS.items():
+			if dimName in self.dimensions:
+				fixed[startName] = 1
+				fixed[startName.replace("_START_", "_END_")] = self.dimensions[dimName]
+		attributes = [(a[0], a[1], a[2], pack(fixed[a[0]], 4)) if a[0] in fixed and a[1] == 4 and a[2] == 1 else a for a in first["attributeList"]]
+		records = [var for var in first["variables"] if var["record"]]
+		recordSize = sizes[records[0]["name"]] if len(records) == 1 else sum(Validate.padded(sizes[var["name"]]) for var in records)
+
+		def header_bytes(begins):
+			out = b"CDF" + bytes([version]) + pack(self.numrecs, countSize)
+			out += pack(Validate.NC_DIMENSION, 4) + pack(len(first["dimensionList"]), countSize)
+			for dimName, length in first["dimensionList"]:
+				out += name_bytes(dimName, countSize) + pack(self.dimensions[dimName], countSize)
+			out += attribute_bytes(attributes, countSize)
+			out += pack(Validate.NC_VARIABLE, 4) + pack(len(first["variables"]), countSize)
+			for var in first["variables"]:
+				out += name_bytes(var["name"], countSize) + pack(len(var["dims"]), countSize) + b"".join(pack(dimID, countSize) for dimID in var["dims"])
+				out += attribute_bytes(var["attributes"], countSize) + pack(var["type"], 4)
+				out += pack(min(Validate.padded(sizes[var["name"]]), 2 ** 32 - 1) if version != 5 else Validate.padded(sizes[var["name"]]), countSize)
+				out += pack(begins.get(var["name"], 0), 8)
+			return out
+
+		position = len(header_bytes({}))
+		begins = {}
+		for var in first["variables"]:
+			if not var["record"]:
+				begins[var["name"]] = position
+				position += Validate.padded(sizes[var["name"]])
+		recordStart = position
+		for var in records:
+			begins[var["name"]] = position
+			position += Validate.padded(sizes[var["name"]])
+		return (header_bytes(begins), recordStart + self.numrecs * recordSize)
+
+	# join: Write the joined file (A classic NetCDF file as written with io_form 2) to outPath, the variables are split between the
+	#  processes of a pool (Default: CPU count), each mapping the rank files and the output on its own
+	def join(self, outPath, processes = None):
+		logger = Tools.loggedPrint.instance()
+		header, total = self.layout()
+		with open(outPath + ".tmp", "wb") as f:
+			f.write(header)
+			f.truncate(total)
+		processes = processes if processes != None else (os.cpu_count() or 1)
+		names = self.variables()
+		jobs = [(self.name, outPath + ".tmp", names[i::processes]) for i in range(processes) if names[i::processes]]
+		if(len(jobs) <= 1):
+			results = [join_variables(job) for job in jobs]
+		else:
+			pool = Pool(processes = len(jobs))
+			try:
+				results = pool.map(join_variables, jobs)
+			finally:
+				pool.close()
+				pool.join()
+		errors = [error for count, error in results if error != None]
+		if errors:
+			os.remove(outPath + ".tmp")
+			logger.write("SplitJoin: Failed to join " + self.name + ": " + "; ".join(errors))
+			return False
+		os.rename(outPath + ".tmp", outPath)
+		logger.write("SplitJoin: Joined " + str(len(self.tiles)) + " rank files of " + os.path.basename(self.name) + " (" + str(len(names)) + " variables) into " + outPath)
+		return True
+
+if __name__ == "__main__":
+	if(len(sys.argv) < 3 or not sys.argv[1] in COMMANDS):
+		print("Usage: python SplitJoin.py list <directory> | join <split file name> [<output file>]")
+		sys.exit(2)
+	logger = Tools.loggedPrint.instance()
+	success = True
+	if(sys.argv[1] == "list"):
+		for name, paths in sorted(split_sets(sys.argv[2]).items()):
+			logger.write(name + ": " + str(len(paths)) + " rank files")
+	else:
+		try:
+			split = SplitFile(sys.argv[2])
+		except (IOError, OSError, ValueError, IndexError, KeyError) as e:
+			logger.write("SplitJoin: " + str(e))
+			success = False
+		else:
+			success = split.join(sys.argv[3] if len(sys.argv) > 3 else sys.argv[2])
+			split.close()
+	logger.close()
+	sys.exit(0 if success else 1)
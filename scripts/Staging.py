@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# Staging.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes used to stage the WRF run tables and executables (wrfrunfiles) into a run's output directory without copying them
+
+import os
+import json
+import fcntl
+import glob
+import shutil
+import Tools
+import FileOps
+
+# The files staged by default, as patterns relative to wrfrunfiles: every regular file of the WRF run/ directory
+MANIFEST = ["*"]
+
+# Names never staged, namelist.input is written by the program and the files of headdir/run_files are copied in (See Jobs.JobSteps)
+EXCLUDE = ["namelist.input"]
+
+# The tables and executables staged before the record of staged files was written, used to unstage those directories
+RECORDLESS_MANIFEST = ["real.exe", "wrf.exe", "tc.exe",
+			"aero*", "bulk*", "CAM*", "capacity.asc", "CCN*", "CLM*", "co2_trans", "coeff*", "constants.asc", "create_p3_lookupTable_1.f90",
+			"ETA*", "GEN*", "grib*", "kernels*", "LANDUSE.TBL", "masses.asc", "MPTABLE.TBL", "ozone*", "p3_lookup_table_1.dat", "RRTM*",
+			"SOILPARM.TBL", "termvels.asc", "tr*", "URB*", "VEG*", "wind-turbine-1.tbl"]
+
+# The record of the staged files, written to the output directory
+RECORD = "staged_files.json"
+
+# FICLONE ioctl (linux/fs.h), clones the extents of one file into another on filesystems that support it (btrfs, XFS)
+FICLONE = 0x40049409
+
+# reflink_file: Copy-on-write clone of source at dest, raises OSError if the filesystem cannot clone
+def reflink_file(source, dest):
+	try:
+		with open(source, "rb") as s:
+			with open(dest, "wb") as d:
+				fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+	except (IOError, OSError):
+		if os.path.lexists(dest):
+			os.remove(dest)
+		raise
+	shutil.copymode(source, dest)
+
+# read_manifest: Patterns from a manifest file, one per line, # starts a comment
+def read_manifest(path):
+	patterns = []
+	with open(path) as f:
+		for line in f:
+			line = line.split('#')[0].strip()
+			if line:
+				patterns.append(line)
+	return patterns
+
+# Staging: Places the files listed in the manifest (Every file of wrfrunfiles, or the patterns in the file at staging_manifest in control.txt) into a directory as
+#  symbolic links, hardlinks or reflinks (staging_mode: symlink, hardlink, reflink or copy, Default: symlink). Hardlinks fall back to
+#  symbolic links across filesystems and reflinks fall back to copies where cloning is not supported. The staged names are recorded in
+#  the directory so unstage() removes exactly what was staged.
+class Staging:
+	aSet = None
+	logger = None
+	fileOps = None
+	source = ""
+	mode = "symlink"
+	manifest = []
+	exclude = []
+
+	def __init__(self, settings):
+		self.aSet = settings
+		self.logger = Tools.loggedPrint.instance()
+		self.fileOps = FileOps.FileOps(settings)
+		self.source = settings.fetch("wrfrunfiles")
+		self.mode = settings.fetch("staging_mode") if settings.fetch("staging_mode") != None else "symlink"
+		if(settings.fetch("staging_manifest") != None):
+			self.manifest = read_manifest(settings.fetch("staging_manifest"))
+		else:
+			self.manifest = MANIFEST
+		self.exclude = EXCLUDE + [os.path.basename(path) for path in glob.glob(str(settings.fetch("headdir")) + "run_files/*")]
+
+	# files: The regular files matched by the manifest, less the excluded names
+	def files(self):
+		return [path for path in self.fileOps.expand([self.source + pattern for pattern in self.manifest])
+				if os.path.isfile(path) and not os.path.basename(path) in self.exclude]
+
+	# place: Put one file into the directory using the staging mode, returns the mode actually used
+	def place(self, path, target):
+		if os.path.lexists(target):
+			os.remove(target)
+		if(self.mode == "hardlink"):
+			try:
+				os.link(path, target)
+				return "hardlink"
+			except OSError:
+				pass
+		elif(self.mode == "reflink"):
+			try:
+				reflink_file(path, target)
+				return "reflink"
+			except (IOError, OSError):
+				shutil.copy(path, target)
+				return "copy"
+		elif(self.mode == "copy"):
+			shutil.copy(path, target)
+			return "copy"
+		os.symlink(path, target)
+		return "symlink"
+
+	# stage: Place the manifest files into directory, returns True if every file was staged
+	def stage(self, directory):
+		if self.aSet.fetch("debugmode") == '1':
+			for pattern in self.manifest:
+				print("D: stage (" + self.mode + ") " + self.source + pattern + " " + directory)
+			return True
+		def apply(path):
+			target = directory + '/' + os.path.basename(path)
+			try:
+				return FileOps.OpResult(self.place(path, target), path, target)
+			except (IOError, OSError) as e:
+				return FileOps.OpResult("stage", path, target, ok = False, error = e)
+		result = self.fileOps.report("stage", FileOps.FileOpsResult(self.fileOps.run(apply, self.files())))
+		staged = [os.path.basename(r.target) for r in result.results if r.ok]
+		with open(directory + '/' + RECORD, 'w') as f:
+			json.dump({"source": self.source, "mode": self.mode, "files": staged}, f, indent = 1)
+		modes = {}
+		for r in result.results:
+			if r.ok:
+				modes[r.op] = modes.get(r.op, 0) + 1
+		self.logger.write("  - Staged " + str(len(staged)) + " WRF run files from " + self.source + " (" + ", ".join(m + ": " + str(c) for m, c in sorted(modes.items())) + ")")
+		return result.ok()
+
+	# staged_patterns: The paths to remove to unstage directory. Directories staged before the record existed fall back to the
+	#  tables and executables staged at the time (RECORDLESS_MANIFEST)
+	def staged_patterns(self, directory):
+		try:
+			with open(directory + '/' + RECORD) as f:
+				names = json.load(f)["files"]
+			return [directory + '/' + name for name in names] + [directory + '/' + RECORD]
+		except (IOError, OSError, ValueError, KeyError):
+			return [directory + '/' + pattern for pattern in RECORDLESS_MANIFEST]
+
+	# unstage: Remove the staged files from directory, links are removed without touching the files in wrfrunfiles
+	def unstage(self, directory):
+		return self.fileOps.remove(self.staged_patterns(directory))
@@ -4,27 +4,83 @@
 #
 # Contains methods used to modify and save the templated files
 
+import os
+import re
 import ApplicationSettings
+import Tools
+
+# Placeholders are written as [key] in the template files
+KEY_PATTERN = re.compile(r"\[[A-Za-z0-9_]+\]")
+
+# CompiledTemplate: A template split once into literal text and [key] tokens, rendered in a single pass from a lookup table
+class CompiledTemplate:
+	tokens = []
+	keys = []
+
+	def __init__(self, text):
+		self.tokens = []
+		pos = 0
+		for match in KEY_PATTERN.finditer(text):
+			if(match.start() > pos):
+				self.tokens.append((False, text[pos:match.start()]))
+			self.tokens.append((True, match.group(0)))
+			pos = match.end()
+		if(pos < len(text)):
+			self.tokens.append((False, text[pos:]))
+		self.keys = sorted(set(token for isKey, token in self.tokens if isKey))
+
+	# render: Returns the rendered text and the list of keys that had no value, unresolved keys are left in the text as-is
+	def render(self, lookup):
+		out = []
+		unresolved = []
+		for isKey, token in self.tokens:
+			if isKey:
+				value = lookup.get(token)
+				if value is None:
+					if not token in unresolved:
+						unresolved.append(token)
+					out.append(token)
+				else:
+					out.append(str(value))
+			else:
+				out.append(token)
+		return "".join(out), unresolved
+
+# Compiled templates, keyed by path and invalidated when the file's mtime or size changes
+compiledCache = {}
+
+# compile_file: Returns the CompiledTemplate for a template file, lines are stripped as the templates have always been written
+def compile_file(inFile):
+	st = os.stat(inFile)
+	stamp = (st.st_mtime, st.st_size)
+	cached = compiledCache.get(inFile)
+	if cached != None and cached[0] == stamp:
+		return cached[1]
+	with open(inFile, 'r') as source_file:
+		text = "".join(line.strip() + '\n' for line in source_file)
+	compiled = CompiledTemplate(text)
+	compiledCache[inFile] = (stamp, compiled)
+	return compiled
 
 # Template_Writer: Class responsible for taking the template files and saving the use files with parameters set
 class Template_Writer:
 	aSet = None
-	
+
 	def __init__(self, settings):
 		self.aSet = settings
-					
+
+	# render: Render a template file with the settings' replacement keys, extraKeys take precedence. Returns (text, unresolved keys)
+	def render(self, inFile, extraKeys = None):
+		lookup = dict(self.aSet.replacementKeys)
+		if(extraKeys != None):
+			lookup.update(extraKeys)
+		return compile_file(inFile).render(lookup)
+
+	# generateTemplatedFile: Writes the rendered template to outFile, returns the list of unresolved keys (Empty on success)
 	def generateTemplatedFile(self, inFile, outFile, extraKeys = None):
-		inContents = []
-		with open(inFile, 'r') as source_file:
-			for line in source_file:
-				inContents.append(line.strip())
-		
+		text, unresolved = self.render(inFile, extraKeys)
 		with open(outFile, 'w') as target_file:
-			for line in inContents:
-				newLine = line
-				newLine = self.aSet.replace(newLine)
-				if(extraKeys != None):
-					for key, value in extraKeys.items():
-						newLine = newLine.replace(key, value)
-				newLine += '\n'
-				target_file.write(newLine)	
\ No newline at end of file
+			target_file.write(text)
+		if unresolved:
+			Tools.loggedPrint.instance().write("Template_Writer: " + outFile + " has unresolved keys: " + ", ".join(unresolved) + " (Check control.txt)")
+		return unresolved
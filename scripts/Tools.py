@@ -9,44 +9,55 @@ import os
 import os.path
 import datetime
 import ApplicationSettings
+import Logging
 import subprocess
 import time
+import math
+import threading
 
-def detect_ideal_processors(grid_x, grid_y, nodes, procs_per_node, wrf_io_groups, wrf_io_procs):
-	smallest_x = grid_x / 10
-	biggest_y_pair = 0
-
-	smallest_x_io = smallest_x
-	biggest_y_io = biggest_y_pair
-	
-	total_nodes = nodes * procs_per_node
-	io_procs = wrf_io_groups * wrf_io_procs
-
-	remaining = total_nodes - io_procs	
+# rank_decompositions: Enumerate the (nproc_x, nproc_y) layouts of the compute ranks (Total ranks less the I/O quilt ranks) and rank them.
+#  Only divisor pairs of the compute rank count are considered. Each candidate is scored by:
+#   - halo: Total halo-exchange perimeter relative to an ideal square decomposition (1.0 is best)
+#   - squareness: Longest over shortest patch side (1.0 is best)
+#   - io_aligned: nproc_y is a multiple of wrf_io_procs (nio_tasks_per_group), required for the quilt servers to split rows evenly
+#  Patches smaller than min_patch points in either direction are rejected. Lower scores are better.
+def rank_decompositions(grid_x, grid_y, nodes, procs_per_node, wrf_io_groups, wrf_io_procs, min_patch = 10):
+	remaining = nodes * procs_per_node - wrf_io_groups * wrf_io_procs
+	if(remaining <= 0):
+		return []
+	idealHalo = 2.0 * math.sqrt(float(grid_x) * grid_y * remaining)
+	divisors = []
+	for i in range(1, int(math.sqrt(remaining)) + 1):
+		if(remaining % i == 0):
+			divisors.append(i)
+			if(i * i != remaining):
+				divisors.append(remaining // i)
+	candidates = []
+	for nproc_x in divisors:
+		nproc_y = remaining // nproc_x
+		patch_x = grid_x // nproc_x
+		patch_y = grid_y // nproc_y
+		if(patch_x < min_patch or patch_y < min_patch):
+			continue
+		halo = (grid_x * nproc_y + grid_y * nproc_x) / idealHalo
+		squareness = float(max(patch_x, patch_y)) / min(patch_x, patch_y)
+		io_aligned = (wrf_io_procs <= 0 or nproc_y % wrf_io_procs == 0)
+		score = halo + 0.25 * (squareness - 1.0)
+		if not io_aligned:
+			score += 1.0
+		# Tie-break toward longer x patches, x is the contiguous dimension in WRF's arrays
+		if(nproc_x > nproc_y):
+			score += 0.01
+		candidates.append({"nproc_x": nproc_x, "nproc_y": nproc_y, "patch_x": patch_x, "patch_y": patch_y,
+						   "halo": halo, "squareness": squareness, "io_aligned": io_aligned, "score": score})
+	return sorted(candidates, key = lambda c: c["score"])
 
-	found = False
-	foundIO = False
-
-	for i in range(1, (int)(grid_x / 10)+1):
-		for j in range(1, (int)(grid_y / 10)+1):
-			if(i * j == remaining):
-				if((grid_x / i > 10) and (grid_y / j > 10)):
-					if(i < smallest_x):
-						smallest_x = i
-						biggest_y_pair = j
-						# Check for good IO
-						if(biggest_y_pair % wrf_io_procs == 0):
-							smallest_x_io = i
-							biggest_y_io = j
-							foundIO = True
-					found = True
-	if foundIO:
-		return ((smallest_x_io, biggest_y_io))
-	else:
-		if found:
-			return ((smallest_x, biggest_y_pair))
-		else:
-			return None
+# detect_ideal_processors: Returns the best (nproc_x, nproc_y) from rank_decompositions, or None if no decomposition is valid
+def detect_ideal_processors(grid_x, grid_y, nodes, procs_per_node, wrf_io_groups, wrf_io_procs):
+	ranked = rank_decompositions(grid_x, grid_y, nodes, procs_per_node, wrf_io_groups, wrf_io_procs)
+	if not ranked:
+		return None
+	return ((ranked[0]["nproc_x"], ranked[0]["nproc_y"]))
 
 #CD: Current Directory management, see https://stackoverflow.com/a/13197763/7537290 for implementation. This is used to maintain the overall OS CWD while allowing embedded changes.
 class cd:
@@ -61,19 +72,31 @@ class cd:
     def __exit__(self, etype, value, traceback):
         os.chdir(self.savedPath)
 		
+#run_command: Runs a shell command and returns its [stdout, stderr] as text
+def run_command(command):
+	runCmd = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	cResult, stderr = runCmd.communicate()
+	return [cResult.decode("utf-8", "replace"), stderr.decode("utf-8", "replace")]
+
 #popen: A wrapped call to the subprocess.popen method to test for the debugging flag.
+#  Job submissions (qsub) are routed through the JobTracker so the job ID printed by the scheduler is recorded in jobID.
 class popen:
+	stored = ["", ""]
+	jobID = None
+
 	def __init__(self, settings, command):
+		self.jobID = None
 		if(settings.fetch("debugmode") == '1'):
 			print("D: " + command)
+			self.stored = ["", ""]
 		else:
-			runCmd = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-			runCmd.wait()
-			cResult, stderr = runCmd.communicate()
-			cResult = str(cResult)
-			stderr = str(stderr)
-			self.stored = [cResult, stderr]
-			loggedPrint.instance().write("popen(" + command +"): " + self.stored[0] + ", " + self.stored[1])
+			if(command.startswith("qsub ")):
+				# Imported here as JobTracker depends on this module
+				import JobTracker
+				self.stored, self.jobID = JobTracker.JobTracker.instance().submit(command)
+			else:
+				self.stored = run_command(command)
+			loggedPrint.instance().write("popen(" + command + ")", fields = {"command": command, "stdout": self.stored[0], "stderr": self.stored[1]})
 			
 	def fetch(self):
 		return self.stored
@@ -96,37 +119,23 @@ class Singleton:
     def __instancecheck__(self, inst):
         return isinstance(inst, self._decorated)
 		
-@Singleton
-class loggedPrint:
-	f = None
-	filePath = None
-	
-	def __init__(self):
-		curTime = datetime.date.today().strftime("%B%d%Y-%H%M%S")
-		curDir = os.path.dirname(os.path.abspath(__file__)) 	
-		logName = "wrf_run_script_" + str(curTime) + ".log"	
-		logFile = curDir + '/' + logName
-		self.filePath = logFile
-	
-	def write(self, out):
-		self.f = open(self.filePath, "a")
-		self.f.write(out + '\n')
-		self.f.close()
-		print(out)
-	
-	def close(self):
-		self.f.close()
-		
+#loggedPrint: The program logger, kept under its original name (See Logging.py)
+loggedPrint = Logging.Logger
+
 #BreakException: Custom exception that is thrown if the Process HoldUntilOpen() never completes
 class BreakException(Exception):
 	pass		
 		
+#Process: The lock held by a job step while it runs, steps wait in HoldUntilOpen() until it is released. Steps running on other
+#  threads (See Pipeline) are woken as soon as Unlock() is called
 @Singleton
 class Process:
 	lock = False
+	condition = None
 	
 	def __init__(self):
 		self.lock = False
+		self.condition = threading.Condition()
 		
 	def CanStart(self):
 		return (self.lock == False)
@@ -137,15 +146,19 @@ class Process:
 		if(breakTime != None):
 			expTime = currentTime + datetime.timedelta(seconds=int(breakTime))
 		
-		while(datetime.datetime.utcnow() < expTime):
-			if(self.CanStart() == True):
-				return True
-			time.sleep(10)
+		with self.condition:
+			while(datetime.datetime.utcnow() < expTime):
+				if(self.CanStart() == True):
+					return True
+				self.condition.wait((expTime - datetime.datetime.utcnow()).total_seconds())
 		raise BreakException
 		return False
 		
 	def Lock(self):
-		self.lock = True
+		with self.condition:
+			self.lock = True
 		
 	def Unlock(self):
-		self.lock = False
\ No newline at end of file
+		with self.condition:
+			self.lock = False
+			self.condition.notify_all()
\ No newline at end of file
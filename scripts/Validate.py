@@ -0,0 +1,324 @@
+#!/usr/bin/python
+# Validate.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains classes and methods used to check the met_em, wrfinput, wrfbdy and wrfout files from their NetCDF headers on a process pool
+
+import os
+import mmap
+import glob
+import datetime
+from multiprocessing import Pool
+import Tools
+
+# Header tags and the byte size of each NetCDF type (NC_BYTE to NC_UINT64)
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+# numrecs of a classic (CDF5) file still being streamed, its record count is not final yet
+STREAMING = (0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF)
+
+# The date written in the Times variable of the WRF and metgrid files
+def times_text(time):
+	return time.strftime("%Y-%m-%d_%H:%M:%S")
+
+# span: The first and last of a list of times, for the logs
+def span(times):
+	return "None" if not times else times[0] if len(times) == 1 else times[0] + " to " + times[-1]
+
+def padded(length):
+	return (length + 3) // 4 * 4
+
+# Reader: Reads the fields of a classic NetCDF header, counts are 4 bytes in CDF1/CDF2 and 8 bytes in CDF5 (As are offsets in CDF2/CDF5)
+class Reader:
+	data = None
+	position = 0
+	countSize = 4
+	offsetSize = 4
+
+	def __init__(self, data, version):
+		self.data = data
+		self.position = 4
+		self.countSize = 8 if version == 5 else 4
+		self.offsetSize = 4 if version == 1 else 8
+
+	def integer(self, size):
+		if(self.position + size > len(self.data)):
+			raise ValueError("header ends at byte " + str(len(self.data)) + ", the file is truncated")
+		value = int.from_bytes(self.data[self.position:self.position + size], "big")
+		self.position += size
+		return value
+
+	def count(self):
+		return self.integer(self.countSize)
+
+	def name(self):
+		length = self.count()
+		text = self.data[self.position:self.position + length].decode("ascii", "replace")
+		self.position += padded(length)
+		return text
+
+	# raw: The bytes of count values of type ncType, the position moves past their padding
+	def raw(self, ncType, count):
+		size = TYPE_SIZES.get(ncType)
+		if size == None:
+			raise ValueError("unknown attribute type " + str(ncType))
+		raw = bytes(self.data[self.position:self.position + size * count])
+		self.position += padded(size * count)
+		return raw
+
+	# list_of: A header list (dim_list, gatt_list, var_list), absent lists are written as two zeros
+	def list_of(self, tag, item):
+		found = self.integer(4)
+		count = self.count()
+		if(found == 0 and count == 0):
+			return []
+		if(found != tag):
+			raise ValueError("bad header tag " + str(found) + " at byte " + str(self.position))
+		return [item() for i in range(count)]
+
+	def dimension(self):
+		return (self.name(), self.count())
+
+	# attribute: (name, type, count, raw bytes), see decode() for the values
+	def attribute(self):
+		name = self.name()
+		ncType = self.integer(4)
+		count = self.count()
+		return (name, ncType, count, self.raw(ncType, count))
+
+	def variable(self):
+		name = self.name()
+		dimIDs = [self.count() for i in range(self.count())]
+		attributes = self.list_of(NC_ATTRIBUTE, self.attribute)
+		ncType = self.integer(4)
+		self.count() # vsize, computed from the dimensions as it is clamped for large variables
+		return {"name": name, "dims": dimIDs, "attributes": attributes, "type": ncType, "begin": self.integer(self.offsetSize)}
+
+# decode: The values of an attribute, text for NC_CHAR and a tuple of integers (Or the raw bytes for floating point types) otherwise
+def decode(ncType, raw):
+	size = TYPE_SIZES[ncType]
+	if(ncType == 2):
+		return raw.decode("ascii", "replace").rstrip("\x00")
+	if ncType in (1, 3, 4, 10):
+		return tuple(int.from_bytes(raw[i:i + size], "big", signed = True) for i in range(0, len(raw), size))
+	if ncType in (7, 8, 9, 11):
+		return tuple(int.from_bytes(raw[i:i + size], "big") for i in range(0, len(raw), size))
+	return raw
+
+# parse_classic: The header of a classic NetCDF file, its dimensions, global attributes (Decoded, and as read in attributeList) and
+#  variables (With their size and placement)
+def parse_classic(data):
+	version = data[3]
+	reader = Reader(data, version)
+	numrecs = reader.count()
+	dimensions = reader.list_of(NC_DIMENSION, reader.dimension)
+	attributeList = reader.list_of(NC_ATTRIBUTE, reader.attribute)
+	variables = reader.list_of(NC_VARIABLE, reader.variable)
+	for var in variables:
+		if any(dimID >= len(dimensions) for dimID in var["dims"]):
+			raise ValueError("variable " + var["name"] + " uses an undefined dimension")
+		if not var["type"] in TYPE_SIZES:
+			raise ValueError("variable " + var["name"] + " has an unknown type " + str(var["type"]))
+		# The record dimension has length 0 and can only be the first dimension of a variable
+		var["record"] = bool(var["dims"]) and dimensions[var["dims"][0]][1] == 0
+		size = TYPE_SIZES[var["type"]]
+		for dimID in (var["dims"][1:] if var["record"] else var["dims"]):
+			size *= dimensions[dimID][1]
+		var["size"] = size
+	records = [var for var in variables if var["record"]]
+	# Record variables are interleaved, one record of each per record. A single record variable is not padded
+	recordSize = records[0]["size"] if len(records) == 1 else sum(padded(var["size"]) for var in records)
+	return {"format": "CDF" + str(version), "version": version, "numrecs": numrecs, "dimensionList": dimensions, "dimensions": dict(dimensions),
+			"attributeList": attributeList, "attributes": dict((a[0], decode(a[1], a[3])) for a in attributeList), "variables": variables,
+			"recordSize": recordSize, "headerSize": reader.position}
+
+# expected_size: The smallest size of a complete file, the end of the last fixed variable or of the last record
+def expected_size(header):
+	end = header["headerSize"]
+	for var in header["variables"]:
+		if var["record"]:
+			end = max(end, var["begin"] + (header["numrecs"] - 1) * header["recordSize"] + var["size"] if header["numrecs"] > 0 else var["begin"])
+		else:
+			end = max(end, var["begin"] + var["size"])
+	return end
+
+# record_times: The Times variable of each record (IE: 2019-05-26_00:00:00)
+def record_times(data, header):
+	for var in header["variables"]:
+		if(var["name"] == "Times" and var["record"]):
+			return [bytes(data[var["begin"] + r * header["recordSize"]:var["begin"] + r * header["recordSize"] + var["size"]]).decode("ascii", "replace").rstrip("\x00 ")
+					for r in range(header["numrecs"])]
+	return None
+
+# hdf5_end: The end of file address in the superblock of a NetCDF-4 (HDF5) file, the superblock may follow a user block (512 bytes,
+#  doubling). Only the superblock is read, the dimensions and times of these files are not checked
+def hdf5_end(data):
+	base = 0
+	while base + 8 <= len(data) and data[base:base + 8] != HDF5_SIGNATURE:
+		base = 512 if base == 0 else base * 2
+	if(base + 8 > len(data)):
+		raise ValueError("no HDF5 superblock found")
+	version = data[base + 8]
+	if version in (0, 1):
+		offsetSize = data[base + 13]
+		position = base + 24 + (4 if version == 1 else 0) + 2 * offsetSize
+	elif version in (2, 3):
+		offsetSize = data[base + 9]
+		position = base + 12 + 2 * offsetSize
+	else:
+		raise ValueError("unknown HDF5 superblock version " + str(version))
+	if(position + offsetSize > len(data)):
+		raise ValueError("the HDF5 superblock is truncated")
+	return base + int.from_bytes(data[position:position + offsetSize], "little")
+
+# check_header: Compare a parsed header with the expectation, returns the problems found
+def check_header(data, header, expected):
+	problems = []
+	if(header["numrecs"] in STREAMING):
+		return ["the record count is not final (The file is still being written)"]
+	if(len(data) < expected_size(header)):
+		problems.append("truncated, " + str(len(data)) + " of " + str(expected_size(header)) + " bytes")
+	for name, value in expected.get("attributes", {}).items():
+		found = header["attributes"].get(name)
+		if(found == None or (found[0] if isinstance(found, tuple) else found) != value):
+			problems.append(name + " is " + str(found[0] if isinstance(found, tuple) else found) + ", expected " + str(value))
+	for name, value in expected.get("dimensions", {}).items():
+		if(header["dimensions"].get(name) != value):
+			problems.append("dimension " + name + " is " + str(header["dimensions"].get(name)) + ", expected " + str(value))
+	if(expected.get("times") != None):
+		times = record_times(data, header)
+		if(times == None):
+			problems.append("no Times variable")
+		elif(times != expected["times"]):
+			problems.append("Times holds " + str(len(times)) + " records (" + span(times) + "), expected " + str(len(expected["times"])) + " (" + span(expected["times"]) + ")")
+	return problems
+
+# validate_file: Worker for the process pool, maps one file and checks its header against expected ({"times": [...], "attributes": {},
+#  "dimensions": {}}). Only the pages holding the header and the Times records are read. Returns (path, description, problems)
+def validate_file(job):
+	path, expected = job
+	if expected.get("split"):
+		return check_split(path, expected)
+	try:
+		with open(path, "rb") as f:
+			if(os.fstat(f.fileno()).st_size == 0):
+				return (path, "", ["zero-length file"])
+			data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		try:
+			if data[0:4] in (b"CDF\x01", b"CDF\x02", b"CDF\x05"):
+				header = parse_classic(data)
+				return (path, header["format"] + ", " + str(header["numrecs"]) + " records", check_header(data, header, expected))
+			end = hdf5_end(data)
+			return (path, "HDF5", [] if len(data) >= end else ["truncated, " + str(len(data)) + " of " + str(end) + " bytes"])
+		finally:
+			data.close()
+	except (IOError, OSError) as e:
+		return (path, "", [e.strerror if e.strerror != None else str(e)])
+	except (ValueError, IndexError) as e:
+		return (path, "", [str(e)])
+
+# check_split: Check a file written with io_form 102 as its per-rank files (<name>_NNNN). Every rank file is checked against expected, then
+#  the ranks must hold the same records and their tiles must cover the domain (See SplitJoin.SplitFile). Returns (name, description, problems)
+def check_split(name, expected):
+	# Imported here as SplitJoin depends on this module
+	import SplitJoin
+	paths = SplitJoin.rank_files(name)
+	if not paths:
+		return (name, "", ["no per-rank files"])
+	rankExpected = dict((key, value) for key, value in expected.items() if key != "split")
+	problems = []
+	for path in paths:
+		rPath, description, found = validate_file((path, rankExpected))
+		problems.extend("rank " + path[len(name) + 1:] + ": " + problem for problem in found)
+	if not problems:
+		try:
+			SplitJoin.SplitFile(name).close()
+		except (IOError, OSError, ValueError, IndexError, KeyError) as e:
+			problems.append(str(e))
+	return (name, str(len(paths)) + " rank files", problems)
+
+# Validate: Checks the files of a run from their headers before the jobs that read them are submitted. Classic NetCDF files (CDF1, CDF2
+#  and CDF5) must be complete, hold the expected Times records and the grid of control.txt (e_we, e_sn, e_vert, num_metgrid_levels),
+#  NetCDF-4 files must be as long as their superblock says. Files are checked on a process pool (validate_processes in control.txt,
+#  Default: CPU count)
+class Validate:
+	aSet = None
+	logger = None
+	processes = 1
+	outDir = ""
+	dates = []
+
+	def __init__(self, settings, modelParms):
+		self.aSet = settings
+		self.logger = Tools.loggedPrint.instance()
+		self.processes = os.cpu_count() or 1
+		if(settings.fetch("validate_processes") != None):
+			self.processes = int(settings.fetch("validate_processes"))
+		self.outDir = settings.fetch("rundir") + "/output/"
+		# The boundary times, every HourDelta hours of the model data from the start to the end of the run
+		self.dates = []
+		current = settings.startTime
+		while current <= settings.endTime:
+			self.dates.append(current)
+			current += datetime.timedelta(hours = modelParms.fetch()["HourDelta"])
+
+	def grid(self, vertical):
+		attributes = {"WEST-EAST_GRID_DIMENSION": int(self.aSet.fetch("e_we")), "SOUTH-NORTH_GRID_DIMENSION": int(self.aSet.fetch("e_sn"))}
+		if vertical:
+			attributes["BOTTOM-TOP_GRID_DIMENSION"] = int(self.aSet.fetch("e_vert"))
+		return attributes
+
+	# met_em_jobs: One met_em file per boundary time, named with or without colons. With io_form_metgrid = 102 each time is a set of
+	#  per-rank files (<name>_NNNN), checked together (See check_split())
+	def met_em_jobs(self):
+		# Imported here as SplitJoin depends on this module
+		import SplitJoin
+		jobs = []
+		for date in self.dates:
+			found = sorted(glob.glob(self.outDir + "met_em.d01." + date.strftime("%Y-%m-%d_%H?%M?%S") + "*"))
+			expected = {"times": [times_text(date)], "attributes": self.grid(False), "dimensions": {"num_metgrid_levels": int(self.aSet.fetch("num_metgrid_levels"))}}
+			ranks = [SplitJoin.RANK_SUFFIX.match(path) for path in found]
+			if(found and all(ranks)):
+				expected["split"] = True
+				jobs.append((ranks[0].group(1), expected))
+			else:
+				jobs.append((found[0] if found else self.outDir + "met_em.d01." + times_text(date) + ".nc", expected))
+		return jobs
+
+	# input_jobs: wrfinput_d01 holds the start time, wrfbdy_d01 one record per boundary interval
+	def input_jobs(self):
+		return [(self.outDir + "wrfinput_d01", {"times": [times_text(self.dates[0])], "attributes": self.grid(True)}),
+				(self.outDir + "wrfbdy_d01", {"times": [times_text(date) for date in self.dates[:-1]], "attributes": self.grid(True)})]
+
+	# wrfout_jobs: Each wrfout file holds one frame (frames_per_outfile = 1) at the date in its name
+	def wrfout_jobs(self, fList):
+		jobs = []
+		for path in fList:
+			date = os.path.basename(path).split("_", 2)[-1]
+			jobs.append((path, {"times": [date[0:10] + "_" + date[11:19].replace("_", ":")], "attributes": self.grid(True)}))
+		return jobs
+
+	# check: Validate the files of jobs ([(path, expected)]), every problem is logged. Returns True if all files passed
+	def check(self, jobs, label):
+		if(self.aSet.fetch("debugmode") == '1' or not jobs):
+			return True
+		if(self.processes <= 1 or len(jobs) == 1):
+			results = [validate_file(job) for job in jobs]
+		else:
+			pool = Pool(processes = min(self.processes, len(jobs)))
+			try:
+				results = pool.map(validate_file, jobs)
+			finally:
+				pool.close()
+				pool.join()
+		failed = 0
+		for path, description, problems in results:
+			if problems:
+				failed += 1
+				self.logger.write("  -> Validate: " + os.path.basename(path) + (" (" + description + ")" if description else "") + ": " + "; ".join(problems))
+		self.logger.write("  -> Validate: " + label + ", " + str(len(results) - failed) + " of " + str(len(results)) + " files passed")
+		return failed == 0
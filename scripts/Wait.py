@@ -6,61 +6,155 @@
 
 import datetime
 import time
-import sys
-import os
-import subprocess
 import Tools
+import LogWatcher
+import JobTracker
+import Metrics
 
 #TimeExpiredException: Custom exception that is thrown when the Wait() command expires
 class TimeExpiredException(Exception):
 	pass
-					
+
 # Wait: Class instance designed to establish a hold condition until execution has been completed
+#  Each hold is a dictionary, either:
+#   - {"watchFile": <glob>, ...}: The file(s) are followed in-process by LogWatcher, only newly appended text is tested each poll
+#   - {"waitCommand": <shell command>, ...}: The command is run in a shell each poll and its output is tested
+#   - {"jobID": <scheduler job ID>, "jobState": <JobTracker state>, ...}: Matches once the tracked job reaches the state
+#  And one test: "exists" (watchFile only), "contains", "isValue" or "isNotValue", with "retCode" being returned on a match.
+#  A watchFile "contains" test with "tail": <lines> looks at the last lines of each file instead of the new text (Up to LogWatcher.TAIL_LINES),
+#  used for failure markers, as words such as "error" also appear in the normal output of the WRF programs.
+#  For watchFile holds, timeDelay is the longest time between polls, the hold wakes early when the kernel reports a change.
+#  onNewText, if given, is called with {pattern: text} whenever the watched files grow, before the conditions are tested.
+#  onPoll, if given, is called once per poll, used to run work alongside the hold (IE: IncrementalPost)
+#  Each hold() is timed as a "wait <name>" span (Default: the first watched file), with the queue and run time of the jobs it holds on
 class Wait:
 	holds = []
 	currentTime = ""
 	abortTime = ""
 	timeDelay = ""
-	
-	def __init__(self, holdList, abortTime = None, timeDelay=10):
+	onNewText = None
+	onPoll = None
+	name = None
+
+	def __init__(self, holdList, abortTime = None, timeDelay=10, onNewText = None, onPoll = None, name = None):
 		self.holds = holdList
+		self.name = name
+		self.onNewText = onNewText
+		self.onPoll = onPoll
 		self.currentTime = datetime.datetime.utcnow()
 		self.abortTime = self.currentTime + datetime.timedelta(days=int(999))
 		self.timeDelay = timeDelay
 		if(abortTime != None):
 			self.abortTime = self.currentTime + datetime.timedelta(seconds=int(abortTime))
-	
+
 	def hold(self):
-		cTime = datetime.datetime.utcnow()
-		while cTime < self.abortTime:
-			for indHold in self.holds:
-				command = indHold["waitCommand"]
-				retCode = indHold["retCode"]
-				#cResult = os.popen(command).read()
-				
-				runCmd = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-				runCmd.wait()
-				cResult, stderr = runCmd.communicate()
-				cResult = str(cResult)
-				stderr = str(stderr)
-				
-				if 'splitFirst' in indHold:
-					cResult = cResult.split()[0]
-				if 'contains' in indHold:
-					contains = indHold["contains"]
-					if(contains in cResult):
-						return retCode
-				elif 'isValue' in indHold:
-					isValue = indHold["isValue"]
-					if(cResult == isValue):
-						return retCode
-				elif 'isNotValue' in indHold:
-					isValue = indHold["isNotValue"]
-					if(cResult != isValue):
-						return retCode
-				else:
-					return cResult	
-			time.sleep(self.timeDelay)
+		name = self.name
+		if name is None:
+			name = next((indHold.get("watchFile", indHold.get("waitCommand")) for indHold in self.holds if not 'jobID' in indHold), "jobs")
+		jobIDs = [indHold["jobID"] for indHold in self.holds if 'jobID' in indHold]
+		with Metrics.span("wait " + name, jobIDs):
+			return self.hold_loop()
+
+	def hold_loop(self):
+		watcher = self.watcher()
+		try:
 			cTime = datetime.datetime.utcnow()
+			while cTime < self.abortTime:
+				result = self.check(watcher)
+				if result is not None:
+					return result
+				if watcher:
+					watcher.sleep(self.timeDelay)
+				else:
+					time.sleep(self.timeDelay)
+				cTime = datetime.datetime.utcnow()
+		finally:
+			if watcher:
+				watcher.close()
 		raise TimeExpiredException
-		return None
\ No newline at end of file
+		return None
+
+	# watcher: The LogWatcher following the watched files of the holds, None if there are none. The caller closes it
+	def watcher(self):
+		patterns = []
+		for indHold in self.holds:
+			if 'watchFile' in indHold and not indHold["watchFile"] in patterns:
+				patterns.append(indHold["watchFile"])
+		return LogWatcher.LogWatcher(patterns) if patterns else None
+
+	# check: Test the holds once, returns the retCode of the first match or None. Used by hold_loop(), or directly by a caller
+	#  polling several Waits at once (IE: Ensemble)
+	def check(self, watcher):
+		# Job states are refreshed before the logs are read, so a job seen as exited has its final log text tested first
+		if any('jobID' in indHold for indHold in self.holds):
+			JobTracker.JobTracker.instance().refresh()
+		# Read everything appended to the watched files once, then test every condition against it
+		newText = watcher.poll() if watcher else {}
+		if(self.onNewText != None and any(newText.values())):
+			self.onNewText(newText)
+		if(self.onPoll != None):
+			self.onPoll()
+		for indHold in self.holds:
+			if 'watchFile' in indHold:
+				result = self.test_watch(indHold, watcher, newText)
+			elif 'jobID' in indHold:
+				result = self.test_job(indHold)
+			else:
+				result = self.test_command(indHold)
+			if result is not None:
+				return result
+		return None
+
+	def test_watch(self, indHold, watcher, newText):
+		pattern = indHold["watchFile"]
+		retCode = indHold["retCode"]
+		if 'exists' in indHold:
+			if(watcher.exists(pattern) == indHold["exists"]):
+				return retCode
+			return None
+		if 'contains' in indHold:
+			text = watcher.tail(pattern, indHold["tail"]) if 'tail' in indHold else newText[pattern]
+			if(indHold["contains"] in text):
+				return retCode
+			return None
+		cResult = watcher.lastLine(pattern)
+		if 'splitFirst' in indHold:
+			cResult = cResult.split()[0] if cResult.split() else ""
+		if 'isValue' in indHold:
+			if(cResult == indHold["isValue"]):
+				return retCode
+		elif 'isNotValue' in indHold:
+			if(watcher.exists(pattern) and cResult != indHold["isNotValue"]):
+				return retCode
+		elif newText[pattern]:
+			return newText[pattern]
+		return None
+
+	def test_job(self, indHold):
+		if(JobTracker.JobTracker.instance().state(indHold["jobID"]) == indHold["jobState"]):
+			return indHold["retCode"]
+		return None
+
+	def test_command(self, indHold):
+		command = indHold["waitCommand"]
+		retCode = indHold["retCode"]
+
+		cResult, stderr = Tools.run_command(command)
+
+		if 'splitFirst' in indHold:
+			cResult = cResult.split()[0]
+		if 'contains' in indHold:
+			contains = indHold["contains"]
+			if(contains in cResult):
+				return retCode
+		elif 'isValue' in indHold:
+			isValue = indHold["isValue"]
+			if(cResult == isValue):
+				return retCode
+		elif 'isNotValue' in indHold:
+			isValue = indHold["isNotValue"]
+			if(cResult != isValue):
+				return retCode
+		else:
+			return cResult
+		return None
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# ncfiles.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Contains methods used by the tests to write small classic NetCDF files (CDF1/CDF2) shaped like the WRF and metgrid outputs, whole or
+#  split per rank as with io_form 102
+
+import struct
+
+NC_CHAR = 2
+NC_INT = 4
+
+def pad(data):
+	return data + b"\x00" * ((4 - len(data) % 4) % 4)
+
+def name_bytes(name):
+	return struct.pack(">i", len(name)) + pad(name.encode())
+
+# classic: The bytes of a classic NetCDF file. dims is [(name, length)] (Length 0 for the record dimension), attributes is
+#  [(name, value)] with int or str values, variables is [(name, type, [dimension names], data)] where data is the bytes of a fixed
+#  variable or a list of the bytes of each record
+def classic(dims, attributes, variables, numrecs, version = 1):
+	offsetSize = 4 if version == 1 else 8
+	dimIDs = dict((name, i) for i, (name, length) in enumerate(dims))
+	header = b"CDF" + bytes([version]) + struct.pack(">i", numrecs)
+	header += struct.pack(">ii", 10, len(dims)) + b"".join(name_bytes(name) + struct.pack(">i", length) for name, length in dims)
+	header += struct.pack(">ii", 12, len(attributes))
+	for name, value in attributes:
+		if isinstance(value, str):
+			header += name_bytes(name) + struct.pack(">ii", NC_CHAR, len(value)) + pad(value.encode())
+		else:
+			header += name_bytes(name) + struct.pack(">iii", NC_INT, 1, value)
+	header += struct.pack(">ii", 11, len(variables))
+	size = lambda data: len(data[0]) if isinstance(data, list) else len(data)
+	headerSize = len(header) + sum(len(name_bytes(v[0])) + 4 + 4 * len(v[2]) + 8 + 8 + offsetSize for v in variables)
+	records = [v for v in variables if isinstance(v[3], list)]
+	begins = {}
+	position = headerSize
+	for v in variables:
+		if not isinstance(v[3], list):
+			begins[v[0]] = position
+			position += len(pad(v[3]))
+	for v in records:
+		begins[v[0]] = position
+		position += size(v[3]) if len(records) == 1 else len(pad(v[3][0]))
+	for name, ncType, names, data in variables:
+		header += name_bytes(name) + struct.pack(">i", len(names)) + b"".join(struct.pack(">i", dimIDs[n]) for n in names)
+		header += struct.pack(">ii", 0, 0) + struct.pack(">ii", ncType, len(pad(data[0] if isinstance(data, list) else data)))
+		header += struct.pack(">i" if offsetSize == 4 else ">q", begins[name])
+	out = header
+	for v in variables:
+		if not isinstance(v[3], list):
+			out += pad(v[3])
+	for r in range(numrecs):
+		for v in records:
+			out += v[3][r] if len(records) == 1 else pad(v[3][r])
+	return out
+
+def ints(values):
+	return b"".join(struct.pack(">i", value) for value in values)
+
+# wrf_value: The value the test files hold at a grid point, so a joined file can be checked point by point
+def wrf_value(record, k, j, i):
+	return record * 100000 + k * 10000 + j * 100 + i
+
+# wrf_tile: A WRF-like file holding the patch [xs, xe] x [ys, ye] (1-based, unstaggered) of a grid of WE x SN points (Grid dimensions,
+#  one more than the unstaggered length) and NZ levels: ZNU(bottom_top), HGT(south_north, west_east) and the records Times and
+#  T(Time, bottom_top, south_north, west_east). extra adds or replaces global attributes
+def wrf_tile(times, xs, xe, ys, ye, WE, SN, NZ = 2, version = 1, extra = None):
+	nx = xe - xs + 1
+	ny = ye - ys + 1
+	dims = [("Time", 0), ("DateStrLen", 19), ("west_east", nx), ("south_north", ny), ("bottom_top", NZ)]
+	attributes = [("TITLE", "OUTPUT FROM TEST"), ("WEST-EAST_GRID_DIMENSION", WE), ("SOUTH-NORTH_GRID_DIMENSION", SN), ("BOTTOM-TOP_GRID_DIMENSION", NZ + 1),
+				  ("WEST-EAST_PATCH_START_UNSTAG", xs), ("WEST-EAST_PATCH_END_UNSTAG", xe),
+				  ("SOUTH-NORTH_PATCH_START_UNSTAG", ys), ("SOUTH-NORTH_PATCH_END_UNSTAG", ye)]
+	if extra != None:
+		attributes = [(name, extra.get(name, value)) for name, value in attributes] + [(name, value) for name, value in extra.items() if not name in dict(attributes)]
+	points = [(j, i) for j in range(ys - 1, ye) for i in range(xs - 1, xe)]
+	variables = [("ZNU", NC_INT, ["bottom_top"], ints(range(NZ))),
+				 ("HGT", NC_INT, ["south_north", "west_east"], ints(wrf_value(0, 0, j, i) for j, i in points)),
+				 ("Times", NC_CHAR, ["Time", "DateStrLen"], [t.encode() for t in times]),
+				 ("T", NC_INT, ["Time", "bottom_top", "south_north", "west_east"], [ints(wrf_value(r, k, j, i) for k in range(NZ) for j, i in points) for r in range(len(times))])]
+	return classic(dims, attributes, variables, len(times), version)
+
+# write_split: Write name_NNNN for each patch [(xs, xe, ys, ye)], returns the paths
+def write_split(name, times, patches, WE, SN, NZ = 2):
+	paths = []
+	for rank, (xs, xe, ys, ye) in enumerate(patches):
+		paths.append(name + "_%04d" % rank)
+		with open(paths[-1], "wb") as f:
+			f.write(wrf_tile(times, xs, xe, ys, ye, WE, SN, NZ))
+	return paths
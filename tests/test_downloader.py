@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# test_downloader.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Tests of Downloader.py against a local http.server: range resume, retry after a dropped connection and GRIB verification
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import Logging
+import Downloader
+
+# A small complete GRIB file, the indicator section, a body and the 7777 end section
+PAYLOAD = b"GRIB" + bytes(range(256)) * 40 + b"7777"
+
+# Settings: Stands in for ApplicationSettings, only fetch() is used by Downloader
+class Settings:
+	settings = {}
+
+	def __init__(self, settings = None):
+		self.settings = settings if settings != None else {}
+
+	def fetch(self, key):
+		return self.settings.get(key)
+
+# Handler: Serves server.payload at any path, honouring "Range: bytes=<n>-". While server.drops is above zero a request sends the
+#  full Content-Length but closes the connection half way through the body. Every request's Range header is kept in server.ranges
+class Handler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		payload = self.server.payload
+		rangeHeader = self.headers.get("Range")
+		self.server.ranges.append(rangeHeader)
+		offset = 0
+		if rangeHeader != None:
+			offset = int(rangeHeader[len("bytes="):].split('-')[0])
+			self.send_response(206)
+			self.send_header("Content-Range", "bytes " + str(offset) + "-" + str(len(payload) - 1) + "/" + str(len(payload)))
+		else:
+			self.send_response(200)
+		body = payload[offset:]
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		if(self.server.drops > 0):
+			self.server.drops -= 1
+			self.wfile.write(body[:len(body) // 2])
+			self.wfile.flush()
+			self.close_connection = True
+			return
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class DownloaderTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		# Keep the program log out of the scripts directory
+		Logging.Logger.instance().filePath = self.tmp + "/test.log"
+		self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		self.server.payload = PAYLOAD
+		self.server.drops = 0
+		self.server.ranges = []
+		self.thread = threading.Thread(target = self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		self.url = "http://127.0.0.1:" + str(self.server.server_address[1]) + "/cfs/flxf.grb2"
+		self.dest = self.tmp + "/flxf.grb2"
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		Logging.Logger.instance().close()
+		shutil.rmtree(self.tmp)
+
+	def downloader(self, retries = 3):
+		downloader = Downloader.Downloader(Settings({"download_threads": "1", "download_retries": str(retries)}))
+		downloader.backoff = 0.01
+		return downloader
+
+	def read_dest(self):
+		with open(self.dest, "rb") as f:
+			return f.read()
+
+	def test_resumes_part_file_with_range(self):
+		with open(self.dest + ".part", "wb") as f:
+			f.write(PAYLOAD[:1000])
+		result = self.downloader().fetch([Downloader.DownloadTask(self.url, self.dest, verify = Downloader.grib_complete)])[0]
+		self.assertTrue(result.ok)
+		self.assertEqual(self.server.ranges, ["bytes=1000-"])
+		self.assertEqual(result.received, len(PAYLOAD) - 1000)
+		self.assertEqual(self.read_dest(), PAYLOAD)
+		self.assertFalse(os.path.exists(self.dest + ".part"))
+
+	def test_retries_dropped_connection_with_backoff(self):
+		self.server.drops = 2
+		with unittest.mock.patch("Downloader.time.sleep") as sleep:
+			result = self.downloader(retries = 3).fetch([Downloader.DownloadTask(self.url, self.dest, verify = Downloader.grib_complete)])[0]
+		self.assertTrue(result.ok)
+		self.assertEqual(result.attempts, 3)
+		# Each retry resumes from the bytes already written, waiting twice as long as the one before
+		self.assertEqual(self.server.ranges[0], None)
+		self.assertTrue(all(r != None and r.startswith("bytes=") for r in self.server.ranges[1:]))
+		self.assertEqual([call.args[0] for call in sleep.call_args_list], [0.01, 0.02])
+		self.assertEqual(self.read_dest(), PAYLOAD)
+
+	def test_gives_up_after_retries(self):
+		self.server.drops = 5
+		with unittest.mock.patch("Downloader.time.sleep"):
+			result = self.downloader(retries = 2).fetch([Downloader.DownloadTask(self.url, self.dest)])[0]
+		self.assertFalse(result.ok)
+		self.assertEqual(result.attempts, 2)
+		self.assertFalse(os.path.exists(self.dest))
+
+	def test_grib_complete_rejects_truncated_file(self):
+		self.server.payload = PAYLOAD[:-100]
+		with unittest.mock.patch("Downloader.time.sleep"):
+			result = self.downloader(retries = 2).fetch([Downloader.DownloadTask(self.url, self.dest, verify = Downloader.grib_complete)])[0]
+		self.assertFalse(result.ok)
+		self.assertEqual(result.error, "verification failed")
+		self.assertFalse(os.path.exists(self.dest))
+		self.assertFalse(os.path.exists(self.dest + ".part"))
+
+	def test_grib_complete(self):
+		with open(self.dest, "wb") as f:
+			f.write(PAYLOAD)
+		self.assertTrue(Downloader.grib_complete(self.dest))
+		with open(self.dest, "wb") as f:
+			f.write(PAYLOAD[:-1])
+		self.assertFalse(Downloader.grib_complete(self.dest))
+
+	def test_existing_complete_file_is_skipped(self):
+		with open(self.dest, "wb") as f:
+			f.write(PAYLOAD)
+		result = self.downloader().fetch([Downloader.DownloadTask(self.url, self.dest, verify = Downloader.grib_complete)])[0]
+		self.assertTrue(result.ok and result.skipped)
+		self.assertEqual(self.server.ranges, [])
+
+	def test_connections_closed_when_pool_finishes(self):
+		downloader = self.downloader()
+		opened = []
+		connection = downloader.connection
+		def record(url):
+			opened.append(connection(url))
+			return opened[-1]
+		downloader.connection = record
+		self.assertTrue(downloader.fetch([Downloader.DownloadTask(self.url, self.dest, verify = Downloader.grib_complete)])[0].ok)
+		self.assertTrue(len(opened) > 0)
+		self.assertTrue(all(conn.sock == None for conn in opened))
+		self.assertEqual(downloader.connections, [])
+
+if __name__ == "__main__":
+	unittest.main()
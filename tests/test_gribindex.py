@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# test_gribindex.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Tests of GribIndex.py against synthetic GRIB2 messages (Sections 0, 1, 3, 4, 5, 7 and the end section)
+
+import os
+import sys
+import json
+import struct
+import shutil
+import datetime
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import Logging
+import GribIndex
+
+# sign_magnitude: A GRIB2 signed integer, the top bit holds the sign
+def sign_magnitude(value, size = 4):
+	return ((1 << (8 * size - 1)) | -value if value < 0 else value).to_bytes(size, "big")
+
+def section(number, body):
+	return struct.pack(">IB", 5 + len(body), number) + body
+
+def section1(refTime):
+	return section(1, struct.pack(">HHBBB", 7, 0, 2, 1, 1) + struct.pack(">HBBBBB", refTime.year, refTime.month, refTime.day, refTime.hour, refTime.minute, refTime.second) + bytes([0, 1]))
+
+# latlon_grid: Section 3 with template 3.0 (Regular lat/lon), angles in microdegrees
+def latlon_grid(nx, ny, la1, lo1, la2, lo2, dx, dy):
+	body = bytes([0]) + struct.pack(">I", nx * ny) + bytes([0, 0]) + struct.pack(">H", 0) + bytes([6]) + bytes(15)
+	body += struct.pack(">II", nx, ny) + struct.pack(">II", 0, 0xFFFFFFFF)
+	body += sign_magnitude(la1) + struct.pack(">I", lo1) + bytes([48]) + sign_magnitude(la2) + struct.pack(">I", lo2) + struct.pack(">II", dx, dy) + bytes([64])
+	return section(3, body)
+
+# lambert_grid: Section 3 with template 3.30 (Lambert conformal), angles in microdegrees and spacing in mm
+def lambert_grid(nx, ny, la1, lo1, lad, lov, dx, dy, latin1, latin2):
+	body = bytes([0]) + struct.pack(">I", nx * ny) + bytes([0, 0]) + struct.pack(">H", 30) + bytes([6]) + bytes(15)
+	body += struct.pack(">II", nx, ny) + sign_magnitude(la1) + struct.pack(">I", lo1) + bytes([8]) + sign_magnitude(lad) + struct.pack(">I", lov)
+	body += struct.pack(">II", dx, dy) + bytes([0, 64]) + sign_magnitude(latin1) + sign_magnitude(latin2) + bytes(8)
+	return section(3, body)
+
+# product: Section 4 with template 4.0 (Or 4.8 with a statistical process), forecast in hours, scale applies to both surfaces
+def product(category, number, forecast, levelType, level, scale = 0, levelType2 = 255, level2 = 0, stat = None):
+	body = struct.pack(">HH", 0, 0 if stat is None else 8) + bytes([category, number, 2, 0, 96]) + struct.pack(">HB", 0, 0) + bytes([1])
+	body += sign_magnitude(forecast) + bytes([levelType]) + sign_magnitude(scale, 1) + sign_magnitude(level)
+	body += bytes([levelType2]) + sign_magnitude(scale if levelType2 != 255 else 0, 1) + sign_magnitude(level2 if levelType2 != 255 else 0)
+	if stat != None:
+		body += bytes(12) + bytes([1, 0]) + bytes(4) + bytes([stat]) + bytes(11)
+	return section(4, body)
+
+# message: One GRIB2 message, the data sections hold filler bytes that the index never reads
+def message(discipline, refTime, grid, field):
+	body = section1(refTime) + grid + field + section(5, bytes(16)) + section(7, b"\xAA" * 37) + b"7777"
+	return b"GRIB" + bytes([0, 0, discipline, 2]) + struct.pack(">Q", 16 + len(body)) + body
+
+REFTIME = datetime.datetime(2019, 5, 26, 0)
+GLOBAL = latlon_grid(360, 181, -90000000, 0, 90000000, 359000000, 1000000, 1000000)
+
+class GribIndexTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		# Keep the program log out of the scripts directory
+		Logging.Logger.instance().filePath = self.tmp + "/test.log"
+		self.messages = [message(0, REFTIME, GLOBAL, product(0, 0, 6, 100, 85000)),
+						 message(0, REFTIME, GLOBAL, product(0, 0, 6, 100, 50000)),
+						 message(0, REFTIME, GLOBAL, product(0, 0, 6, 103, 2)),
+						 message(0, REFTIME, GLOBAL, product(2, 2, 6, 103, 10)),
+						 message(0, REFTIME, GLOBAL, product(1, 8, 6, 1, 0, stat = 1)),
+						 message(2, REFTIME, GLOBAL, product(3, 18, 6, 106, 0, levelType2 = 106, level2 = 10, scale = 2))]
+		self.path = self.tmp + "/WRFPRS.GrbF06"
+		with open(self.path, "wb") as f:
+			# Padding between messages is skipped
+			f.write(self.messages[0] + self.messages[1] + bytes(4) + b"".join(self.messages[2:]))
+
+	def tearDown(self):
+		Logging.Logger.instance().close()
+		shutil.rmtree(self.tmp)
+
+	def test_signed(self):
+		self.assertEqual(GribIndex.signed(sign_magnitude(-90000000)), -90000000)
+		self.assertEqual(GribIndex.signed(sign_magnitude(42)), 42)
+		self.assertEqual(GribIndex.signed(b"\x81"), -1)
+
+	def test_scan_file(self):
+		index = GribIndex.scan_file(self.path)
+		self.assertEqual(index["grid"], {"template": 0, "nx": 360, "ny": 181, "la1": -90.0, "lo1": 0.0, "la2": 90.0, "lo2": 359.0, "dx": 1.0, "dy": 1.0, "scan": 64})
+		messages = index["messages"]
+		self.assertEqual(len(messages), 6)
+		self.assertEqual([m["offset"] for m in messages[0:3]], [0, len(self.messages[0]), len(self.messages[0]) + len(self.messages[1]) + 4])
+		self.assertEqual(messages[0]["length"], len(self.messages[0]))
+		self.assertEqual([(m["discipline"], m["category"], m["number"]) for m in messages], [(0, 0, 0), (0, 0, 0), (0, 0, 0), (0, 2, 2), (0, 1, 8), (2, 3, 18)])
+		self.assertEqual([(m["level_type"], m["level"]) for m in messages[0:4]], [(100, 85000.0), (100, 50000.0), (103, 2.0), (103, 10.0)])
+		self.assertEqual((messages[5]["level"], messages[5]["level_type2"], messages[5]["level2"]), (0.0, 106, 0.1))
+		self.assertEqual(messages[4]["stat"], 1)
+		self.assertTrue(all(m["forecast"] == 6.0 and m["reftime"] == "20190526000000" for m in messages))
+
+	def test_not_grib2(self):
+		data = bytearray(self.messages[0])
+		data[7] = 1
+		with open(self.path, "wb") as f:
+			f.write(bytes(data))
+		with self.assertRaises(ValueError):
+			GribIndex.scan_file(self.path)
+
+	def test_field_names(self):
+		names = [GribIndex.field_name(m) for m in GribIndex.scan_file(self.path)["messages"]]
+		self.assertEqual(names, ["TMPprs", "TMPprs", "TMP2m", "UGRD10m", "APCPsfc", "TSOIL0_0p1bgl"])
+
+	def test_control_file(self):
+		index = GribIndex.scan_file(self.path)
+		lines = GribIndex.control_file(self.path, index).splitlines()
+		self.assertEqual(lines[0], "dset ^WRFPRS.GrbF06")
+		self.assertIn("dtype grib2", lines)
+		self.assertIn("xdef 360 linear 0 1", lines)
+		self.assertIn("ydef 181 linear -90 1", lines)
+		self.assertIn("tdef 1 linear 06Z26may2019 1hr", lines)
+		self.assertIn("zdef 2 levels 850 500", lines)
+		start = lines.index("vars 5")
+		self.assertEqual(lines[start + 1:], ["TMPprs 2,100 0,0,0 ** isobaric TMPprs",
+											 "TMP2m 0,103,2 0,0,0 ** TMP2m",
+											 "UGRD10m 0,103,10 0,2,2 ** UGRD10m",
+											 "APCPsfc 0,1 0,1,8,1 ** APCPsfc",
+											 "TSOIL0_0p1bgl 0,106,0,0.1 2,3,18 ** TSOIL0_0p1bgl",
+											 "endvars"])
+
+	def test_template_control_file(self):
+		index = GribIndex.scan_file(self.path)
+		out = GribIndex.control_file(self.path, index, template = "WRFPRS.GrbF%f2", times = 4, step = 3)
+		self.assertIn("dset ^WRFPRS.GrbF%f2\n", out)
+		self.assertIn("options template\n", out)
+		self.assertIn("tdef 4 linear 06Z26may2019 3hr\n", out)
+
+	def test_lambert_grid(self):
+		grid = GribIndex.parse_grid(lambert_grid(100, 80, 30000000, 260000000, 38000000, 262000000, 12000000, 12000000, 38000000, 38000000))
+		self.assertEqual((grid["template"], grid["nx"], grid["ny"], grid["la1"], grid["lo1"], grid["dx"], grid["latin1"]), (30, 100, 80, 30.0, 260.0, 12000.0, 38.0))
+		lat, lon = GribIndex.lambert_latlon(grid, 0, 0)
+		self.assertAlmostEqual(lat, 30.0, places = 4)
+		self.assertAlmostEqual(lon, -100.0, places = 4)
+		# North of the first point along the central meridian side of the domain
+		self.assertGreater(GribIndex.lambert_latlon(grid, 0, 79)[0], 38.0)
+		lines = GribIndex.grid_lines(grid)
+		self.assertTrue(lines[0].startswith("pdef 100 80 lcc 30 -100 1 1 38 38 -98 12000 12000"))
+		self.assertTrue(lines[1].startswith("xdef ") and lines[2].startswith("ydef "))
+
+	def test_build_index_cache(self):
+		index = GribIndex.build_index(self.path)
+		with open(self.path + ".inv.json") as f:
+			self.assertEqual(json.load(f)["messages"], index["messages"])
+		self.assertEqual(GribIndex.build_index(self.path), index)
+		with open(self.path, "ab") as f:
+			f.write(self.messages[0])
+		self.assertEqual(len(GribIndex.build_index(self.path)["messages"]), 7)
+
+	def test_write_controls(self):
+		with open(self.tmp + "/empty.grb", "wb") as f:
+			f.write(bytes(64))
+		writer = GribIndex.GribIndex(type("Settings", (), {"fetch": lambda self, key: "1" if key == "ctl_processes" else None})())
+		failed = writer.write_controls([(self.path, self.tmp + "/WRFPRS.ctl"), (self.tmp + "/empty.grb", self.tmp + "/empty.ctl")])
+		self.assertEqual(failed, [self.tmp + "/empty.grb"])
+		self.assertTrue(os.path.isfile(self.tmp + "/WRFPRS.ctl"))
+
+if __name__ == "__main__":
+	unittest.main()
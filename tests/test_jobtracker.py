@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# test_jobtracker.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Tests of JobTracker.py through the LocalBackend scheduler: job states from qsub to exit, afterok chains and job_exited holds
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import Logging
+import Tools
+import JobTracker
+import Jobs
+import Wait
+
+# Settings: Stands in for ApplicationSettings, only fetch() is used by Tools.popen
+class Settings:
+	settings = {}
+
+	def __init__(self, settings = None):
+		self.settings = settings if settings != None else {}
+
+	def fetch(self, key):
+		return self.settings.get(key)
+
+class LocalBackendTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.cwd = os.getcwd()
+		os.chdir(self.tmp)
+		# Keep the program log out of the scripts directory
+		Logging.Logger.instance().filePath = self.tmp + "/test.log"
+		self.settings = Settings({"scheduler": "local"})
+		self.tracker = JobTracker.JobTracker.instance()
+		self.tracker.jobs = {}
+		self.tracker.lastQuery = None
+		self.backend = JobTracker.LocalBackend()
+		self.tracker.setBackend(self.backend, interval = 0)
+
+	def tearDown(self):
+		self.backend.cancel([job.jobID for job in self.tracker.jobs.values()])
+		os.chdir(self.cwd)
+		Logging.Logger.instance().close()
+		shutil.rmtree(self.tmp)
+
+	# job: Write a job script running commands, returns its name
+	def job(self, name, commands):
+		with open(name, 'w') as f:
+			f.write("#!/bin/bash\n" + commands + "\n")
+		return name
+
+	# wait_state: Refresh the tracker until the job reaches state, fails the test after timeout seconds
+	def wait_state(self, jobID, state, timeout = 10):
+		end = time.time() + timeout
+		while time.time() < end:
+			self.tracker.refresh(force = True)
+			if(self.tracker.state(jobID) == state):
+				return
+			time.sleep(0.05)
+		self.fail("job " + jobID + " is " + self.tracker.state(jobID) + ", expected " + state)
+
+	def test_qsub_returns_tracked_job_id(self):
+		jobSub = Tools.popen(self.settings, "qsub " + self.job("a.job", "exit 0"))
+		self.assertEqual(jobSub.jobID, "1.local")
+		self.assertEqual(jobSub.fetch()[0].strip(), "1.local")
+		self.assertEqual(self.tracker.fetch("1").name, "a.job")
+		second = Tools.popen(self.settings, "qsub " + self.job("b.job", "exit 0"))
+		self.assertEqual(second.jobID, "2.local")
+
+	def test_queued_running_exited(self):
+		self.backend.queueDelay = 0.5
+		jobSub = Tools.popen(self.settings, "qsub " + self.job("a.job", "while [ ! -f go ]; do sleep 0.05; done\nexit 4"))
+		self.tracker.refresh(force = True)
+		self.assertEqual(self.tracker.state(jobSub.jobID), JobTracker.QUEUED)
+		self.wait_state(jobSub.jobID, JobTracker.RUNNING)
+		self.assertIsNone(self.tracker.exitCode(jobSub.jobID))
+		open("go", 'w').close()
+		self.wait_state(jobSub.jobID, JobTracker.EXITED)
+		job = self.tracker.fetch(jobSub.jobID)
+		self.assertEqual(job.exitCode, 4)
+		self.assertTrue(job.submitted <= job.started <= job.finished)
+
+	def test_refresh_skips_queries_inside_interval(self):
+		self.tracker.interval = 3600
+		jobSub = Tools.popen(self.settings, "qsub " + self.job("a.job", "while [ ! -f go ]; do sleep 0.05; done\nexit 0"))
+		self.tracker.refresh()
+		self.assertEqual(self.tracker.state(jobSub.jobID), JobTracker.RUNNING)
+		open("go", 'w').close()
+		time.sleep(0.5)
+		self.tracker.refresh()
+		self.assertEqual(self.tracker.state(jobSub.jobID), JobTracker.RUNNING)
+		self.wait_state(jobSub.jobID, JobTracker.EXITED)
+
+	def test_afterok_waits_and_is_removed_on_failure(self):
+		first = Tools.popen(self.settings, "qsub " + self.job("a.job", "while [ ! -f go ]; do sleep 0.05; done\nexit 1"))
+		second = Tools.popen(self.settings, "qsub -W depend=afterok:" + first.jobID + " " + self.job("b.job", "touch b_ran"))
+		self.tracker.refresh(force = True)
+		self.assertEqual(self.tracker.state(second.jobID), JobTracker.QUEUED)
+		open("go", 'w').close()
+		self.wait_state(second.jobID, JobTracker.EXITED)
+		self.assertEqual(self.tracker.exitCode(first.jobID), 1)
+		self.assertIsNone(self.tracker.exitCode(second.jobID))
+		self.assertFalse(os.path.exists("b_ran"))
+
+	def test_afterok_runs_after_success(self):
+		first = Tools.popen(self.settings, "qsub " + self.job("a.job", "exit 0"))
+		second = Tools.popen(self.settings, "qsub -W depend=afterok:" + first.jobID + " " + self.job("b.job", "touch b_ran"))
+		self.wait_state(second.jobID, JobTracker.EXITED)
+		self.assertEqual(self.tracker.exitCode(second.jobID), 0)
+		self.assertTrue(os.path.exists("b_ran"))
+
+	def test_job_exited_hold_fires_when_job_exits_without_log(self):
+		jobSub = Tools.popen(self.settings, "qsub " + self.job("a.job", "sleep 0.2\nexit 3"))
+		holds = [{"watchFile": "a.log", "contains": "Successful completion", "retCode": 1}] + Jobs.job_exited(jobSub, 3)
+		self.assertEqual(Wait.Wait(holds, abortTime = 20, timeDelay = 0.1, name = "test").hold(), 3)
+		self.assertEqual(Jobs.job_exit_text(jobSub), "job 1.local exited with code 3")
+
+	def test_log_hold_is_tested_before_job_exited(self):
+		jobSub = Tools.popen(self.settings, "qsub " + self.job("a.job", "echo \"Successful completion\" >> a.log\nexit 0"))
+		holds = [{"watchFile": "a.log", "contains": "Successful completion", "retCode": 1}] + Jobs.job_exited(jobSub, 3)
+		self.assertEqual(Wait.Wait(holds, abortTime = 20, timeDelay = 0.1, name = "test").hold(), 1)
+
+	def test_job_exited_is_empty_without_job_id(self):
+		self.assertEqual(Jobs.job_exited(Tools.popen(Settings({"debugmode": "1"}), "qsub a.job"), 3), [])
+
+if __name__ == "__main__":
+	unittest.main()
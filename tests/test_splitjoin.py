@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# test_splitjoin.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Tests of SplitJoin.py: reading variables from, and joining, hand-built per-rank (io_form 102) CDF1 files
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import Logging
+import Validate
+import SplitJoin
+import ncfiles
+
+TIMES = ["2019-05-26_00:00:00", "2019-05-26_06:00:00"]
+
+# A grid of 9 x 7 points (8 x 6 unstaggered) on 2 levels
+WE = 9
+SN = 7
+NZ = 2
+
+class SplitJoinTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		# Keep the program log out of the scripts directory
+		Logging.Logger.instance().filePath = self.tmp + "/test.log"
+		self.name = self.tmp + "/wrfrst_d01_2019-05-26_06:00:00"
+
+	def tearDown(self):
+		Logging.Logger.instance().close()
+		shutil.rmtree(self.tmp)
+
+	# split: Two ranks splitting the rows, or four ranks in a 2 x 2 layout of uneven patches
+	def split(self, ranks = 2):
+		patches = [(1, 8, 1, 3), (1, 8, 4, 6)] if ranks == 2 else [(1, 3, 1, 4), (4, 8, 1, 4), (1, 3, 5, 6), (4, 8, 5, 6)]
+		return ncfiles.write_split(self.name, TIMES, patches, WE, SN, NZ)
+
+	def test_rank_files_and_split_sets(self):
+		paths = self.split(4)
+		with open(self.name + "_extra", "w") as f:
+			f.write("not a rank file")
+		self.assertEqual(SplitJoin.rank_files(self.name), paths)
+		self.assertEqual(SplitJoin.split_sets(self.tmp), {self.name: paths})
+
+	def test_read(self):
+		for ranks in (2, 4):
+			self.split(ranks)
+			split = SplitJoin.SplitFile(self.name)
+			try:
+				self.assertEqual(split.dimensions["west_east"], 8)
+				self.assertEqual(split.dimensions["south_north"], 6)
+				shape, values = split.read("HGT")
+				self.assertEqual(shape, [6, 8])
+				self.assertEqual(list(values), [ncfiles.wrf_value(0, 0, j, i) for j in range(6) for i in range(8)])
+				shape, values = split.read("T", record = 1)
+				self.assertEqual(shape, [NZ, 6, 8])
+				self.assertEqual(list(values), [ncfiles.wrf_value(1, k, j, i) for k in range(NZ) for j in range(6) for i in range(8)])
+				shape, values = split.read("T")
+				self.assertEqual(shape, [2, NZ, 6, 8])
+				self.assertEqual(values[-1], ncfiles.wrf_value(1, NZ - 1, 5, 7))
+				self.assertEqual(split.read("Times", record = 0), ([19], TIMES[0].encode()))
+			finally:
+				split.close()
+
+	def test_join_round_trip(self):
+		for ranks in (2, 4):
+			self.split(ranks)
+			outPath = self.tmp + "/joined_" + str(ranks) + ".nc"
+			split = SplitJoin.SplitFile(self.name)
+			try:
+				self.assertTrue(split.join(outPath, processes = 2))
+			finally:
+				split.close()
+			with open(outPath, "rb") as f:
+				joined = f.read()
+			# The joined file is the whole-domain file written with io_form 2, as a CDF2 file with the patch covering the domain
+			whole = ncfiles.wrf_tile(TIMES, 1, 8, 1, 6, WE, SN, NZ, version = 2)
+			header = Validate.parse_classic(joined)
+			self.assertEqual(header["dimensions"], Validate.parse_classic(whole)["dimensions"])
+			self.assertEqual(header["attributes"]["WEST-EAST_PATCH_END_UNSTAG"], (8,))
+			self.assertEqual(header["attributes"]["SOUTH-NORTH_PATCH_START_UNSTAG"], (1,))
+			self.assertEqual(Validate.check_header(joined, header, {"times": TIMES, "attributes": {"WEST-EAST_GRID_DIMENSION": WE}}), [])
+			self.assertEqual(joined, whole)
+			self.assertFalse(os.path.exists(outPath + ".tmp"))
+			os.remove(outPath)
+			for path in SplitJoin.rank_files(self.name):
+				os.remove(path)
+
+	def test_missing_rank(self):
+		paths = self.split(4)
+		os.remove(paths[2])
+		with self.assertRaises(ValueError) as raised:
+			SplitJoin.SplitFile(self.name)
+		self.assertIn("a rank file is missing", str(raised.exception))
+
+	def test_not_split(self):
+		with open(self.name + "_0000", "wb") as f:
+			f.write(ncfiles.classic([("Time", 0), ("west_east", 8)], [], [("X", ncfiles.NC_INT, ["Time", "west_east"], [ncfiles.ints(range(8))])], 1))
+		with self.assertRaises(ValueError) as raised:
+			SplitJoin.SplitFile(self.name)
+		self.assertIn("Not written with io_form 102", str(raised.exception))
+		with self.assertRaises(ValueError):
+			SplitJoin.SplitFile(self.tmp + "/none")
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# test_template.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Tests of Template.py: compiled templates, rendering with the replacement keys and unresolved [keys]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import Logging
+import Template
+
+# Settings: Stands in for ApplicationSettings, only replacementKeys is used by Template_Writer
+class Settings:
+	replacementKeys = {}
+
+	def __init__(self, replacementKeys):
+		self.replacementKeys = replacementKeys
+
+class TemplateTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		# Keep the program log out of the scripts directory
+		Logging.Logger.instance().filePath = self.tmp + "/test.log"
+
+	def tearDown(self):
+		Logging.Logger.instance().close()
+		shutil.rmtree(self.tmp)
+
+	def template(self, text):
+		path = self.tmp + "/namelist.template"
+		with open(path, 'w') as f:
+			f.write(text)
+		return path
+
+	def test_compiled_tokens(self):
+		compiled = Template.CompiledTemplate("run_hours = [run_hours],\ne_we = [e_we], [e_we]\n")
+		self.assertEqual(compiled.keys, ["[e_we]", "[run_hours]"])
+		self.assertEqual("".join(token for isKey, token in compiled.tokens), "run_hours = [run_hours],\ne_we = [e_we], [e_we]\n")
+
+	def test_render(self):
+		compiled = Template.CompiledTemplate("start = [start_year]-[start_month], dx = [dx]")
+		text, unresolved = compiled.render({"[start_year]": 2019, "[start_month]": "05", "[dx]": 12000})
+		self.assertEqual(text, "start = 2019-05, dx = 12000")
+		self.assertEqual(unresolved, [])
+
+	def test_unresolved_key_is_reported_once_and_kept(self):
+		compiled = Template.CompiledTemplate("e_we = [e_we], [e_we]\ne_sn = [e_sn]\n")
+		text, unresolved = compiled.render({"[e_sn]": 100})
+		self.assertEqual(unresolved, ["[e_we]"])
+		self.assertEqual(text, "e_we = [e_we], [e_we]\ne_sn = 100\n")
+
+	def test_brackets_that_are_not_keys_are_literal(self):
+		compiled = Template.CompiledTemplate("a[i+1] = [x y], [] [ok]")
+		self.assertEqual(compiled.keys, ["[ok]"])
+		self.assertEqual(compiled.render({"[ok]": "1"}), ("a[i+1] = [x y], [] 1", []))
+
+	def test_generate_templated_file(self):
+		writer = Template.Template_Writer(Settings({"[e_we]": "1400", "[e_sn]": "900"}))
+		path = self.template("  e_we = [e_we],  \n e_sn = [e_sn],\n dx = [dx],\n")
+		outFile = self.tmp + "/namelist.input"
+		unresolved = writer.generateTemplatedFile(path, outFile, extraKeys = {"[dx]": "3000", "[e_sn]": "901"})
+		self.assertEqual(unresolved, [])
+		with open(outFile) as f:
+			# Lines are stripped, extraKeys take precedence over the settings
+			self.assertEqual(f.read(), "e_we = 1400,\ne_sn = 901,\ndx = 3000,\n")
+
+	def test_generate_templated_file_unresolved(self):
+		writer = Template.Template_Writer(Settings({"[e_we]": "1400"}))
+		outFile = self.tmp + "/namelist.input"
+		self.assertEqual(writer.generateTemplatedFile(self.template("e_we = [e_we]\nnum_metgrid_levels = [num_metgrid_levels]\n"), outFile),
+						 ["[num_metgrid_levels]"])
+
+	def test_compile_file_cache_follows_changes(self):
+		path = self.template("a = [a]\n")
+		first = Template.compile_file(path)
+		self.assertIs(Template.compile_file(path), first)
+		time.sleep(0.01)
+		with open(path, 'w') as f:
+			f.write("a = [a], b = [b]\n")
+		os.utime(path, (time.time() + 5, time.time() + 5))
+		self.assertEqual(Template.compile_file(path).keys, ["[a]", "[b]"])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# test_tools.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Tests of the domain decomposition solver in Tools.py (rank_decompositions, detect_ideal_processors)
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import Tools
+
+class DecompositionTests(unittest.TestCase):
+	# The 1400x900 grid on 10 nodes of 40 cores, 2 quilt groups of 8 I/O ranks leave 384 compute ranks
+	def ranked(self):
+		return Tools.rank_decompositions(1400, 900, 10, 40, 2, 8)
+
+	def test_candidates_are_divisor_pairs_of_the_compute_ranks(self):
+		ranked = self.ranked()
+		self.assertTrue(ranked)
+		for c in ranked:
+			self.assertEqual(c["nproc_x"] * c["nproc_y"], 384)
+			self.assertEqual(c["patch_x"], 1400 // c["nproc_x"])
+			self.assertEqual(c["patch_y"], 900 // c["nproc_y"])
+		self.assertEqual(len(set((c["nproc_x"], c["nproc_y"]) for c in ranked)), len(ranked))
+
+	def test_ranked_by_score(self):
+		scores = [c["score"] for c in self.ranked()]
+		self.assertEqual(scores, sorted(scores))
+
+	def test_best_is_near_square_with_least_halo(self):
+		ranked = self.ranked()
+		best = ranked[0]
+		self.assertEqual((best["nproc_x"], best["nproc_y"]), (24, 16))
+		self.assertTrue(best["io_aligned"])
+		self.assertLess(best["squareness"], 1.1)
+		self.assertAlmostEqual(best["halo"], 1.0, places = 2)
+		self.assertEqual(best["halo"], min(c["halo"] for c in ranked))
+		self.assertEqual(Tools.detect_ideal_processors(1400, 900, 10, 40, 2, 8), (24, 16))
+
+	def test_skinny_patches_rank_below_square_ones(self):
+		ranked = self.ranked()
+		order = [(c["nproc_x"], c["nproc_y"]) for c in ranked]
+		# 8x48 gives 175x18 point patches
+		self.assertGreater(order.index((8, 48)), order.index((24, 16)))
+		skinny = ranked[order.index((8, 48))]
+		self.assertGreater(skinny["squareness"], 9.0)
+
+	def test_nio_alignment(self):
+		for c in self.ranked():
+			self.assertEqual(c["io_aligned"], c["nproc_y"] % 8 == 0)
+		# 32x12 has less halo than the runner-up, but 12 rows do not split over 8 I/O ranks
+		ranked = self.ranked()
+		order = [(c["nproc_x"], c["nproc_y"]) for c in ranked]
+		unaligned = ranked[order.index((32, 12))]
+		self.assertFalse(unaligned["io_aligned"])
+		self.assertLess(unaligned["halo"], ranked[1]["halo"])
+		self.assertGreater(unaligned["score"], ranked[1]["score"])
+
+	def test_min_patch(self):
+		for c in self.ranked():
+			self.assertGreaterEqual(min(c["patch_x"], c["patch_y"]), 10)
+		self.assertEqual(Tools.rank_decompositions(100, 100, 1, 400, 0, 0), [])
+		self.assertIsNone(Tools.detect_ideal_processors(100, 100, 1, 400, 0, 0))
+
+	def test_no_compute_ranks_left(self):
+		self.assertEqual(Tools.rank_decompositions(1400, 900, 1, 4, 1, 4), [])
+
+if __name__ == "__main__":
+	unittest.main()
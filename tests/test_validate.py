@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# test_validate.py
+# Robert C Fritzen - Dpt. Geographic & Atmospheric Sciences
+#
+# Tests of Validate.py against hand-built classic NetCDF files: header parsing, truncated files, Times records and io_form 102 rank sets
+
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import Logging
+import Validate
+import ncfiles
+
+TIMES = ["2019-05-26_00:00:00", "2019-05-26_06:00:00"]
+
+# Settings: Stands in for ApplicationSettings, only fetch(), startTime and endTime are used by Validate
+class Settings:
+	settings = {}
+	startTime = None
+	endTime = None
+
+	def __init__(self, settings, startTime, endTime):
+		self.settings = settings
+		self.startTime = startTime
+		self.endTime = endTime
+
+	def fetch(self, key):
+		return self.settings.get(key)
+
+# ModelParms: Stands in for ModelData.ModelDataParameters
+class ModelParms:
+	def fetch(self):
+		return {"HourDelta": 6}
+
+class ValidateTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		# Keep the program log out of the scripts directory
+		Logging.Logger.instance().filePath = self.tmp + "/test.log"
+
+	def tearDown(self):
+		Logging.Logger.instance().close()
+		shutil.rmtree(self.tmp)
+
+	def write(self, name, data):
+		with open(self.tmp + '/' + name, "wb") as f:
+			f.write(data)
+		return self.tmp + '/' + name
+
+	def expected(self, times = TIMES):
+		return {"times": times, "attributes": {"WEST-EAST_GRID_DIMENSION": 9, "SOUTH-NORTH_GRID_DIMENSION": 7}, "dimensions": {"bottom_top": 2}}
+
+	def test_parse_classic(self):
+		for version in (1, 2):
+			header = Validate.parse_classic(ncfiles.wrf_tile(TIMES, 1, 8, 1, 6, 9, 7, version = version))
+			self.assertEqual(header["format"], "CDF" + str(version))
+			self.assertEqual(header["numrecs"], 2)
+			self.assertEqual(header["dimensions"], {"Time": 0, "DateStrLen": 19, "west_east": 8, "south_north": 6, "bottom_top": 2})
+			self.assertEqual(header["attributes"]["TITLE"], "OUTPUT FROM TEST")
+			self.assertEqual(header["attributes"]["WEST-EAST_GRID_DIMENSION"], (9,))
+			variables = dict((var["name"], var) for var in header["variables"])
+			self.assertEqual(sorted(variables), ["HGT", "T", "Times", "ZNU"])
+			self.assertFalse(variables["HGT"]["record"])
+			self.assertTrue(variables["T"]["record"])
+			self.assertEqual(variables["T"]["size"], 4 * 2 * 6 * 8)
+			self.assertEqual(header["recordSize"], 20 + 4 * 2 * 6 * 8)
+
+	def test_complete_file_passes(self):
+		path = self.write("wrfout_d01", ncfiles.wrf_tile(TIMES, 1, 8, 1, 6, 9, 7))
+		path, description, problems = Validate.validate_file((path, self.expected()))
+		self.assertEqual(problems, [])
+		self.assertEqual(description, "CDF1, 2 records")
+
+	def test_truncated_file(self):
+		data = ncfiles.wrf_tile(TIMES, 1, 8, 1, 6, 9, 7)
+		path, description, problems = Validate.validate_file((self.write("wrfout_d01", data[:-100]), self.expected()))
+		self.assertEqual(problems, ["truncated, " + str(len(data) - 100) + " of " + str(len(data)) + " bytes"])
+
+	def test_truncated_header(self):
+		path, description, problems = Validate.validate_file((self.write("wrfout_d01", ncfiles.wrf_tile(TIMES, 1, 8, 1, 6, 9, 7)[:60]), self.expected()))
+		self.assertEqual(len(problems), 1)
+		self.assertIn("truncated", problems[0])
+
+	def test_wrong_times(self):
+		path = self.write("wrfbdy_d01", ncfiles.wrf_tile(["2019-05-26_00:00:00", "2019-05-26_12:00:00"], 1, 8, 1, 6, 9, 7))
+		path, description, problems = Validate.validate_file((path, self.expected()))
+		self.assertEqual(problems, ["Times holds 2 records (2019-05-26_00:00:00 to 2019-05-26_12:00:00), expected 2 (2019-05-26_00:00:00 to 2019-05-26_06:00:00)"])
+		path, description, problems = Validate.validate_file((path, self.expected(TIMES + ["2019-05-26_12:00:00"])))
+		self.assertEqual(len(problems), 1)
+		self.assertIn("expected 3", problems[0])
+
+	def test_wrong_grid(self):
+		path = self.write("wrfinput_d01", ncfiles.wrf_tile(TIMES, 1, 8, 1, 6, 9, 7, NZ = 3))
+		path, description, problems = Validate.validate_file((path, self.expected()))
+		self.assertEqual(problems, ["dimension bottom_top is 3, expected 2"])
+		expected = self.expected()
+		expected["attributes"]["WEST-EAST_GRID_DIMENSION"] = 10
+		path, description, problems = Validate.validate_file((path, {"attributes": expected["attributes"]}))
+		self.assertEqual(problems, ["WEST-EAST_GRID_DIMENSION is 9, expected 10"])
+
+	def test_file_still_being_written(self):
+		data = bytearray(ncfiles.wrf_tile(TIMES, 1, 8, 1, 6, 9, 7))
+		data[4:8] = b"\xff\xff\xff\xff"
+		path, description, problems = Validate.validate_file((self.write("wrfout_d01", bytes(data)), self.expected()))
+		self.assertEqual(problems, ["the record count is not final (The file is still being written)"])
+
+	def test_missing_and_empty_files(self):
+		self.assertEqual(Validate.validate_file((self.write("empty", b""), self.expected()))[2], ["zero-length file"])
+		self.assertEqual(len(Validate.validate_file((self.tmp + "/missing", self.expected()))[2]), 1)
+
+	def test_check_split(self):
+		name = self.tmp + "/met_em.d01.2019-05-26_00:00:00.nc"
+		paths = ncfiles.write_split(name, TIMES[:1], [(1, 4, 1, 3), (5, 8, 1, 3), (1, 4, 4, 6), (5, 8, 4, 6)], 9, 7)
+		expected = dict(self.expected(TIMES[:1]), split = True)
+		self.assertEqual(Validate.validate_file((name, expected)), (name, "4 rank files", []))
+		# A truncated rank is reported with its rank number
+		with open(paths[1], "rb") as f:
+			data = f.read()
+		with open(paths[1], "wb") as f:
+			f.write(data[:-8])
+		problems = Validate.validate_file((name, expected))[2]
+		self.assertEqual(len(problems), 1)
+		self.assertTrue(problems[0].startswith("rank 0001: truncated"))
+		# A missing rank leaves part of the domain uncovered
+		os.remove(paths[1])
+		self.assertEqual(Validate.validate_file((name, expected))[2], ["3 rank files cover 36 of 48 grid points, a rank file is missing"])
+		self.assertEqual(Validate.check_split(self.tmp + "/none", expected)[2], ["no per-rank files"])
+
+	def test_check_split_record_counts(self):
+		name = self.tmp + "/met_em.d01.2019-05-26_00:00:00.nc"
+		paths = ncfiles.write_split(name, TIMES[:1], [(1, 4, 1, 6), (5, 8, 1, 6)], 9, 7)
+		with open(paths[1], "wb") as f:
+			f.write(ncfiles.wrf_tile(TIMES, 5, 8, 1, 6, 9, 7))
+		problems = Validate.check_split(name, {"attributes": self.expected()["attributes"]})[2]
+		self.assertEqual(len(problems), 1)
+		self.assertIn("holds 2 records", problems[0])
+
+	def test_met_em_jobs(self):
+		os.mkdir(self.tmp + "/output")
+		ncfiles.write_split(self.tmp + "/output/met_em.d01.2019-05-26_00:00:00.nc", TIMES[:1], [(1, 8, 1, 6)], 9, 7)
+		self.write("output/met_em.d01.2019-05-26_06:00:00.nc", ncfiles.wrf_tile(TIMES[1:], 1, 8, 1, 6, 9, 7))
+		settings = Settings({"rundir": self.tmp, "e_we": "9", "e_sn": "7", "num_metgrid_levels": "2", "validate_processes": "1"},
+							datetime.datetime(2019, 5, 26, 0), datetime.datetime(2019, 5, 26, 12))
+		validate = Validate.Validate(settings, ModelParms())
+		jobs = validate.met_em_jobs()
+		self.assertEqual([(os.path.basename(path), expected.get("split", False)) for path, expected in jobs],
+						 [("met_em.d01.2019-05-26_00:00:00.nc", True), ("met_em.d01.2019-05-26_06:00:00.nc", False),
+						  ("met_em.d01.2019-05-26_12:00:00.nc", False)])
+		self.assertEqual(jobs[1][1]["times"], ["2019-05-26_06:00:00"])
+
+if __name__ == "__main__":
+	unittest.main()